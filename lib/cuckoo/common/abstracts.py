@@ -19,6 +19,7 @@ from lib.cuckoo.common.exceptions import CuckooDependencyError
 from lib.cuckoo.common.objects import Dictionary
 from lib.cuckoo.common.utils import create_folder
 from lib.cuckoo.core.database import Database
+from lib.cuckoo.core.machines import MachineRegistry
 
 try:
     import libvirt
@@ -66,6 +67,8 @@ class Machinery(object):
         self.options_globals = Config()
         # Database pointer.
         self.db = Database()
+        # In-memory mirror of the machines table.
+        self.registry = MachineRegistry(self.db)
 
         # Machine table is cleaned to be filled from configuration file
         # at each start.
@@ -83,6 +86,7 @@ class Machinery(object):
         """
         # Load.
         self._initialize(module_name)
+        self.registry.load()
 
         # Run initialization checks.
         self._initialize_check()
@@ -191,13 +195,22 @@ class Machinery(object):
         """List virtual machines.
         @return: virtual machines list
         """
-        return self.db.list_machines()
+        return self.registry.list()
 
     def availables(self, locked_by=None):
         """How many machines are free.
         @return: free machines count.
         """
-        return self.db.count_machines_available(locked_by)
+        return self.registry.count_available(locked_by)
+
+    def free_machines(self):
+        """List machines which are not locked by any analysis.
+        @return: free virtual machines list.
+        """
+        # With all the machines busy, machines unlocked by other processes
+        # are looked for on every call.
+        self.registry.sync(force=not self.registry.count_available())
+        return self.registry.available()
 
     def acquire(self, machine_id=None, platform=None, tags=None, locked_by=None):
         """Acquire a machine to start analysis.
@@ -207,23 +220,31 @@ class Machinery(object):
         @return: machine or None.
         """
         if machine_id:
-            return self.db.lock_machine(name=machine_id, locked_by=locked_by)
+            return self.registry.acquire(name=machine_id, locked_by=locked_by)
         elif platform:
-            return self.db.lock_machine(platform=platform, tags=tags, locked_by=locked_by)
+            return self.registry.acquire(platform=platform, tags=tags, locked_by=locked_by)
         else:
-            return self.db.lock_machine(tags=tags, locked_by=locked_by)
+            return self.registry.acquire(tags=tags, locked_by=locked_by)
 
     def release(self, label=None):
         """Release a machine.
         @param label: machine name.
         """
-        self.db.unlock_machine(label)
+        self.registry.release(label)
+
+    def get_lock(self, label):
+        """Lock serializing the operations on a machine, e.g., so that it's
+        not started and stopped at the same time.
+        @param label: machine name.
+        @return: lock object.
+        """
+        return self.registry.get_lock(label)
 
     def running(self):
         """Returns running virtual machines.
         @return: running virtual machines list.
         """
-        return self.db.list_machines(status="running")
+        return self.registry.running()
 
     def shutdown(self):
         """Shutdown the machine manager. Kills all alive machines.
@@ -239,12 +260,15 @@ class Machinery(object):
                     log.warning("Unable to shutdown machine %s, please check "
                                 "manually. Error: %s", machine.label, e)
 
+        # Make sure the database reflects the final state of the machines.
+        self.registry.flush()
+
     def set_status(self, label, status):
         """Set status for a virtual machine.
         @param label: virtual machine label
         @param status: new virtual machine status
         """
-        self.db.set_machine_status(label, status)
+        self.registry.set_status(label, status)
 
     def start(self, label=None, revert=True):
         """Start a machine.
@@ -995,6 +1019,13 @@ class Report(object):
         """
         self.task = task
 
+    def setup(self):
+        """Prepare the module once at startup, before the analyses are
+        reported in their own processes. Only the options are set.
+        @raise CuckooReportError: if the module can't be used.
+        """
+        pass
+
     def run(self):
         """Start report processing.
         @raise NotImplementedError: this method is abstract.
@@ -0,0 +1,210 @@
+# Copyright (C) 2010-2014 Cuckoo Foundation.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import os
+import stat
+import errno
+import fcntl
+import shutil
+import hashlib
+import logging
+import tempfile
+from contextlib import contextmanager
+
+from lib.cuckoo.common.constants import CUCKOO_ROOT
+from lib.cuckoo.common.exceptions import CuckooOperationalError
+
+log = logging.getLogger(__name__)
+
+# ioctl cloning a file on copy-on-write file systems (btrfs, xfs).
+FICLONE = 0x40049409
+
+def file_sha256(path):
+    """Hash a file.
+    @param path: file path.
+    @return: SHA256 hex digest.
+    """
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as fd:
+        for chunk in iter(lambda: fd.read(1024 * 1024), ""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+def makedirs(folder):
+    """Create a folder and its parents, unless it exists.
+    @param folder: folder path.
+    @raise CuckooOperationalError: if the folder can't be created.
+    """
+    if os.path.isdir(folder):
+        return
+
+    try:
+        os.makedirs(folder)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise CuckooOperationalError("Unable to create folder: "
+                                         "%s" % folder)
+
+def open_new(path):
+    """Open a file for writing in place of an existing one. The file is
+    replaced rather than truncated, as it may be a link to a blob shared by
+    other analyses.
+    @param path: file path.
+    @return: file object.
+    """
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    return open(path, "wb")
+
+def reflink(src, dst):
+    """Clone a file, sharing its data until either copy is modified.
+    @param src: source file path.
+    @param dst: destination file path, created.
+    @raise IOError: if the file system doesn't support it.
+    """
+    with open(src, "rb") as src_fd:
+        with open(dst, "wb") as dst_fd:
+            try:
+                fcntl.ioctl(dst_fd.fileno(), FICLONE, src_fd.fileno())
+            except IOError:
+                os.unlink(dst)
+                raise
+
+class BlobStore(object):
+    """Content-addressed store of the files of the analyses.
+
+    Each distinct file is stored once as storage/blobs/<xx>/<sha256> and is
+    hardlinked in place of its copies, so the link count of a blob tells how
+    many files still reference it. Where hardlinks aren't possible, the
+    copies are cloned from the blob if the file system supports it.
+
+    The blobs and their links are read-only, files written where a link may
+    be are to be opened with open_new(). The links are made while holding a
+    shared lock on the store, which collect() takes exclusively before
+    deleting a blob.
+    """
+
+    def __init__(self, root=None):
+        """@param root: store folder, storage/blobs by default."""
+        self.root = root or os.path.join(CUCKOO_ROOT, "storage", "blobs")
+
+    def path(self, sha256):
+        """@return: path of the blob with the given hash."""
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    @contextmanager
+    def lock(self, exclusive=False):
+        """Lock the store.
+        @param exclusive: whether to take the lock exclusively.
+        """
+        makedirs(self.root)
+        with open(os.path.join(self.root, "lock"), "a") as fd:
+            fcntl.flock(fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            yield
+
+    def exists(self, sha256):
+        """@return: whether a blob with the given hash is stored."""
+        return os.path.exists(self.path(sha256))
+
+    def refcount(self, sha256):
+        """@return: number of files sharing the blob with the given hash."""
+        try:
+            return os.stat(self.path(sha256)).st_nlink - 1
+        except OSError:
+            return 0
+
+    def store(self, file_path, sha256):
+        """Store a file as a blob, unless there's already one.
+        @param file_path: file path.
+        @param sha256: hash of the file.
+        @return: blob path.
+        """
+        blob_path = self.path(sha256)
+        if os.path.exists(blob_path):
+            return blob_path
+
+        folder = os.path.dirname(blob_path)
+        makedirs(folder)
+
+        # The file itself becomes the blob when possible. Otherwise it's
+        # copied to a temporary file first, so that concurrent stores of the
+        # same content never expose a partial blob.
+        try:
+            os.link(file_path, blob_path)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                return blob_path
+
+            fd, tmp_path = tempfile.mkstemp(dir=folder)
+            os.close(fd)
+            try:
+                shutil.copyfile(file_path, tmp_path)
+                os.rename(tmp_path, blob_path)
+            except:
+                os.unlink(tmp_path)
+                raise
+
+        os.chmod(blob_path, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+        return blob_path
+
+    def add(self, file_path, sha256=None):
+        """Store a file and replace it by a link to its blob.
+        @param file_path: file path.
+        @param sha256: hash of the file, computed if not given.
+        @return: hash of the file.
+        """
+        if not sha256:
+            sha256 = file_sha256(file_path)
+
+        # The blob can't be collected until the file is linked to it.
+        with self.lock():
+            blob_path = self.store(file_path, sha256)
+            if os.path.samefile(blob_path, file_path):
+                return sha256
+
+            # The link is made aside and moved over the file, so that the
+            # file is never missing.
+            tmp_path = "%s.%s.tmp" % (file_path, os.getpid())
+            try:
+                try:
+                    os.link(blob_path, tmp_path)
+                except OSError:
+                    reflink(blob_path, tmp_path)
+                    os.chmod(tmp_path,
+                             stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+                os.rename(tmp_path, file_path)
+            except (IOError, OSError) as e:
+                log.debug("Unable to link \"%s\" to its blob, keeping a "
+                          "copy: %s", file_path, e)
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
+        return sha256
+
+    def collect(self):
+        """Delete the blobs no file refers to anymore.
+        @return: number of blobs deleted.
+        """
+        count = 0
+        for dir_name, dir_names, file_names in os.walk(self.root):
+            for file_name in file_names:
+                # Skip the blobs being stored.
+                if len(file_name) != 64:
+                    continue
+
+                blob_path = os.path.join(dir_name, file_name)
+                try:
+                    if os.stat(blob_path).st_nlink != 1:
+                        continue
+
+                    # Check again once no file can be linked to the blob.
+                    with self.lock(exclusive=True):
+                        if os.stat(blob_path).st_nlink == 1:
+                            os.unlink(blob_path)
+                            count += 1
+                except OSError:
+                    pass
+        return count
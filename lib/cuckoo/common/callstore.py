@@ -0,0 +1,216 @@
+# Copyright (C) 2010-2014 Cuckoo Foundation.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import os
+import mmap
+import struct
+import marshal
+import shutil
+import tempfile
+
+from lib.cuckoo.common.exceptions import CuckooOperationalError
+
+# File layout:
+#   HEADER
+#   one blob per call, the marshal'ed variable part of the call
+#   one RECORD per call, the fixed-width columns of the call
+#   the marshal'ed table of the interned strings and metadata dictionary
+#   FOOTER
+MAGIC = "CUCKOOCS"
+VERSION = 2
+HEADER = struct.Struct("<8sI")
+# Blob offset, blob length, api, category, thread id, status, repeated.
+RECORD = struct.Struct("<QIIIIBI")
+# Records offset, strings offset, number of calls, magic.
+FOOTER = struct.Struct("<QQI8s")
+
+# Status of the records whose blob is the whole call dictionary, used for
+# the calls which don't have the usual fields (e.g., anomalies).
+STATUS_RAW = 0xff
+
+class CallStoreWriter(object):
+    """Writes the calls of a process to a call store file."""
+
+    def __init__(self, path, meta=None):
+        """@param path: path of the call store file.
+        @param meta: optional metadata dictionary, written when the call
+                     store is closed.
+        """
+        self.path = path
+        self.tmppath = path + ".tmp"
+        self.fd = open(self.tmppath, "wb")
+        self.fd.write(HEADER.pack(MAGIC, VERSION))
+        self.records = tempfile.TemporaryFile()
+        self.strings = {}
+        self.meta = meta if meta is not None else {}
+        self.count = 0
+
+    def _intern(self, value):
+        """@return: index of the value in the strings table."""
+        index = self.strings.get(value)
+        if index is None:
+            index = self.strings[value] = len(self.strings)
+        return index
+
+    def add(self, call):
+        """Append a call.
+        @param call: call dictionary, as returned by ParseProcessLog.
+        """
+        try:
+            blob = marshal.dumps((call["timestamp"], call["return"],
+                                  call["arguments"]), 2)
+            record = (self._intern(call["api"]),
+                      self._intern(call["category"]),
+                      self._intern(call["thread_id"]),
+                      int(call["status"]), call["repeated"])
+        except KeyError:
+            blob = marshal.dumps(call, 2)
+            record = 0, 0, 0, STATUS_RAW, 0
+
+        self.records.write(RECORD.pack(self.fd.tell(), len(blob), *record))
+        self.fd.write(blob)
+        self.count += 1
+
+    def close(self):
+        """Complete the call store, it's only visible once closed."""
+        records_offset = self.fd.tell()
+        self.records.seek(0)
+        shutil.copyfileobj(self.records, self.fd)
+        self.records.close()
+
+        strings = [None] * len(self.strings)
+        for value, index in self.strings.iteritems():
+            strings[index] = value
+
+        strings_offset = self.fd.tell()
+        self.fd.write(marshal.dumps((strings, self.meta), 2))
+        self.fd.write(FOOTER.pack(records_offset, strings_offset,
+                                  self.count, MAGIC))
+        self.fd.close()
+
+        os.rename(self.tmppath, self.path)
+
+    def abort(self):
+        """Drop the call store being written."""
+        self.records.close()
+        self.fd.close()
+        os.unlink(self.tmppath)
+
+def write_calls(path, calls, meta=None):
+    """Write a call store.
+    @param path: path of the call store file.
+    @param calls: iterable of calls.
+    @param meta: optional metadata dictionary, it may be filled while the
+                 calls are iterated.
+    @return: number of calls written.
+    """
+    writer = CallStoreWriter(path, meta)
+    try:
+        for call in calls:
+            writer.add(call)
+    except:
+        writer.abort()
+        raise
+
+    writer.close()
+    return writer.count
+
+class CallStore(object):
+    """Read-only, memory-mapped call store.
+
+    Every call is decoded again from its compact form when accessed, the
+    API name, category and thread id of a call can be looked up without
+    decoding the rest of it.
+    """
+
+    def __init__(self, path):
+        """@param path: path of the call store file.
+        @raise CuckooOperationalError: if the file isn't a valid call store.
+        """
+        self.path = path
+        self.fd = open(path, "rb")
+        try:
+            self.mm = mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError) as e:
+            self.fd.close()
+            raise CuckooOperationalError("Invalid call store %s: %s" %
+                                         (path, e))
+
+        if len(self.mm) < HEADER.size + FOOTER.size or \
+                HEADER.unpack_from(self.mm, 0) != (MAGIC, VERSION):
+            self.close()
+            raise CuckooOperationalError("Invalid call store %s" % path)
+
+        self.records_offset, strings_offset, self.count, magic = \
+            FOOTER.unpack_from(self.mm, len(self.mm) - FOOTER.size)
+        if magic != MAGIC:
+            self.close()
+            raise CuckooOperationalError("Truncated call store %s" % path)
+
+        self.strings, self.meta = marshal.loads(
+            self.mm[strings_offset:len(self.mm) - FOOTER.size])
+
+    def close(self):
+        self.mm.close()
+        self.fd.close()
+
+    def __len__(self):
+        return self.count
+
+    def _record(self, index):
+        return RECORD.unpack_from(self.mm,
+                                  self.records_offset + index * RECORD.size)
+
+    def _decode(self, record):
+        offset, length, api, category, tid, status, repeated = record
+        blob = marshal.loads(self.mm[offset:offset + length])
+
+        if status == STATUS_RAW:
+            return blob
+
+        timestamp, returnval, arguments = blob
+        return {
+            "timestamp": timestamp,
+            "thread_id": self.strings[tid],
+            "category": self.strings[category],
+            "api": self.strings[api],
+            "status": bool(status),
+            "return": returnval,
+            "arguments": arguments,
+            "repeated": repeated,
+        }
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if index < 0 or index >= self.count:
+            raise IndexError("call index out of range")
+        return self._decode(self._record(index))
+
+    def __iter__(self):
+        for index in xrange(self.count):
+            yield self._decode(self._record(index))
+
+    def select(self, apis=None, categories=None):
+        """Iterate the calls with the given API names or categories, only
+        these calls are decoded.
+        @param apis: optional set of API names.
+        @param categories: optional set of categories.
+        """
+        for index in xrange(self.count):
+            record = self._record(index)
+            if record[5] == STATUS_RAW:
+                call = self._decode(record)
+                api, category = call.get("api"), call.get("category")
+            else:
+                call = None
+                api = self.strings[record[2]]
+                category = self.strings[record[3]]
+
+            if apis and api not in apis:
+                continue
+            if categories and category not in categories:
+                continue
+
+            yield call or self._decode(record)
@@ -20,7 +20,7 @@ class ConfigSection(object):
 
         # We make one exception here, namely, for the database connection.
         if self.file_name == "cuckoo" and self.section == "database":
-            return self.items[key]
+            return self.items.get(key)
 
         # Recursive dependencies and all that.
         from lib.cuckoo.core.database import Database
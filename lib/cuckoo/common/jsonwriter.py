@@ -0,0 +1,220 @@
+# Copyright (C) 2010-2014 Cuckoo Foundation.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import os
+import gzip
+import json
+
+from lib.cuckoo.common.exceptions import CuckooDependencyError
+
+try:
+    import zstandard
+    HAVE_ZSTD = True
+except ImportError:
+    HAVE_ZSTD = False
+
+# Amount of encoded data kept in memory before it's written out.
+BUFFER_SIZE = 1024 * 1024
+
+# File name extension of each compression.
+EXTENSIONS = {
+    None: "",
+    "gzip": ".gz",
+    "zstd": ".zst",
+}
+
+def open_output(path, compression=None):
+    """Open a file for writing, compressed if requested.
+    @param path: file path, without the compression extension.
+    @param compression: None, "gzip" or "zstd".
+    @return: file-like object.
+    @raise CuckooDependencyError: if zstandard is requested but missing.
+    @raise ValueError: if the compression is unknown.
+    """
+    if compression not in EXTENSIONS:
+        raise ValueError("Unknown compression: %s" % compression)
+
+    path += EXTENSIONS[compression]
+    if compression == "gzip":
+        return gzip.open(path, "wb")
+    if compression == "zstd":
+        if not HAVE_ZSTD:
+            raise CuckooDependencyError("Unable to import zstandard "
+                                        "(install with `pip install "
+                                        "zstandard`)")
+        return zstandard.ZstdCompressor().stream_writer(open(path, "wb"))
+    return open(path, "wb")
+
+def find_output(path):
+    """Find a file written by open_output(), whatever its compression.
+    @param path: file path, without the compression extension.
+    @return: path of the file, None if there's none.
+    """
+    for extension in EXTENSIONS.itervalues():
+        if os.path.exists(path + extension):
+            return path + extension
+    return None
+
+def open_input(path):
+    """Open a file written by open_output() for reading, decompressed.
+    @param path: file path, with its compression extension.
+    @return: file-like object.
+    @raise CuckooDependencyError: if zstandard is needed but missing.
+    """
+    if path.endswith(EXTENSIONS["gzip"]):
+        return gzip.open(path, "rb")
+    if path.endswith(EXTENSIONS["zstd"]):
+        if not HAVE_ZSTD:
+            raise CuckooDependencyError("Unable to import zstandard "
+                                        "(install with `pip install "
+                                        "zstandard`)")
+        return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"))
+    return open(path, "rb")
+
+def json_key(key):
+    """Convert a dict key as json.dump() does.
+    @param key: dict key.
+    @return: key string.
+    """
+    if isinstance(key, basestring):
+        return key
+    if key is True:
+        return "true"
+    if key is False:
+        return "false"
+    if key is None:
+        return "null"
+    if isinstance(key, float):
+        return repr(key)
+    return str(key)
+
+class JsonStreamWriter(object):
+    """Encodes a results dict to JSON incrementally.
+
+    Dicts and lists are walked, so lazy sequences such as the calls of a
+    process are encoded one element at a time and never held in memory as a
+    whole. The encoded data goes through a buffer of bounded size. The output
+    is the same as the one of json.dump() with the same indent.
+    """
+
+    def __init__(self, fd, indent=None, encoding="utf-8",
+                 buffer_size=BUFFER_SIZE):
+        """@param fd: file-like object to write to.
+        @param indent: indent level, None for compact output.
+        @param encoding: encoding of the str values.
+        @param buffer_size: maximum amount of data kept before writing.
+        """
+        self.fd = fd
+        self.indent = indent
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.size = 0
+
+        if indent is None:
+            separators = ",", ":"
+        else:
+            separators = ", ", ": "
+
+        self.encoder = json.JSONEncoder(indent=indent, encoding=encoding,
+                                        separators=separators)
+        self.item_separator, self.key_separator = separators
+
+    def write(self, data):
+        """Buffer some encoded data.
+        @param data: encoded data.
+        """
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered data out."""
+        self.fd.write("".join(self.buffer))
+        self.buffer = []
+        self.size = 0
+
+    def newline(self, level):
+        """@return: line break and indentation for the given level."""
+        if self.indent is None:
+            return ""
+        return "\n" + " " * (self.indent * level)
+
+    def encode(self, obj, level):
+        """Encode an object as a whole.
+        @param obj: object to encode.
+        @param level: nesting level of the object.
+        @return: encoded object.
+        """
+        data = self.encoder.encode(obj)
+        if level and self.indent is not None:
+            # Strings never contain raw line breaks once encoded.
+            data = data.replace("\n", self.newline(level))
+        return data
+
+    def dump(self, obj, level=0):
+        """Encode an object and write it out.
+        @param obj: object to encode.
+        @param level: nesting level of the object.
+        """
+        if isinstance(obj, dict):
+            if not obj:
+                self.write("{}")
+                return
+
+            self.write("{")
+            separator = self.newline(level + 1)
+            for key, value in obj.iteritems():
+                self.write(separator)
+                separator = self.item_separator + self.newline(level + 1)
+                self.write(self.encode(json_key(key), level + 1) +
+                           self.key_separator)
+                self.dump(value, level + 1)
+            self.write(self.newline(level) + "}")
+        elif type(obj) in (list, tuple):
+            self.dump_list(obj, level, self.dump)
+        elif isinstance(obj, (list, tuple)) or (hasattr(obj, "__iter__") and
+                                                not isinstance(obj, basestring)):
+            # Lazy sequence, its elements are encoded as a whole.
+            self.dump_list(obj, level, self.dump_whole)
+        else:
+            self.dump_whole(obj, level)
+
+    def dump_whole(self, obj, level):
+        """Encode an object as a whole and write it out.
+        @param obj: object to encode.
+        @param level: nesting level of the object.
+        """
+        self.write(self.encode(obj, level))
+
+    def dump_list(self, items, level, dump):
+        """Encode the elements of a sequence and write them out.
+        @param items: iterable.
+        @param level: nesting level of the sequence.
+        @param dump: function writing out an element.
+        """
+        empty = True
+        separator = "[" + self.newline(level + 1)
+        for item in items:
+            self.write(separator)
+            separator = self.item_separator + self.newline(level + 1)
+            dump(item, level + 1)
+            empty = False
+
+        if empty:
+            self.write("[]")
+        else:
+            self.write(self.newline(level) + "]")
+
+def dump(obj, fd, indent=None, encoding="utf-8", buffer_size=BUFFER_SIZE):
+    """Encode an object to JSON incrementally.
+    @param obj: object to encode.
+    @param fd: file-like object to write to.
+    @param indent: indent level, None for compact output.
+    @param encoding: encoding of the str values.
+    @param buffer_size: maximum amount of data kept before writing.
+    """
+    writer = JsonStreamWriter(fd, indent, encoding, buffer_size)
+    writer.dump(obj)
+    writer.flush()
@@ -6,6 +6,9 @@ import logging
 import struct
 import datetime
 import string
+from collections import deque
+
+bson_decode_all = None
 
 try:
     import bson
@@ -13,9 +16,13 @@ try:
 except ImportError:
     HAVE_BSON = False
 else:
-    # The BSON module provided by pymongo works through its "BSON" class.
+    # The BSON module provided by pymongo works through its "BSON" class,
+    # it also decodes a sequence of documents at once (in C, if the _cbson
+    # extension is available).
     if hasattr(bson, "BSON"):
         bson_decode = lambda d: bson.BSON(d).decode()
+        if hasattr(bson, "decode_all"):
+            bson_decode_all = bson.decode_all
     # The BSON module provided by "pip install bson" works through the
     # "loads" function (just like pickle etc.)
     elif hasattr(bson, "loads"):
@@ -32,6 +39,137 @@ from lib.cuckoo.common.utils import get_filename_from_path
 
 log = logging.getLogger(__name__)
 
+class IncompleteMessage(Exception):
+    """Raised by non-blocking handlers when the message being parsed hasn't
+    been entirely received yet. Parsers have to let it through, the message
+    is parsed again from its start once more data is available."""
+    pass
+
+# Initial size of the read buffers.
+READ_BUFFER_SIZE = 64 * 1024
+
+class ReadBuffer(object):
+    """Buffer the protocol parsers read from.
+
+    Data is received into a preallocated bytearray, as much as available at
+    once, and handed out as slices of it. The buffer grows when a single
+    message doesn't fit in it. The data consumed by the parser can be
+    persisted, it's written out in one go whenever the buffer is refilled
+    instead of once per read.
+    """
+
+    def __init__(self, fill, blocking=True, size=READ_BUFFER_SIZE):
+        """@param fill: function filling the writable memoryview it's given
+                        (e.g., socket.recv_into or file.readinto) and
+                        returning the number of bytes, 0 at the end of the
+                        stream.
+        @param blocking: wait for the data missing to complete a read,
+                         otherwise raise IncompleteMessage.
+        @param size: initial size of the buffer.
+        """
+        self.fill = fill
+        self.blocking = blocking
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.pos = self.end = 0
+        # Start of the consumed data not persisted yet, None when the
+        # consumed data isn't persisted.
+        self.mark = None
+        self.persist = None
+
+    def reset(self):
+        """Drop the buffered data, e.g., after a seek of the file."""
+        self.pos = self.end = 0
+        if self.mark is not None:
+            self.mark = 0
+
+    def start_persist(self, persist):
+        """Persist the data consumed from now on.
+        @param persist: function writing a memoryview.
+        """
+        self.persist = persist
+        self.mark = self.pos
+
+    def flush(self):
+        """Persist the data consumed so far."""
+        if self.mark is not None and self.pos > self.mark:
+            self.persist(self.view[self.mark:self.pos])
+            self.mark = self.pos
+
+    def make_room(self):
+        """Make room for more data, by dropping the data already consumed or
+        by growing the buffer.
+        @raise CuckooResultError: if a message doesn't fit in the maximum
+                                  message length.
+        """
+        self.flush()
+
+        if self.pos:
+            size = self.end - self.pos
+            self.buf[:size] = self.buf[self.pos:self.end]
+            self.pos, self.end = 0, size
+            if self.mark is not None:
+                self.mark = 0
+            return
+
+        if len(self.buf) >= MAX_MESSAGE_LENGTH:
+            raise CuckooResultError("Message larger than %d bytes." %
+                                    MAX_MESSAGE_LENGTH)
+
+        buf = bytearray(len(self.buf) * 2)
+        buf[:self.end] = self.view[:self.end]
+        self.buf, self.view = buf, memoryview(buf)
+
+    def receive(self):
+        """Fill the buffer with the data available.
+        @return: number of bytes received, 0 at the end of the stream.
+        """
+        if self.pos == self.end:
+            self.flush()
+            self.reset()
+        elif self.end == len(self.buf):
+            self.make_room()
+
+        length = self.fill(self.view[self.end:])
+        self.end += length
+        return length
+
+    def wait(self, length):
+        """Make sure that length bytes are available.
+        @raise IncompleteMessage: if they aren't and the buffer isn't
+                                  blocking.
+        @raise EOFError: if the end of the stream is reached first.
+        """
+        while self.end - self.pos < length:
+            if not self.blocking:
+                raise IncompleteMessage()
+            if not self.receive():
+                raise EOFError()
+
+    def read(self, length):
+        if self.end - self.pos < length:
+            self.wait(length)
+
+        buf = self.view[self.pos:self.pos+length].tobytes()
+        self.pos += length
+        return buf
+
+    def read_any(self):
+        """Read all the data available, at least one byte."""
+        if self.pos == self.end:
+            self.wait(1)
+        return self.read(self.end - self.pos)
+
+    def read_newline(self):
+        """Read up to and including the next newline."""
+        searched = 0
+        while True:
+            idx = self.buf.find("\n", self.pos + searched, self.end)
+            if idx >= 0:
+                return self.read(idx + 1 - self.pos)
+
+            searched = self.end - self.pos
+            self.wait(searched + 1)
 
 # TODO: should probably prettify this.
 def expand_format(fs):
@@ -53,37 +191,159 @@ def expand_format(fs):
 # Kind of deprecated, more generic BSON protocol below.
 ###############################################################################
 
+# Api index, status, return value, thread id, time difference.
+NETLOG_HEADER = struct.Struct("=BBIII")
+NETLOG_INT32 = struct.Struct("=I")
+NETLOG_STRING = struct.Struct("=II")
+
+# Fixed-width format specifiers.
+NETLOG_INTEGERS = "ilL"
+NETLOG_POINTERS = "pP"
+# Format specifiers of the values prefixed by their length and maximum
+# length: strings, whose length is checked, and buffers.
+NETLOG_STRINGS = "sSuUoO"
+NETLOG_BUFFERS = "bB"
+
+def netlog_read_int32(read):
+    """Reads a 32bit integer."""
+    return NETLOG_INT32.unpack(read(4))[0]
+
+def netlog_check_string(length, maxlength):
+    """Checks the length of a string."""
+    if length < 0 or length > 0x10000:
+        log.critical("read_string length weirdness "
+                     "length: %d maxlength: %d", length, maxlength)
+        raise CuckooResultError("read_string length failure, "
+                                "protocol broken?")
+
+def netlog_read_string(read):
+    """Reads an utf8 string."""
+    length, maxlength = NETLOG_STRING.unpack(read(8))
+    netlog_check_string(length, maxlength)
+
+    s = read(length)
+    if maxlength > length:
+        s += "... (truncated)"
+    return s
+
+def netlog_read_registry(read):
+    """Read logged registry data."""
+    typ = netlog_read_int32(read)
+    # Do something depending on type.
+    if typ == REG_DWORD_BIG_ENDIAN or typ == REG_DWORD_LITTLE_ENDIAN:
+        value = netlog_read_int32(read)
+    elif typ == REG_SZ or typ == REG_EXPAND_SZ:
+        value = netlog_read_string(read)
+    else:
+        value = "(unable to dump buffer content)"
+    return value
+
+def netlog_read_argv(read):
+    """Reads a list of strings."""
+    count = netlog_read_int32(read)
+    return [netlog_read_string(read) for x in xrange(count)]
+
+NETLOG_READERS = {
+    "r": netlog_read_registry, "R": netlog_read_registry,
+    "a": netlog_read_argv, "A": netlog_read_argv,
+}
+
+def compile_decoder(apiname, parseinfo):
+    """Build the decoder of the arguments of an API.
+
+    The arguments are split in groups: the fixed-width values up to and
+    including the length of the next string are unpacked with a single
+    precompiled struct. The data of that string is read along with the next
+    group, so that a call takes one read per string argument, plus one.
+    Registry values and argv lists are read by their own readers.
+
+    @param apiname: API name.
+    @param parseinfo: format specifiers and argument names, from the logtbl.
+    @return: function decoding the arguments through a read function,
+             returning a list of (name, value) tuples.
+    """
+    # List of (struct, fields, string, reader): fields are (name,
+    # is_pointer) tuples for the fixed-width values, string is the (name,
+    # is_buffer) of the string whose length ends the struct, reader is the
+    # (name, reader) of a value read after the struct.
+    groups = []
+    fmt, fields = "=", []
+
+    for fs, argname in zip(expand_format(parseinfo[0]), parseinfo[1:]):
+        if fs in NETLOG_INTEGERS or fs in NETLOG_POINTERS:
+            fmt += "I"
+            fields.append((argname, fs in NETLOG_POINTERS))
+        elif fs in NETLOG_STRINGS or fs in NETLOG_BUFFERS:
+            groups.append((struct.Struct(fmt + "II"), fields,
+                           (argname, fs in NETLOG_BUFFERS), None))
+            fmt, fields = "=", []
+        elif fs in NETLOG_READERS:
+            groups.append((struct.Struct(fmt), fields, None,
+                           (argname, NETLOG_READERS[fs])))
+            fmt, fields = "=", []
+        else:
+            log.warning("No handler for format specifier {0} on "
+                        "apitype {1}".format(fs, apiname))
+
+    if fields or not groups:
+        groups.append((struct.Struct(fmt), fields, None, None))
+
+    def string_value(buf, length, maxlength, is_buffer):
+        value = buf[:length]
+        if maxlength > length:
+            value += " ... (truncated)" if is_buffer else "... (truncated)"
+        return value
+
+    def decode(read):
+        arguments = []
+        # String whose data hasn't been read yet.
+        pending, length, maxlength = None, 0, 0
+
+        for st, fields, string, reader in groups:
+            size = length + st.size
+            buf = read(size) if size else ""
+
+            if pending:
+                arguments.append((pending[0], string_value(buf, length,
+                                                           maxlength,
+                                                           pending[1])))
+
+            values = st.unpack_from(buf, length)
+            for (argname, pointer), value in zip(fields, values):
+                if pointer:
+                    value = "0x%08x" % value
+                arguments.append((argname, value))
+
+            pending, length = string, 0
+            if string:
+                length, maxlength = values[-2:]
+                if not string[1]:
+                    netlog_check_string(length, maxlength)
+            elif reader:
+                arguments.append((reader[0], reader[1](read)))
+
+        if pending:
+            arguments.append((pending[0], string_value(read(length), length,
+                                                       maxlength, pending[1])))
+
+        return arguments
+
+    return decode
+
+# Api index -> (api name, category, arguments decoder).
+NETLOG_DECODERS = [(apiname, category, compile_decoder(apiname, parseinfo))
+                   for apiname, category, parseinfo in LOGTBL]
+
 class NetlogParser(object):
     def __init__(self, handler):
         self.handler = handler
 
-        self.formatmap = {
-            "s": self.read_string,
-            "S": self.read_string,
-            "u": self.read_string,
-            "U": self.read_string,
-            "b": self.read_buffer,
-            "B": self.read_buffer,
-            "i": self.read_int32,
-            "l": self.read_int32,
-            "L": self.read_int32,
-            "p": self.read_ptr,
-            "P": self.read_ptr,
-            "o": self.read_string,
-            "O": self.read_string,
-            "a": self.read_argv,
-            "A": self.read_argv,
-            "r": self.read_registry,
-            "R": self.read_registry,
-        }
-
     def close(self):
         pass
 
     def read_next_message(self):
-        apiindex, status = struct.unpack("BB", self.handler.read(2))
-        returnval, tid, timediff = struct.unpack("III", self.handler.read(12))
-        context = apiindex, status, returnval, tid, timediff
+        context = NETLOG_HEADER.unpack(self.handler.read(NETLOG_HEADER.size))
+        apiindex, status, returnval, tid, timediff = context
 
         if apiindex == 0:
             # New process message.
@@ -105,6 +365,8 @@ class NetlogParser(object):
             try:
                 modulepath = self.read_string()
                 procname = get_filename_from_path(modulepath)
+            except IncompleteMessage:
+                raise
             except:
                 log.exception("Exception in netlog protocol, stopping parser.")
                 return False
@@ -126,31 +388,20 @@ class NetlogParser(object):
         else:
             # Actual API call.
             try:
-                apiname, modulename, parseinfo = LOGTBL[apiindex]
+                apiname, modulename, decode = NETLOG_DECODERS[apiindex]
             except IndexError:
                 log.debug("Netlog LOGTBL lookup error for API index {0} "
                           "(pid={1}, tid={2})".format(apiindex, None, tid))
                 return False
 
-            formatspecifiers = expand_format(parseinfo[0])
-            argnames = parseinfo[1:]
-            arguments = []
-            for pos in range(len(formatspecifiers)):
-                fs = formatspecifiers[pos]
-                argname = argnames[pos]
-                fn = self.formatmap.get(fs, None)
-                if fn:
-                    try:
-                        r = fn()
-                    except:
-                        log.exception("Exception in netlog protocol, "
-                                      "stopping parser.")
-                        return False
-
-                    arguments.append((argname, r))
-                else:
-                    log.warning("No handler for format specifier {0} on "
-                                "apitype {1}".format(fs, apiname))
+            try:
+                arguments = decode(self.handler.read)
+            except IncompleteMessage:
+                raise
+            except:
+                log.exception("Exception in netlog protocol, "
+                              "stopping parser.")
+                return False
 
             self.handler.log_call(context, apiname, modulename, arguments)
 
@@ -158,7 +409,7 @@ class NetlogParser(object):
 
     def read_int32(self):
         """Reads a 32bit integer from the socket."""
-        return struct.unpack("I", self.handler.read(4))[0]
+        return netlog_read_int32(self.handler.read)
 
     def read_ptr(self):
         """Read a pointer from the socket."""
@@ -167,21 +418,11 @@ class NetlogParser(object):
 
     def read_string(self):
         """Reads an utf8 string from the socket."""
-        length, maxlength = struct.unpack("II", self.handler.read(8))
-        if length < 0 or length > 0x10000:
-            log.critical("read_string length weirdness "
-                         "length: %d maxlength: %d", length, maxlength)
-            raise CuckooResultError("read_string length failure, "
-                                    "protocol broken?")
-
-        s = self.handler.read(length)
-        if maxlength > length:
-            s += "... (truncated)"
-        return s
+        return netlog_read_string(self.handler.read)
 
     def read_buffer(self):
         """Reads a memory socket from the socket."""
-        length, maxlength = struct.unpack("II", self.handler.read(8))
+        length, maxlength = NETLOG_STRING.unpack(self.handler.read(8))
         # Only return the maxlength, as we don't log the actual
         # buffer right now.
         buf = self.handler.read(length)
@@ -191,27 +432,10 @@ class NetlogParser(object):
 
     def read_registry(self):
         """Read logged registry data from the socket."""
-        typ = struct.unpack("I", self.handler.read(4))[0]
-        # Do something depending on type.
-        if typ == REG_DWORD_BIG_ENDIAN or typ == REG_DWORD_LITTLE_ENDIAN:
-            value = self.read_int32()
-        elif typ == REG_SZ or typ == REG_EXPAND_SZ:
-            value = self.read_string()
-        else:
-            value = "(unable to dump buffer content)"
-        return value
-
-    def read_list(self, fn):
-        """Reads a list of _fn_ from the socket."""
-        count = struct.unpack("I", self.handler.read(4))[0]
-        ret = []
-        for x in xrange(count):
-            item = fn()
-            ret.append(item)
-        return ret
+        return netlog_read_registry(self.handler.read)
 
     def read_argv(self):
-        return self.read_list(self.read_string)
+        return netlog_read_argv(self.handler.read)
 
 
 ###############################################################################
@@ -226,6 +450,25 @@ TYPECONVERTERS = {
 
 # 1 Mb max message length.
 MAX_MESSAGE_LENGTH = 20 * 1024 * 1024
+# Maximum number of messages framed and decoded at once.
+BSON_BATCH_SIZE = 1024
+BSON_LENGTH = struct.Struct("=I")
+
+def bson_decode_batch(data):
+    """Decode a sequence of BSON documents.
+    @param data: the documents, one after the other.
+    @raise Exception: if a document can't be decoded.
+    @return: list of documents.
+    """
+    if bson_decode_all:
+        return bson_decode_all(data)
+
+    docs, offset = [], 0
+    while offset < len(data):
+        blen = BSON_LENGTH.unpack_from(data, offset)[0]
+        docs.append(bson_decode(data[offset:offset+blen]))
+        offset += blen
+    return docs
 
 def default_converter(v):
     # Fix signed ints (bson is kind of limited there).
@@ -252,9 +495,19 @@ def check_names_for_typeinfo(arginfo):
 
 
 class BsonParser(object):
+    """BSON protocol parser.
+
+    When the handler reads through a ReadBuffer, all the complete messages
+    available in it are framed and decoded at once, and then handled one
+    per read_next_message() call.
+    """
+
     def __init__(self, handler):
         self.handler = handler
         self.infomap = {}
+        # Messages decoded but not handled yet, None if the decoding of the
+        # next message failed.
+        self.batch = deque()
 
         if not HAVE_BSON:
             log.critical("Starting BsonParser, but bson is not available! (install with `pip install bson`)")
@@ -262,21 +515,72 @@ class BsonParser(object):
     def close(self):
         pass
 
-    def read_next_message(self):
+    def frame(self, buf):
+        """Find the complete messages at the start of a read buffer.
+        @param buf: ReadBuffer instance.
+        @return: their total length.
+        """
+        offset, count = buf.pos, 0
+        while buf.end - offset >= 4 and count < BSON_BATCH_SIZE:
+            blen = BSON_LENGTH.unpack_from(buf.buf, offset)[0]
+            if blen < 5 or blen > MAX_MESSAGE_LENGTH or \
+                    buf.end - offset < blen:
+                break
+            offset += blen
+            count += 1
+        return offset - buf.pos
+
+    def decode(self, data):
+        """Decode messages and queue them to be handled."""
+        try:
+            self.batch.extend(bson_decode_batch(data))
+            return
+        except Exception:
+            pass
+
+        # Decode them one by one to handle the valid ones before the one
+        # which can't be decoded.
+        offset = 0
+        while offset < len(data):
+            blen = BSON_LENGTH.unpack_from(data, offset)[0]
+            msg = data[offset:offset+blen]
+            try:
+                self.batch.append(bson_decode(msg))
+            except Exception as e:
+                log.warning("BsonParser decoding problem {0} on "
+                            "data[:50] {1}".format(e, repr(msg[:50])))
+                self.batch.append(None)
+                return
+            offset += blen
+
+    def read_batch(self):
+        """Read and decode the next messages.
+        @return: False if they can't be read.
+        """
+        buf = getattr(self.handler, "buffer", None)
+        length = self.frame(buf) if buf else 0
+        if length:
+            self.decode(buf.read(length))
+            return True
+
+        # No complete message available, wait for the next one.
         data = self.handler.read(4)
-        blen = struct.unpack("I", data)[0]
+        blen = BSON_LENGTH.unpack(data)[0]
         if blen > MAX_MESSAGE_LENGTH:
             log.critical("BSON message larger than MAX_MESSAGE_LENGTH, "
                          "stopping handler.")
             return False
 
         data += self.handler.read(blen-4)
+        self.decode(data)
+        return True
 
-        try:
-            dec = bson_decode(data)
-        except Exception as e:
-            log.warning("BsonParser decoding problem {0} on "
-                        "data[:50] {1}".format(e, repr(data[:50])))
+    def read_next_message(self):
+        if not self.batch and not self.read_batch():
+            return False
+
+        dec = self.batch.popleft()
+        if dec is None:
             return False
 
         mtype = dec.get("type", "none")
@@ -303,7 +607,8 @@ class BsonParser(object):
                 category = category[0][1] if category else "unknown"
 
             argnames, converters = check_names_for_typeinfo(arginfo)
-            self.infomap[index] = name, arginfo, argnames, converters, category
+            self.infomap[index] = (name, arginfo, tuple(argnames),
+                                   tuple(converters), category)
 
         elif mtype == "debug":
             log.info("Debug message from monitor: "
@@ -335,8 +640,8 @@ class BsonParser(object):
                                                            apiname))
                 return True
 
-            argdict = dict((argnames[i], converters[i](args[i]))
-                           for i in range(len(args)))
+            argdict = dict(zip(argnames, [convert(arg) for convert, arg
+                                          in zip(converters, args)]))
 
             if apiname == "__process__":
                 # Special new process message from cuckoomon.
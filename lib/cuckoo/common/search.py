@@ -0,0 +1,192 @@
+# Copyright (C) 2010-2014 Cuckoo Foundation.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import re
+
+# Maximum number of analyses returned by a search.
+MAX_RESULTS = 200
+
+# Default maximum number of values of a field made searchable per analysis,
+# and maximum length of the values, so that the search documents stay
+# bounded. The reports whose search document is truncated are also searched
+# through the reports themselves.
+MAX_VALUES = 1000
+MAX_LENGTH = 512
+
+# Length of the substrings indexed for substring searches. It's also the
+# minimum length of a search value.
+NGRAM = 3
+
+def _target_file(key):
+    def extract(report):
+        return [report.get("target", {}).get("file", {}).get(key)]
+    return extract
+
+def _summary(key):
+    def extract(report):
+        return report.get("behavior", {}).get("summary", {}).get(key, [])
+    return extract
+
+# Fields searchable by substring, prefix, suffix and token, along with the
+# function extracting their values from a report.
+FIELDS = {
+    "name": _target_file("name"),
+    "type": _target_file("type"),
+    "ssdeep": _target_file("ssdeep"),
+    "string": lambda report: report.get("strings", []),
+    "file": _summary("files"),
+    "key": _summary("keys"),
+    "mutex": _summary("mutexes"),
+    "domain": lambda report: [entry["domain"] for entry in
+                              report.get("network", {}).get("domains", [])],
+    "signature": lambda report: [sig["description"] for sig in
+                                 report.get("signatures", [])],
+}
+
+# Fields of the reports holding the values of each searchable field.
+REPORT_FIELDS = {
+    "name": "target.file.name",
+    "type": "target.file.type",
+    "ssdeep": "target.file.ssdeep",
+    "string": "strings",
+    "file": "behavior.summary.files",
+    "key": "behavior.summary.keys",
+    "mutex": "behavior.summary.mutexes",
+    "domain": "network.domains.domain",
+    "signature": "signatures.description",
+}
+
+def normalize(value):
+    """@return: lowercase value."""
+    if not isinstance(value, unicode):
+        value = str(value).decode("latin-1")
+    return value.lower()
+
+def tokenize(value):
+    """@return: words of a normalized value."""
+    return re.findall(r"\w+", value, re.UNICODE)
+
+def ngrams(value):
+    """@return: substrings of NGRAM characters of a normalized value."""
+    return [value[i:i+NGRAM] for i in xrange(len(value) - NGRAM + 1)]
+
+def search_document(report, max_values=MAX_VALUES, max_length=MAX_LENGTH):
+    """Build the search fields of a report.
+    @param report: analysis results dictionary.
+    @param max_values: maximum number of values of a field, 0 for no limit.
+    @param max_length: maximum length of a value, 0 for no limit.
+    @return: dict with, for each searchable field, its normalized values,
+    the reversed values for suffix searches, their words and their
+    substrings for substring searches, and whether values were left out or
+    shortened.
+    """
+    document = {"truncated": False}
+    for name, extract in FIELDS.iteritems():
+        values, seen = [], set()
+        for value in extract(report):
+            if not value:
+                continue
+            if max_values and len(values) == max_values:
+                document["truncated"] = True
+                break
+            value = normalize(value)
+            if max_length and len(value) > max_length:
+                value = value[:max_length]
+                document["truncated"] = True
+            if value not in seen:
+                seen.add(value)
+                values.append(value)
+
+        tokens, grams = set(), set()
+        for value in values:
+            tokens.update(tokenize(value))
+            grams.update(ngrams(value))
+
+        document[name] = values
+        document[name + "_rev"] = [value[::-1] for value in values]
+        document[name + "_tokens"] = sorted(tokens)
+        document[name + "_ngrams"] = sorted(grams)
+    return document
+
+def search_indexes():
+    """@return: names of the fields of the search documents to index."""
+    return [name + suffix for name in sorted(FIELDS)
+            for suffix in ("", "_rev", "_tokens", "_ngrams")] + ["truncated"]
+
+def parse_value(value):
+    """Parse a searched value.
+    @param value: searched value.
+    @return: tuple of the words if whole words are searched, None otherwise,
+    whether the value is a prefix, a suffix, and the normalized value.
+    @raise ValueError: if the value is too short.
+    """
+    if len(value) > 2 and value.startswith("\"") and value.endswith("\""):
+        tokens = tokenize(normalize(value[1:-1]))
+        if not tokens:
+            raise ValueError("Search term too short")
+        return tokens, False, False, None
+
+    prefix = value.startswith("^")
+    suffix = value.endswith("$")
+    value = normalize(value[prefix:len(value)-suffix])
+    if len(value) < NGRAM:
+        raise ValueError("Search term too short, minimum %d characters "
+                         "required" % NGRAM)
+    return None, prefix, suffix, value
+
+def search_query(name, value):
+    """Build the query of the search documents matching a value.
+    A value is searched as a substring, "^value" as a prefix, "value$" as a
+    suffix and "\\"value\\"" as a whole word.
+    @param name: field name.
+    @param value: searched value.
+    @return: query dict.
+    @raise ValueError: if the field is unknown or the value too short.
+    """
+    if name not in FIELDS:
+        raise ValueError("Invalid search term: %s" % name)
+
+    tokens, prefix, suffix, value = parse_value(value)
+    if tokens:
+        return {name + "_tokens": {"$all": tokens}}
+
+    # Anchored regular expressions are resolved through the index.
+    if prefix and suffix:
+        return {name: value}
+    if prefix:
+        return {name: {"$regex": "^" + re.escape(value)}}
+    if suffix:
+        return {name + "_rev": {"$regex": "^" + re.escape(value[::-1])}}
+
+    # The substrings narrow the candidates down through the index, the
+    # regular expression then only runs on these.
+    return {
+        name + "_ngrams": {"$all": sorted(set(ngrams(value)))},
+        name: {"$regex": re.escape(value)},
+    }
+
+def report_query(name, value):
+    """Build the query of the reports matching a value, as search_query()
+    does on the search documents, for the reports whose search document is
+    truncated. It runs regular expressions on the reports, without index.
+    @param name: field name.
+    @param value: searched value.
+    @return: query dict.
+    @raise ValueError: if the field is unknown or the value too short.
+    """
+    if name not in REPORT_FIELDS:
+        raise ValueError("Invalid search term: %s" % name)
+
+    field = REPORT_FIELDS[name]
+    tokens, prefix, suffix, value = parse_value(value)
+    if tokens:
+        return {"$and": [{field: {"$regex": r"\b%s\b" % re.escape(token),
+                                  "$options": "i"}} for token in tokens]}
+
+    regex = re.escape(value)
+    if prefix:
+        regex = "^" + regex
+    if suffix:
+        regex += "$"
+    return {field: {"$regex": regex, "$options": "i"}}
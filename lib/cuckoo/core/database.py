@@ -4,7 +4,9 @@
 
 import os
 import json
+import time
 import logging
+import threading
 from datetime import datetime, timedelta
 
 from lib.cuckoo.common.config import Config
@@ -16,14 +18,14 @@ from lib.cuckoo.common.objects import File, URL
 from lib.cuckoo.common.utils import create_folder, Singleton, time_duration
 
 try:
-    from sqlalchemy import create_engine, Column, or_
+    from sqlalchemy import create_engine, event, func, Column, or_, exists
     from sqlalchemy import Integer, String, Boolean, DateTime, Enum
     from sqlalchemy import ForeignKey, Text, Index, Table
     from sqlalchemy.ext.declarative import declarative_base
     from sqlalchemy.exc import SQLAlchemyError, IntegrityError
     from sqlalchemy.orm import sessionmaker, relationship, joinedload, backref, aliased
     from sqlalchemy.orm.session import make_transient
-    from sqlalchemy.pool import NullPool
+    from sqlalchemy.pool import NullPool, QueuePool
     Base = declarative_base()
 except ImportError:
     raise CuckooDependencyError("Unable to import sqlalchemy "
@@ -33,7 +35,7 @@ log = logging.getLogger(__name__)
 
 null = None
 
-SCHEMA_VERSION = "5adbab2b7915"
+SCHEMA_VERSION = "3aa42d870199"
 TASK_PENDING = "pending"
 TASK_RUNNING = "running"
 TASK_COMPLETED = "completed"
@@ -307,6 +309,11 @@ class Task(Base):
                     nullable=False)
     sample_id = Column(Integer, ForeignKey("samples.id"), nullable=True)
     experiment_id = Column(Integer, ForeignKey("experiments.id"), nullable=False)
+    __table_args__ = (
+        Index("tasks_status_added_on_priority_index",
+              "status", "added_on", "priority"),
+        Index("tasks_experiment_id_status_index", "experiment_id", "status"),
+    )
 
     sample = relationship("Sample", backref="tasks")
     experiment = relationship("Experiment", backref=backref("tasks", lazy="dynamic"), lazy="joined")
@@ -356,12 +363,36 @@ class Database(object):
     """
     __metaclass__ = Singleton
 
+    # Seconds the configuration snapshot is trusted for, so that the changes
+    # made by other processes (web interface, utils) are eventually seen.
+    CONFIG_TTL = 10
+
+    # Candidate tasks looked at per task to claim, some of them might be
+    # taken by a concurrent claimer or not fit on any available machine.
+    CLAIM_WINDOW = 4
+
     def __init__(self, dsn=None, schema_check=True):
         """@param dsn: database connection string.
         @param schema_check: disable or enable the db schema version check
         """
         self.cfg = Config()
 
+        # In-memory snapshot of the configuration table. It's reloaded when
+        # config_set() bumps the generation counter or when it's older than
+        # CONFIG_TTL seconds.
+        self._config_lock = threading.Lock()
+        self._config_cache = None
+        self._config_cache_generation = None
+        self._config_cache_time = 0
+        self._config_generation = 0
+
+        # Signalled whenever something happens that may allow the scheduler
+        # to start a new analysis (new task, machine released, etc.).
+        self._wakeup = threading.Event()
+
+        # Engines inherited from the parent process, see reconnect().
+        self._inherited_engines = []
+
         if dsn:
             self._connect_database(dsn)
         elif self.cfg.database.connection:
@@ -425,14 +456,77 @@ class Database(object):
         """Connect to a Database.
         @param connection_string: Connection string specifying the database
         """
+        # SQLite doesn't benefit from a connection pool, moreover sharing
+        # SQLite connections between threads is asking for trouble.
+        if connection_string.startswith("sqlite"):
+            kwargs = dict(poolclass=NullPool)
+        else:
+            kwargs = dict(
+                poolclass=QueuePool,
+                pool_size=self.cfg.database.pool_size or 10,
+                max_overflow=self.cfg.database.max_overflow or 20,
+                pool_recycle=self.cfg.database.pool_recycle or 3600,
+                pool_timeout=self.cfg.database.timeout or 60,
+                pool_pre_ping=True,
+            )
+
+        self._connection_string = connection_string
         try:
-            self.engine = create_engine(connection_string, poolclass=NullPool)
+            self.engine = create_engine(connection_string, **kwargs)
         except ImportError as e:
             lib = e.message.split()[-1]
             raise CuckooDependencyError("Missing database driver, unable to "
                                         "import %s (install with `pip "
                                         "install %s`)" % (lib, lib))
 
+        # The pool events fire from every thread using the database.
+        self._pool_stats = dict(connects=0, checkouts=0, checkins=0)
+        self._pool_stats_lock = threading.Lock()
+
+        def count(name):
+            with self._pool_stats_lock:
+                self._pool_stats[name] += 1
+
+        def on_connect(dbapi_connection, connection_record):
+            count("connects")
+
+        def on_checkout(dbapi_connection, connection_record, connection_proxy):
+            count("checkouts")
+
+        def on_checkin(dbapi_connection, connection_record):
+            count("checkins")
+
+        event.listen(self.engine, "connect", on_connect)
+        event.listen(self.engine, "checkout", on_checkout)
+        event.listen(self.engine, "checkin", on_checkin)
+
+    def reconnect(self):
+        """Connect through a new engine, to be called by a process forked
+        after the database has been used. The engine inherited from the
+        parent process is kept as is, disposing of it would close the
+        connections the parent process still uses."""
+        self._inherited_engines.append(self.engine)
+        self._connect_database(self._connection_string)
+        self.engine.echo = False
+        self.Session.configure(bind=self.engine)
+
+    def pool_status(self):
+        """Returns usage counters of the database connection pool.
+        @return: dict with pool statistics
+        """
+        pool = self.engine.pool
+        with self._pool_stats_lock:
+            ret = dict(self._pool_stats)
+        ret["class"] = pool.__class__.__name__
+
+        if isinstance(pool, QueuePool):
+            ret["size"] = pool.size()
+            ret["checked_in"] = pool.checkedin()
+            ret["checked_out"] = pool.checkedout()
+            ret["overflow"] = pool.overflow()
+
+        return ret
+
     def _get_or_create(self, session, model, **kwargs):
         """Get an ORM instance or create it if not exist.
         @param session: SQLAlchemy session object
@@ -442,6 +536,20 @@ class Database(object):
         instance = session.query(model).filter_by(**kwargs).first()
         return instance or model(**kwargs)
 
+    def notify(self):
+        """Wake up the scheduler, something happened that may allow a new
+        analysis to be started."""
+        self._wakeup.set()
+
+    def wait_for_work(self, timeout=None):
+        """Wait until notify() is called or the timeout expires.
+        @param timeout: timeout in seconds, None to wait forever
+        @return: True if notified, False on timeout
+        """
+        notified = self._wakeup.wait(timeout)
+        self._wakeup.clear()
+        return notified
+
     def _config_unserialize(self, type_, value):
         """Convert the value to its original type.
         @param type_: type
@@ -458,24 +566,49 @@ class Database(object):
 
         return types[type_](value)
 
+    def _config_fresh(self, generation):
+        """@return: whether the configuration snapshot can be used."""
+        return self._config_cache is not None and \
+            self._config_cache_generation == generation and \
+            time.time() - self._config_cache_time < self.CONFIG_TTL
+
+    def _config_snapshot(self):
+        """Return the in-memory snapshot of the configuration table,
+        reloading it if it has been invalidated by config_set() or if it
+        has expired.
+        @return: dict of configuration entries
+        """
+        cache = self._config_cache
+        if self._config_fresh(self._config_generation):
+            return cache
+
+        with self._config_lock:
+            generation = self._config_generation
+            if self._config_fresh(generation):
+                return self._config_cache
+
+            entries = self.config_all()
+            # Don't cache the result of a failed query, retry next time.
+            if not isinstance(entries, dict):
+                return {}
+
+            self._config_cache = entries
+            self._config_cache_generation = generation
+            self._config_cache_time = time.time()
+            return entries
+
+    def config_refresh(self):
+        """Invalidate the configuration snapshot, forcing a reload from the
+        database on the next read, without waiting for it to expire."""
+        with self._config_lock:
+            self._config_generation += 1
+
     def config_get(self, key):
         """Get the value of a configuration entry.
         @param key: key of the configuration entry
         @return: value of the configuration entry
         """
-        session = self.Session()
-        try:
-            row = session.query(Configuration).filter_by(key=key).first()
-        except SQLAlchemyError as e:
-            log.debug("Configuration value not set (%s): {0}".format(key, e))
-            return None
-        finally:
-            session.close()
-
-        if row:
-            return self._config_unserialize(row.type_, row.value)
-
-        return None
+        return self._config_snapshot().get(key)
 
     def config_all(self):
         """Return all configuration entries from the database."""
@@ -512,6 +645,8 @@ class Database(object):
             return None
         finally:
             session.close()
+
+        self.config_refresh()
         return value
 
     def clean_machines(self):
@@ -598,32 +733,39 @@ class Database(object):
         finally:
             session.close()
 
+    def _fetch_query(self, session, status):
+        """Build the query returning the identifiers of the tasks ready to
+        be run, ordered by priority and submission time.
+        @param session: SQLAlchemy session object
+        @param status: status of the tasks to look for
+        @return: query object
+        """
+        # Tasks of an experiment which already has a running task are
+        # left alone, an experiment only runs one task at a time.
+        running = aliased(Task)
+        busy = exists().where(running.experiment_id == Task.experiment_id)
+        busy = busy.where(running.status == TASK_RUNNING)
+
+        q = session.query(Task.id)
+        q = q.filter(Task.status == status)
+        q = q.filter(Task.added_on <= datetime.now())
+        q = q.filter(~busy)
+        return q.order_by(Task.priority.desc(), Task.added_on)
+
     def fetch(self, lock=True, status=TASK_PENDING):
         """Fetches a task waiting to be processed and locks it for running.
         @return: None or task
         """
+        if lock:
+            return self.claim_task(status=status)
+
         session = self.Session()
         row = None
 
         try:
-            task1, task2 = aliased(Task), aliased(Task)
-
-            q = session.query(task1.experiment_id)
-            q = q.filter(task1.id != task2.id)
-            q = q.filter(task1.experiment_id == task2.experiment_id)
-            q = q.filter(task2.status == TASK_RUNNING)
-
-            row = session.query(Task)
-            row = row.filter(Task.status == status)
-            row = row.filter(Task.added_on <= datetime.now())
-            row = row.filter(~Task.experiment_id.in_(q))
-            row = row.order_by("priority desc, tasks.added_on").first()
-            if not row:
-                return None
-
-            if lock:
-                self.set_status(task_id=row.id, status=TASK_RUNNING)
-                session.refresh(row)
+            task_id = self._fetch_query(session, status).first()
+            if task_id:
+                row = session.query(Task).get(task_id[0])
         except SQLAlchemyError as e:
             log.debug("Database error fetching task: {0}".format(e))
             session.rollback()
@@ -632,6 +774,199 @@ class Database(object):
 
         return row
 
+    def _mark_running(self, session, task_id, status):
+        """Mark a task as running, provided it still has the given status.
+        @param session: SQLAlchemy session object
+        @param task_id: task identifier
+        @param status: status the task is expected to have
+        @return: True if the task has been marked as running
+        """
+        q = session.query(Task).filter_by(id=task_id, status=status)
+        updated = q.update({"status": TASK_RUNNING,
+                            "started_on": datetime.now()},
+                           synchronize_session=False)
+        return updated > 0
+
+    def _claim(self, session, task_id, experiment_id, status):
+        """Mark a task as running, unless a concurrent claimer got a task of
+        the same experiment first.
+        @param session: SQLAlchemy session object
+        @param task_id: task identifier
+        @param experiment_id: experiment the task belongs to
+        @param status: status the task is expected to have
+        @return: True if the task has been marked as running
+        """
+        if self.engine.name != "sqlite":
+            # SKIP LOCKED keeps the claimers off each other's task rows
+            # only, two tasks of the same experiment could still be claimed
+            # at once. The experiment row is locked as well.
+            q = session.query(Experiment.id).filter_by(id=experiment_id)
+            if q.with_for_update(skip_locked=True).first() is None:
+                return False
+
+            # The claim of another task of the experiment may have been
+            # committed since the candidates were selected.
+            q = session.query(Task.id).filter_by(experiment_id=experiment_id,
+                                                 status=TASK_RUNNING)
+            if q.first() is not None:
+                return False
+
+        return self._mark_running(session, task_id, status)
+
+    def claim_task(self, status=TASK_PENDING):
+        """Atomically fetches a task waiting to be processed and marks it
+        as running, so that concurrent schedulers never get the same task.
+
+        On PostgreSQL and MySQL the candidate rows and the experiment of the
+        claimed task are locked with SELECT ... FOR UPDATE SKIP LOCKED. On
+        SQLite the status change is guarded by the status the task had when
+        it was selected, which doesn't prevent two concurrent claimers from
+        getting two tasks of the same experiment: a single scheduler is
+        expected to claim tasks from a SQLite database.
+
+        @param status: status of the tasks to look for
+        @return: None or task
+        """
+        session = self.Session()
+        row = None
+
+        try:
+            q = self._fetch_query(session, status)
+            q = q.add_columns(Task.experiment_id)
+            q = q.limit(self.CLAIM_WINDOW)
+
+            if self.engine.name != "sqlite":
+                q = q.with_for_update(skip_locked=True)
+
+            task_id = None
+            # Move on to the next candidate when another claimer steals the
+            # task between the select and the update.
+            for candidate, experiment_id in q.all():
+                if self._claim(session, candidate, experiment_id, status):
+                    task_id = candidate
+                    break
+
+            session.commit()
+
+            if task_id:
+                row = session.query(Task).get(task_id)
+        except SQLAlchemyError as e:
+            log.debug("Database error claiming task: {0}".format(e))
+            session.rollback()
+        finally:
+            session.close()
+
+        return row
+
+    def _match_machine(self, machines, name, platform, tags, experiment_id):
+        """Find a machine satisfying the requirements of a task.
+        @param machines: list of candidate machines
+        @param name: required machine name, if any
+        @param platform: required platform, if any
+        @param tags: set of required tag names
+        @param experiment_id: experiment the task belongs to
+        @return: matching machine or None
+        """
+        match = None
+        for machine in machines:
+            if machine.locked_by not in (None, experiment_id):
+                continue
+            if name and machine.name != name:
+                continue
+            if platform and machine.platform != platform:
+                continue
+            if not tags.issubset(tag.name for tag in machine.tags):
+                continue
+
+            # The machine reserved by the experiment of the task goes first,
+            # the free ones remain available to the other experiments.
+            if machine.locked_by is not None:
+                return machine
+            if match is None:
+                match = machine
+        return match
+
+    def claim_tasks(self, machines, status=TASK_PENDING, limit=None):
+        """Atomically fetches and marks as running as many tasks as can be
+        run on the given machines, in a single transaction.
+
+        Each machine is assigned to at most one task, taking into account
+        the machine name, platform and tags requested by the task, and no
+        more than one task per experiment is claimed. Concurrent claimers
+        are dealt with as in claim_task().
+
+        @param machines: list of available machines
+        @param status: status of the tasks to look for
+        @param limit: maximum number of tasks to claim
+        @return: list of tasks
+        """
+        if limit is None or limit > len(machines):
+            limit = len(machines)
+
+        if limit <= 0:
+            return []
+
+        # Machines with fewer tags go first, keeping the tagged ones for the
+        # tasks which require them.
+        machines = sorted(machines, key=lambda m: (len(m.tags), m.id))
+
+        session = self.Session()
+        tasks = []
+
+        try:
+            q = self._fetch_query(session, status)
+            q = q.add_columns(Task.machine, Task.platform, Task.experiment_id)
+            # Look a bit further than needed, some of the tasks might not
+            # fit on any of the available machines.
+            q = q.limit(limit * self.CLAIM_WINDOW)
+
+            if self.engine.name != "sqlite":
+                q = q.with_for_update(skip_locked=True)
+
+            candidates = q.all()
+
+            tags = {}
+            if candidates:
+                tq = session.query(tasks_tags.c.task_id, Tag.name)
+                tq = tq.join(Tag, Tag.id == tasks_tags.c.tag_id)
+                tq = tq.filter(tasks_tags.c.task_id.in_([c[0] for c in candidates]))
+                for task_id, name in tq:
+                    tags.setdefault(task_id, set()).add(name)
+
+            claimed, experiments = [], set()
+            for task_id, name, platform, experiment_id in candidates:
+                if len(claimed) >= limit:
+                    break
+
+                if experiment_id in experiments:
+                    continue
+
+                machine = self._match_machine(machines, name, platform,
+                                              tags.get(task_id, set()),
+                                              experiment_id)
+                if not machine:
+                    continue
+
+                if self._claim(session, task_id, experiment_id, status):
+                    machines.remove(machine)
+                    experiments.add(experiment_id)
+                    claimed.append(task_id)
+
+            session.commit()
+
+            if claimed:
+                rows = session.query(Task).filter(Task.id.in_(claimed)).all()
+                rows = dict((row.id, row) for row in rows)
+                tasks = [rows[task_id] for task_id in claimed]
+        except SQLAlchemyError as e:
+            log.debug("Database error claiming tasks: {0}".format(e))
+            session.rollback()
+            return []
+        finally:
+            session.close()
+
+        return tasks
+
     def guest_start(self, task_id, name, label, manager):
         """Logs guest start.
         @param task_id: task identifier
@@ -781,6 +1116,37 @@ class Database(object):
 
         return machine
 
+    def try_lock_machine(self, name, locked_by):
+        """Lock a virtual machine on behalf of an experiment, unless another
+        experiment has locked it. It's done in a single statement, so that
+        two processes can't lock the same machine.
+        @param name: virtual machine name
+        @param locked_by: experiment id
+        @return: True if locked, False otherwise
+        """
+        session = self.Session()
+        try:
+            q = session.query(Machine).filter_by(name=name)
+            q = q.filter(or_(Machine.locked_by == null,
+                             Machine.locked_by == locked_by))
+            locked = q.update({"locked_by": locked_by},
+                              synchronize_session=False) == 1
+
+            # Update the experiment to reflect the machine name.
+            if locked and locked_by is not None:
+                session.query(Experiment).filter_by(id=locked_by)\
+                    .update({"machine_name": name}, synchronize_session=False)
+
+            session.commit()
+        except SQLAlchemyError as e:
+            log.debug("Database error locking machine: {0}".format(e))
+            session.rollback()
+            return False
+        finally:
+            session.close()
+
+        return locked
+
     def unlock_machine(self, label):
         """Remove lock form a virtual machine.
         @param label: virtual machine label
@@ -806,6 +1172,8 @@ class Database(object):
             finally:
                 session.close()
 
+            self.notify()
+
         return machine
 
     def unlock_machine_by_experiment(self, experiment):
@@ -833,6 +1201,8 @@ class Database(object):
             finally:
                 session.close()
 
+            self.notify()
+
         return machine
 
     def count_machines_available(self, locked_by=None):
@@ -1012,6 +1382,7 @@ class Database(object):
         finally:
             session.close()
 
+        self.notify()
         return task_id
 
     def add_path(self, file_path, timeout=0, package="", options="",
@@ -1087,6 +1458,7 @@ class Database(object):
             session.commit()
 
         session.close()
+        self.notify()
 
     def reschedule(self, task_id):
         """Reschedule a task.
@@ -1159,6 +1531,8 @@ class Database(object):
         finally:
             session.close()
 
+        # Let the scheduler know about the new due time.
+        self.notify()
         return task
 
     def list_experiments(self, limit=None, details=False, category=None,
@@ -1219,6 +1593,26 @@ class Database(object):
             session.close()
         return tasks
 
+    def list_completed(self, limit=None, exclude=()):
+        """Retrieve the analyses waiting to be processed, oldest first.
+        @param limit: specify a limit of entries.
+        @param exclude: IDs of the tasks to leave out.
+        @return: list of tasks.
+        """
+        session = self.Session()
+        try:
+            search = session.query(Task).filter_by(status=TASK_COMPLETED)
+            if exclude:
+                search = search.filter(~Task.id.in_(exclude))
+
+            tasks = search.order_by(Task.completed_on).limit(limit).all()
+        except SQLAlchemyError as e:
+            log.debug("Database error listing completed tasks: {0}".format(e))
+            return []
+        finally:
+            session.close()
+        return tasks
+
     def count_tasks(self, status=None):
         """Count tasks in the database
         @param status: apply a filter according to the task status
@@ -1237,6 +1631,36 @@ class Database(object):
             session.close()
         return tasks_count
 
+    def last_task_id(self):
+        """Identifier of the most recently added task.
+        @return: task id or None
+        """
+        session = self.Session()
+        try:
+            task_id = session.query(func.max(Task.id)).scalar()
+        except SQLAlchemyError as e:
+            log.debug("Database error getting last task: {0}".format(e))
+            return None
+        finally:
+            session.close()
+        return task_id
+
+    def next_task_due(self):
+        """When the next pending or scheduled task becomes due.
+        @return: datetime or None if no task is waiting for its time
+        """
+        session = self.Session()
+        try:
+            q = session.query(func.min(Task.added_on))
+            q = q.filter(Task.status.in_((TASK_PENDING, TASK_SCHEDULED)))
+            due = q.filter(Task.added_on > datetime.now()).scalar()
+        except SQLAlchemyError as e:
+            log.debug("Database error getting next due task: {0}".format(e))
+            return None
+        finally:
+            session.close()
+        return due
+
     def view_task(self, task_id, details=False):
         """Retrieve information on a task.
         @param task_id: ID of the task to query.
@@ -1258,6 +1682,34 @@ class Database(object):
             session.close()
         return task
 
+    def view_tasks(self, task_ids):
+        """Retrieve information on many tasks along with their samples,
+        in a single query.
+        @param task_ids: IDs of the tasks to query.
+        @return: list of tasks, in the order of the IDs, skipping the
+        missing ones.
+        """
+        if not task_ids:
+            return []
+
+        session = self.Session()
+        try:
+            tasks = session.query(Task).options(joinedload("sample"))\
+                .filter(Task.id.in_(task_ids)).all()
+        except SQLAlchemyError as e:
+            log.debug("Database error viewing tasks: {0}".format(e))
+            return []
+        else:
+            for task in tasks:
+                if task.sample:
+                    session.expunge(task.sample)
+                session.expunge(task)
+        finally:
+            session.close()
+
+        tasks = dict((task.id, task) for task in tasks)
+        return [tasks[task_id] for task_id in task_ids if task_id in tasks]
+
     def delete_task(self, task_id):
         """Delete information on a task.
         @param task_id: ID of the task to query.
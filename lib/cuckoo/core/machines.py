@@ -0,0 +1,256 @@
+# Copyright (C) 2010-2014 Cuckoo Foundation.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import time
+import Queue
+import logging
+import threading
+
+from lib.cuckoo.common.exceptions import CuckooOperationalError
+
+log = logging.getLogger(__name__)
+
+class MachineRegistry(object):
+    """In-memory mirror of the machines table.
+
+    Free machines are indexed by platform, tag and the experiment they are
+    locked by, so that looking for a machine doesn't require any database
+    query. Locks are taken in the database as well, as other processes may
+    lock machines too, while the other changes are written through to the
+    database by a background thread, in the order they have been made.
+    """
+
+    # Seconds between reloads of the machines table, to pick up changes
+    # made by other processes (e.g., an experiment deleted through the web
+    # interface).
+    SYNC_INTERVAL = 30
+
+    def __init__(self, db):
+        """@param db: Database instance."""
+        self.db = db
+        self.lock = threading.Lock()
+        # Label -> machine.
+        self.machines = {}
+        # Name -> label.
+        self.by_name = {}
+        # Platform -> set of labels.
+        self.by_platform = {}
+        # Tag name -> set of labels.
+        self.by_tag = {}
+        # Experiment id -> label.
+        self.by_experiment = {}
+        # Labels of the machines not locked by any experiment.
+        self.free = set()
+        # Label -> lock serializing the operations on that machine.
+        self.locks = {}
+        self.synced = 0
+        self.writes = Queue.Queue()
+        self.writer = None
+
+    def _index(self, machines):
+        """Rebuild the indexes.
+        @param machines: list of machines.
+        """
+        self.machines, self.by_name, self.by_experiment = {}, {}, {}
+        self.by_platform, self.by_tag, self.free = {}, {}, set()
+
+        for machine in machines:
+            self.machines[machine.label] = machine
+            self.by_name[machine.name] = machine.label
+            self.by_platform.setdefault(machine.platform, set()).add(machine.label)
+            for tag in machine.tags:
+                self.by_tag.setdefault(tag.name, set()).add(machine.label)
+
+            if machine.locked_by is None:
+                self.free.add(machine.label)
+            else:
+                self.by_experiment[machine.locked_by] = machine.label
+
+            self.locks.setdefault(machine.label, threading.Lock())
+
+        self.synced = time.time()
+
+    def load(self):
+        """Load the machines from the database and start the writer."""
+        with self.lock:
+            self._index(self.db.list_machines())
+
+        if not self.writer:
+            self.writer = threading.Thread(target=self._write_loop,
+                                           name="MachineRegistryWriter")
+            self.writer.daemon = True
+            self.writer.start()
+
+    def sync(self, force=False):
+        """Reload the machines table if it hasn't been in a while and if
+        all our changes have been written to the database.
+        @param force: reload even if it has been recently.
+        """
+        if not force and time.time() - self.synced < self.SYNC_INTERVAL:
+            return
+
+        with self.lock:
+            if self.writes.unfinished_tasks:
+                return
+
+            self._index(self.db.list_machines())
+
+    def _write_loop(self):
+        """Write the changes to the database."""
+        while True:
+            func, args = self.writes.get()
+            try:
+                func(*args)
+            except Exception as e:
+                log.error("Error writing machine changes to the "
+                          "database: %s", e)
+            finally:
+                self.writes.task_done()
+
+    def _write(self, func, *args):
+        """Queue a change to be written to the database."""
+        self.writes.put((func, args))
+
+    def flush(self):
+        """Wait until all the changes have been written to the database."""
+        self.writes.join()
+
+    def list(self):
+        """@return: all machines, ordered by id."""
+        with self.lock:
+            return sorted(self.machines.values(), key=lambda m: m.id)
+
+    def get(self, label):
+        """@return: the machine with the given label, or None."""
+        return self.machines.get(label)
+
+    def get_lock(self, label):
+        """@return: the lock serializing the operations on a machine."""
+        return self.locks[label]
+
+    def available(self, locked_by=None):
+        """@return: free machines, ordered by id."""
+        with self.lock:
+            labels = set(self.free)
+            if locked_by in self.by_experiment:
+                labels.add(self.by_experiment[locked_by])
+            return sorted((self.machines[l] for l in labels),
+                          key=lambda m: m.id)
+
+    def count_available(self, locked_by=None):
+        """@return: number of machines free or locked by the experiment."""
+        with self.lock:
+            count = len(self.free)
+            if locked_by is not None and locked_by in self.by_experiment:
+                count += 1
+            return count
+
+    def running(self):
+        """@return: machines which are running."""
+        with self.lock:
+            return [m for m in self.machines.values()
+                    if m.status == "running"]
+
+    def acquire(self, name=None, platform=None, tags=None, locked_by=None):
+        """Lock a machine satisfying the given requirements.
+        @param name: optional machine name.
+        @param platform: optional machine platform.
+        @param tags: optional list of required tags.
+        @param locked_by: experiment locking the machine.
+        @raise CuckooOperationalError: if no machine matches the requirements.
+        @return: locked machine or None if none is free.
+        """
+        with self.lock:
+            labels = set(self.machines)
+            if name:
+                labels &= set([self.by_name.get(name)])
+            if platform:
+                labels &= self.by_platform.get(platform, set())
+            for tag in tags or []:
+                labels &= self.by_tag.get(tag.name, set())
+
+            if not labels:
+                raise CuckooOperationalError("No machines match selection "
+                                             "criteria.")
+
+            # The machine already reserved by the experiment, otherwise the
+            # free ones.
+            label = self.by_experiment.get(locked_by)
+            if label is not None and label in labels:
+                candidates = [label]
+            else:
+                candidates = sorted(labels & self.free,
+                                    key=lambda l: self.machines[l].id)
+
+            # Our changes have to be written first, e.g., the unlock of a
+            # machine we're about to lock again.
+            self.flush()
+
+            for label in candidates:
+                machine = self.machines[label]
+                if self.db.try_lock_machine(machine.name, locked_by):
+                    break
+
+                # Another process has locked it since we last synced.
+                self._locked_elsewhere(label)
+            else:
+                return None
+
+            machine.locked_by = locked_by
+            self.free.discard(label)
+            if locked_by is not None:
+                self.by_experiment[locked_by] = label
+
+        return machine
+
+    def _locked_elsewhere(self, label):
+        """Mirror the lock taken by another process on a machine.
+        @param label: machine label.
+        """
+        row = self.db.view_machine_by_label(label)
+        locked_by = row.locked_by if row else None
+        log.debug("Machine %s has been locked by another process (%s)",
+                  label, locked_by)
+
+        machine = self.machines[label]
+        if self.by_experiment.get(machine.locked_by) == label:
+            del self.by_experiment[machine.locked_by]
+
+        machine.locked_by = locked_by
+        self.free.discard(label)
+        if locked_by is not None:
+            self.by_experiment[locked_by] = label
+
+    def release(self, label):
+        """Remove the lock from a machine.
+        @param label: machine label.
+        @return: unlocked machine.
+        """
+        with self.lock:
+            machine = self.machines.get(label)
+            if not machine:
+                return None
+
+            if self.by_experiment.get(machine.locked_by) == label:
+                del self.by_experiment[machine.locked_by]
+
+            machine.locked_by = None
+            self.free.add(label)
+
+            self._write(self.db.unlock_machine, label)
+
+        # Wake up the scheduler right away, not once written.
+        self.db.notify()
+        return machine
+
+    def set_status(self, label, status):
+        """Set the status of a machine.
+        @param label: machine label.
+        @param status: new status.
+        """
+        machine = self.machines.get(label)
+        if machine:
+            machine.status = status
+
+        self._write(self.db.set_machine_status, label, status)
@@ -4,6 +4,7 @@
 
 import os
 import json
+import time
 import pkgutil
 import inspect
 import logging
@@ -236,6 +237,124 @@ class RunProcessing(object):
         # Return the fat dict.
         return results
 
+class EventedSignatures(object):
+    """Streams the API calls to the evented signatures interested in them.
+
+    The filters of the signatures are indexed once, so that each call is only
+    handed to the signatures whose process name, API name and category
+    filters all accept it, and the CPU time spent in each signature is
+    accounted for.
+    """
+
+    # Order in which the filters are looked up in the index.
+    FILTERS = "filter_processnames", "filter_apinames", "filter_categories"
+
+    def __init__(self, signatures):
+        """@param signatures: evented signature instances, in running order."""
+        self.signatures = list(signatures)
+        self.active = set(xrange(len(self.signatures)))
+        self.routes = {}
+        self.timings = [0.0] * len(self.signatures)
+        self.calls = [0] * len(self.signatures)
+
+        # For each filter, the signatures accepting a given value and the
+        # signatures without the filter, which accept any value.
+        self.index = [defaultdict(set) for x in self.FILTERS]
+        self.wildcard = [set() for x in self.FILTERS]
+        for idx, sig in enumerate(self.signatures):
+            for pos, name in enumerate(self.FILTERS):
+                values = getattr(sig, name)
+                if not values:
+                    self.wildcard[pos].add(idx)
+                for value in values or ():
+                    self.index[pos][value].add(idx)
+
+    def __len__(self):
+        return len(self.active)
+
+    def route(self, process_name, api, category):
+        """Signatures interested in a call.
+        @param process_name: name of the process doing the call.
+        @param api: API name of the call.
+        @param category: category of the call.
+        @return: tuple of signature indexes, in running order.
+        """
+        key = process_name, api, category
+        route = self.routes.get(key)
+        if route is None:
+            interested = set(self.active)
+            for pos, value in enumerate(key):
+                interested &= self.index[pos].get(value, set()) | \
+                    self.wildcard[pos]
+            route = self.routes[key] = tuple(sorted(interested))
+        return route
+
+    def finish(self, idx):
+        """Stop streaming calls to a signature.
+        @param idx: signature index.
+        """
+        self.active.discard(idx)
+        self.routes.clear()
+
+    def run(self, idx, method, *args):
+        """Run a method of a signature and account for its CPU time.
+        @param idx: signature index.
+        @param method: name of the method.
+        @return: value returned by the method, False if it failed.
+        """
+        sig = self.signatures[idx]
+        start = time.clock()
+        try:
+            return getattr(sig, method)(*args)
+        except NotImplementedError:
+            return False
+        except:
+            log.exception("Failed to run %s() method of signature \"%s\":",
+                          method, sig.name)
+            return False
+        finally:
+            self.timings[idx] += time.clock() - start
+            self.calls[idx] += 1
+
+    def feed(self, proc, call):
+        """Hand a call to the interested signatures.
+        @param proc: process dict.
+        @param call: API call dict.
+        @return: signatures matched by the call.
+        """
+        matched = []
+        for idx in self.route(proc["process_name"], call["api"],
+                              call["category"]):
+            result = self.run(idx, "on_call", call, proc)
+
+            # If the signature returns None we can carry on, the
+            # condition was not matched.
+            if result is None:
+                continue
+
+            # Either True or False, we don't need to check this sig anymore.
+            if result is True:
+                matched.append(self.signatures[idx])
+            self.finish(idx)
+        return matched
+
+    def complete(self):
+        """Call the on_complete() method of the remaining signatures.
+        @return: signatures matched on completion.
+        """
+        matched = []
+        for idx in sorted(self.active):
+            if self.run(idx, "on_complete") is True:
+                matched.append(self.signatures[idx])
+            self.finish(idx)
+        return matched
+
+    def statistics(self):
+        """@return: CPU time and method calls of each signature."""
+        return [dict(name=sig.name, time=round(self.timings[idx], 3),
+                     calls=self.calls[idx])
+                for idx, sig in enumerate(self.signatures)]
+
 class RunSignatures(object):
     """Run Signatures."""
 
@@ -350,6 +469,8 @@ class RunSignatures(object):
     def run(self):
         # This will contain all the matched signatures.
         matched = []
+        # CPU time spent in each signature.
+        stats = []
 
         complete_list = list_plugins(group="signatures")
         evented_list = [sig(self.results)
@@ -370,59 +491,31 @@ class RunSignatures(object):
                 else:
                     log.debug("\t |-- %s", sig.name)
 
-            # Iterate calls and tell interested signatures about them
-            for proc in self.results["behavior"]["processes"]:
-                for call in proc["calls"]:
-                    # Loop through active evented signatures.
-                    for sig in evented_list:
-                        # Skip current call if it doesn't match the filters (if any).
-                        if sig.filter_processnames and not proc["process_name"] in sig.filter_processnames:
-                            continue
-                        if sig.filter_apinames and not call["api"] in sig.filter_apinames:
-                            continue
-                        if sig.filter_categories and not call["category"] in sig.filter_categories:
-                            continue
-
-                        result = None
-                        try:
-                            result = sig.on_call(call, proc)
-                        except NotImplementedError:
-                            result = False
-                        except:
-                            log.exception("Failed to run signature \"%s\":", sig.name)
-                            result = False
-
-                        # If the signature returns None we can carry on, the
-                        # condition was not matched.
-                        if result is None:
-                            continue
-
-                        # On True, the signature is matched.
-                        if result is True:
-                            log.debug("Analysis matched signature \"%s\"", sig.name)
-                            matched.append(sig.as_result())
-                            if sig in complete_list:
-                                complete_list.remove(sig)
-
-                        # Either True or False, we don't need to check this sig anymore.
-                        evented_list.remove(sig)
-                        del sig
+            # The filters are indexed once, the calls are only handed to the
+            # signatures interested in them.
+            evented = EventedSignatures(evented_list)
+            for proc in self.results.get("behavior", {}).get("processes", []):
+                if not evented:
+                    break
 
-            # Call the stop method on all remaining instances.
-            for sig in evented_list:
-                try:
-                    result = sig.on_complete()
-                except NotImplementedError:
-                    continue
-                except:
-                    log.exception("Failed run on_complete() method for signature \"%s\":", sig.name)
-                    continue
-                else:
-                    if result is True:
+                for call in proc["calls"]:
+                    for sig in evented.feed(proc, call):
                         log.debug("Analysis matched signature \"%s\"", sig.name)
                         matched.append(sig.as_result())
-                        if sig in complete_list:
-                            complete_list.remove(sig)
+
+                    # Stop iterating when all the signatures are done.
+                    if not evented:
+                        break
+
+            # Call the stop method on all remaining instances.
+            for sig in evented.complete():
+                log.debug("Analysis matched signature \"%s\"", sig.name)
+                matched.append(sig.as_result())
+
+            # Evented signatures don't run again in the compat loop.
+            done = set(type(sig) for sig in evented_list)
+            complete_list = [sig for sig in complete_list if sig not in done]
+            stats.extend(evented.statistics())
 
         # Link this into the results already at this point, so non-evented signatures can use it
         self.results["signatures"] = matched
@@ -433,7 +526,11 @@ class RunSignatures(object):
             log.debug("Running non-evented signatures")
 
             for signature in complete_list:
+                start = time.clock()
                 match = self.process(signature)
+                stats.append(dict(name=signature.name, calls=1,
+                                  time=round(time.clock() - start, 3)))
+
                 # If the signature is matched, add it to the list.
                 if match:
                     matched.append(match)
@@ -446,6 +543,13 @@ class RunSignatures(object):
         # Sort the matched signatures by their severity level.
         matched.sort(key=lambda key: key["severity"])
 
+        # Slowest signatures first.
+        stats.sort(key=lambda stat: stat["time"], reverse=True)
+        self.results.setdefault("statistics", {})["signatures"] = stats
+        for stat in stats[:5]:
+            log.debug("Signature \"%s\" took %.3fs", stat["name"],
+                      stat["time"])
+
 class RunReporting:
     """Reporting Engine.
 
@@ -0,0 +1,327 @@
+# Copyright (C) 2010-2014 Cuckoo Foundation.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import os
+import time
+import socket
+import logging
+import threading
+import multiprocessing
+
+from lib.cuckoo.common.config import Config
+from lib.cuckoo.common.constants import CUCKOO_ROOT
+from lib.cuckoo.core.database import Database, TASK_REPORTED
+from lib.cuckoo.core.database import TASK_FAILED_PROCESSING
+from lib.cuckoo.core.plugins import RunProcessing, RunSignatures, RunReporting
+
+log = logging.getLogger(__name__)
+
+# Processing queue running within this process, if any.
+_queue = None
+
+def process(task_id, report=False, auto=False):
+    """Process the results of an analysis and generate the reports.
+    @param task_id: ID of the analysis to process.
+    @param report: generate the reports and mark the task as reported.
+    @param auto: delete the original file and the binary copy, if enabled.
+    """
+    results = RunProcessing(task_id=task_id).run()
+    RunSignatures(results=results).run()
+
+    if not report:
+        return
+
+    RunReporting(task_id=task_id, results=results).run()
+    Database().set_status(task_id, TASK_REPORTED)
+
+    if not auto:
+        return
+
+    cfg = Config()
+    task = Database().view_task(task_id)
+    if task.category != "file":
+        return
+
+    # If the user enabled the option, delete the original copy.
+    if cfg.cuckoo.delete_original:
+        if not os.path.exists(task.target):
+            log.warning("Original file does not exist anymore: \"%s\": "
+                        "File not found.", task.target)
+        else:
+            try:
+                os.remove(task.target)
+            except OSError as e:
+                log.error("Unable to delete original file at path "
+                          "\"%s\": %s", task.target, e)
+
+    # If the user enabled the delete copy of the binary option, then
+    # delete the copy.
+    if cfg.cuckoo.delete_bin_copy:
+        sample = Database().view_sample(task.sample_id)
+        copy_path = os.path.join(CUCKOO_ROOT, "storage", "binaries",
+                                 sample.sha256)
+        if not os.path.exists(copy_path):
+            log.warning("Copy of the original file does not exist anymore: "
+                        "\"%s\": File not found", copy_path)
+        else:
+            try:
+                os.remove(copy_path)
+            except OSError as e:
+                log.error("Unable to delete the copy of the original file "
+                          "at path \"%s\": %s", copy_path, e)
+
+def _reset_logging_locks():
+    """Replace the logging locks inherited from the parent process. Another
+    thread of the parent may have held one of them when it forked, it would
+    never be released in the child."""
+    logging._lock = threading.RLock()
+    for ref in logging._handlerList:
+        handler = ref()
+        if handler is not None:
+            handler.createLock()
+
+def _process_worker(task_id):
+    """Entry point of the worker processes."""
+    _reset_logging_locks()
+    # Connections inherited from the parent process can't be shared.
+    Database().reconnect()
+    process(task_id, report=True, auto=True)
+
+def notify_completed(task_id):
+    """Tell the processing queue that an analysis has completed, either
+    directly if it runs within this process or through its local socket.
+    @param task_id: ID of the completed analysis.
+    """
+    if _queue is not None:
+        _queue.notify()
+        return
+
+    port = Config().processing.notify_port
+    if not port:
+        return
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(str(task_id), ("127.0.0.1", port))
+    except socket.error as e:
+        log.debug("Unable to notify the processing queue: %s", e)
+    finally:
+        sock.close()
+
+class ProcessingQueue(object):
+    """Processing queue of the completed analyses.
+
+    The queue is persisted in the database, it's made of the tasks with the
+    completed status. Each analysis is processed in its own worker process,
+    so that a crash or a memory leak in a processing, signature or reporting
+    module only affects that analysis. The number of worker processes is
+    bounded, further analyses wait in the database until a worker is free.
+
+    The worker processes are forked from a process running other threads
+    (the analyses, the result server). Only the forking thread survives in
+    the child, any lock held by another thread at that time stays locked.
+    The workers reset the logging locks and reconnect to the database, they
+    don't rely on any other state shared with those threads: the processing
+    modules mustn't use module level locks of the parent nor its threads.
+    """
+
+    # Seconds between checks for completed analyses we haven't been
+    # notified about.
+    POLL_INTERVAL = 5
+
+    # Seconds before the first retry of a failed analysis, doubled on every
+    # further failure.
+    RETRY_DELAY = 30
+
+    def __init__(self, workers=1, timeout=0, retries=0, maxcount=0,
+                 listen=False):
+        """@param workers: maximum number of worker processes.
+        @param timeout: seconds after which a worker process is killed.
+        @param retries: number of retries after a failure or a timeout.
+        @param maxcount: stop after this many analyses, 0 for no limit.
+        @param listen: listen for notifications on the local socket.
+        """
+        self.workers = workers
+        self.timeout = timeout
+        self.retries = retries
+        self.maxcount = maxcount
+        self.listen = listen
+        self.db = Database()
+        self.running = True
+        self.draining = False
+        self.thread = None
+        self.wakeup = threading.Event()
+        # Task id -> (worker process, start time).
+        self.processes = {}
+        # Task id -> number of failed attempts.
+        self.attempts = {}
+        # Task id -> time before which a failed analysis isn't retried.
+        self.retry_at = {}
+        # Analyses given up on, left alone even if their status couldn't be
+        # updated.
+        self.failed = set()
+        # Analyses processed so far, counted once however many attempts.
+        self.counted = set()
+
+    def notify(self):
+        """Wake up the queue, an analysis has completed."""
+        self.wakeup.set()
+
+    def _listener(self, sock):
+        """Wake up the queue on every datagram received."""
+        while self.running:
+            try:
+                sock.recv(64)
+            except socket.error:
+                continue
+            self.notify()
+
+    def _failed(self, task_id, reason):
+        """Deal with an analysis which couldn't be processed.
+        @param task_id: ID of the analysis.
+        @param reason: failure description.
+        """
+        attempts = self.attempts.get(task_id, 0) + 1
+        if attempts <= self.retries:
+            delay = self.RETRY_DELAY * 2 ** (attempts - 1)
+            log.warning("Task #%d: processing %s, retrying in %d seconds "
+                        "(%d/%d)", task_id, reason, delay, attempts,
+                        self.retries)
+            self.attempts[task_id] = attempts
+            self.retry_at[task_id] = time.time() + delay
+        else:
+            log.error("Task #%d: processing %s", task_id, reason)
+            self.attempts.pop(task_id, None)
+            self.retry_at.pop(task_id, None)
+            self.failed.add(task_id)
+            self.db.set_status(task_id, TASK_FAILED_PROCESSING)
+
+    def _reap(self):
+        """Collect the worker processes which are done or timed out."""
+        for task_id, (proc, started) in self.processes.items():
+            if proc.is_alive():
+                if not self.timeout or time.time() - started < self.timeout:
+                    continue
+
+                proc.terminate()
+                proc.join()
+                del self.processes[task_id]
+                self._failed(task_id, "timed out after %d seconds" %
+                             self.timeout)
+                continue
+
+            proc.join()
+            del self.processes[task_id]
+
+            if proc.exitcode:
+                self._failed(task_id, "failed (exit code %d)" % proc.exitcode)
+            else:
+                self.attempts.pop(task_id, None)
+                log.info("Task #%d: reports generation completed (%.1fs)",
+                         task_id, time.time() - started)
+
+    def _dispatch(self):
+        """Start worker processes for as many completed analyses as there
+        are free workers.
+        @return: number of worker processes started.
+        """
+        # The failed analyses whose delay has expired may be retried.
+        now = time.time()
+        for task_id, retry_at in self.retry_at.items():
+            if retry_at <= now:
+                del self.retry_at[task_id]
+
+        free = self.workers - len(self.processes)
+        if free <= 0:
+            return 0
+
+        exclude = self.processes.keys() + self.retry_at.keys() + \
+            list(self.failed)
+        tasks = self.db.list_completed(limit=free, exclude=exclude)
+
+        started = 0
+        for task in tasks:
+            # Retries don't count toward the maximum number of analyses.
+            if task.id not in self.counted and self._limit_reached():
+                continue
+
+            log.info("Processing analysis data for Task #%d", task.id)
+
+            proc = multiprocessing.Process(target=_process_worker,
+                                           args=(task.id,),
+                                           name="Processing-%d" % task.id)
+            # Not daemonic, the processing modules may have children of their
+            # own. The workers are terminated by stop().
+            proc.daemon = False
+            proc.start()
+
+            self.processes[task.id] = proc, time.time()
+            self.counted.add(task.id)
+            started += 1
+
+        return started
+
+    def _limit_reached(self):
+        """@return: whether the maximum number of analyses was reached."""
+        return bool(self.maxcount) and len(self.counted) >= self.maxcount
+
+    def start(self):
+        """Run the queue in a background thread of this process."""
+        global _queue
+        _queue = self
+
+        self.thread = threading.Thread(target=self.run,
+                                       name="ProcessingQueue")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        """Process completed analyses until stopped, until the maximum
+        number of analyses has been reached or, when draining, until there
+        is no completed analysis left."""
+        if self.listen and Config().processing.notify_port:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(("127.0.0.1", Config().processing.notify_port))
+            thread = threading.Thread(target=self._listener, args=(sock,),
+                                      name="ProcessingQueueListener")
+            thread.daemon = True
+            thread.start()
+
+        while self.running:
+            self.wakeup.clear()
+            self._reap()
+
+            if not self._dispatch() and \
+                    (self.draining or self._limit_reached()) and \
+                    not self.processes and not self.retry_at:
+                break
+
+            # While analyses are being processed check on them every second,
+            # otherwise only poll the database once in a while.
+            if self.processes:
+                self.wakeup.wait(1)
+            else:
+                self.wakeup.wait(self.POLL_INTERVAL)
+
+    def stop(self, drain=False):
+        """Stop the queue.
+        @param drain: process all the completed analyses first. Otherwise
+        the analyses being processed are interrupted, they are still in the
+        completed state and will be processed again.
+        """
+        if drain and self.thread:
+            log.info("Waiting for the completed analyses to be processed")
+            self.draining = True
+            self.notify()
+            # Join with a timeout so that CTRL+C is still handled.
+            while self.thread.is_alive():
+                self.thread.join(1)
+
+        self.running = False
+        self.notify()
+
+        for task_id, (proc, started) in self.processes.items():
+            log.info("Task #%d: processing interrupted", task_id)
+            proc.terminate()
+            proc.join()
@@ -3,6 +3,8 @@
 # See the file 'docs/LICENSE' for copying permission.
 
 import os
+import errno
+import hashlib
 import socket
 import select
 import logging
@@ -10,12 +12,14 @@ import datetime
 import SocketServer
 from threading import Event, Thread
 
+from lib.cuckoo.common.blobstore import BlobStore, open_new
 from lib.cuckoo.common.config import Config
 from lib.cuckoo.common.constants import CUCKOO_ROOT
 from lib.cuckoo.common.exceptions import CuckooOperationalError
 from lib.cuckoo.common.exceptions import CuckooCriticalError
 from lib.cuckoo.common.exceptions import CuckooResultError
 from lib.cuckoo.common.netlog import NetlogParser, BsonParser
+from lib.cuckoo.common.netlog import IncompleteMessage, ReadBuffer
 from lib.cuckoo.common.utils import create_folder, Singleton, logtime
 
 log = logging.getLogger(__name__)
@@ -43,8 +47,10 @@ class ResultServer(SocketServer.ThreadingTCPServer, object):
 
     def __init__(self, *args, **kwargs):
         self.cfg = Config()
+        self.blobstore = BlobStore() if self.cfg.cuckoo.blob_store else None
         self.analysistasks = {}
         self.analysishandlers = {}
+        self.wakeup = None
 
         ip = self.cfg.resultserver.ip
         self.port = int(self.cfg.resultserver.port)
@@ -71,7 +77,11 @@ class ResultServer(SocketServer.ThreadingTCPServer, object):
                                                   ip, self.port, str(e)))
             else:
                 log.debug("ResultServer running on {0}:{1}.".format(ip, self.port))
-                self.servethread = Thread(target=self.serve_forever)
+                if self.cfg.resultserver.mode == "async":
+                    self.wakeup = os.pipe()
+                    self.servethread = Thread(target=self.serve_async)
+                else:
+                    self.servethread = Thread(target=self.serve_forever)
                 self.servethread.setDaemon(True)
                 self.servethread.start()
                 break
@@ -90,6 +100,8 @@ class ResultServer(SocketServer.ThreadingTCPServer, object):
         handlers = self.analysishandlers.pop(task.id, None)
         for h in handlers:
             h.end_request.set()
+        self.wake()
+        for h in handlers:
             h.done_event.wait()
 
     def register_handler(self, handler):
@@ -118,6 +130,90 @@ class ResultServer(SocketServer.ThreadingTCPServer, object):
 
         return os.path.join(CUCKOO_ROOT, "storage", "analyses", str(task.id))
 
+    def wake(self):
+        """Interrupt the event loop, if running."""
+        if self.wakeup:
+            try:
+                os.write(self.wakeup[1], "x")
+            except OSError:
+                pass
+
+    def serve_async(self):
+        """Serve all the connections from a single thread, multiplexing the
+        sockets instead of spawning a thread per connection."""
+        self.socket.setblocking(0)
+        self.connections = {}
+        self.poller = select.poll()
+        self.poller.register(self.socket, select.POLLIN)
+        self.poller.register(self.wakeup[0], select.POLLIN)
+
+        while True:
+            try:
+                events = self.poller.poll(1000)
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for fd, event in events:
+                if fd == self.socket.fileno():
+                    self.accept_async()
+                elif fd == self.wakeup[0]:
+                    os.read(self.wakeup[0], BUFSIZE)
+                elif fd in self.connections:
+                    handler = self.connections[fd]
+                    try:
+                        keep = handler.handle_read()
+                    except Exception:
+                        log.exception("ResultServer connection %s failed:",
+                                      str(handler.client_address))
+                        keep = False
+                    if not keep:
+                        self.close_async(fd)
+
+            # Connections of the analyses which have been stopped.
+            for fd, handler in self.connections.items():
+                if handler.end_request.isSet():
+                    self.close_async(fd)
+
+    def accept_async(self):
+        """Accept a new connection and register it in the event loop."""
+        try:
+            request, client_address = self.socket.accept()
+        except socket.error:
+            return
+
+        try:
+            handler = AsyncResultHandler(request, client_address, self)
+        except Exception:
+            log.exception("Unable to handle the ResultServer connection %s:",
+                          str(client_address))
+            request.close()
+            return
+
+        if not handler.storagepath:
+            request.close()
+            handler.finish()
+            return
+
+        self.connections[request.fileno()] = handler
+        self.poller.register(request, select.POLLIN)
+
+    def close_async(self, fd):
+        """Unregister a connection from the event loop and close it."""
+        handler = self.connections.pop(fd)
+        self.poller.unregister(fd)
+        # A failure to complete the files of a connection mustn't stop the
+        # loop serving all the others.
+        try:
+            handler.close()
+        except Exception:
+            log.exception("Unable to close the ResultServer connection %s:",
+                          str(handler.client_address))
+        finally:
+            handler.request.close()
+            handler.finish()
+
 
 class ResultHandler(SocketServer.BaseRequestHandler):
     """Result handler.
@@ -133,6 +229,8 @@ class ResultHandler(SocketServer.BaseRequestHandler):
         self.end_request = Event()
         self.done_event = Event()
         self.pid, self.ppid, self.procname = None, None, None
+        self.behavior = None
+        self.buffer = ReadBuffer(self.receive)
         self.server.register_handler(self)
 
     def finish(self):
@@ -146,36 +244,30 @@ class ResultHandler(SocketServer.BaseRequestHandler):
             if rs:
                 return True
 
-    def read(self, length):
-        buf = ""
-        while len(buf) < length:
-            if not self.wait_sock_or_end():
-                raise Disconnect()
-            tmp = self.request.recv(length-len(buf))
-            if not tmp:
-                raise Disconnect()
-            buf += tmp
-
-        if isinstance(self.protocol, (NetlogParser, BsonParser)):
-            if self.rawlogfd:
-                self.rawlogfd.write(buf)
-            else:
-                self.startbuf += buf
-        return buf
-
-    def read_any(self):
+    def receive(self, view):
+        """Receive the data available into the read buffer."""
         if not self.wait_sock_or_end():
             raise Disconnect()
-        tmp = self.request.recv(BUFSIZE)
-        if not tmp:
+        length = self.request.recv_into(view)
+        if not length:
             raise Disconnect()
-        return tmp
+        return length
+
+    def read(self, length):
+        return self.buffer.read(length)
+
+    def read_any(self):
+        return self.buffer.read_any()
 
     def read_newline(self):
-        buf = ""
-        while "\n" not in buf:
-            buf += self.read(1)
-        return buf
+        return self.buffer.read_newline()
+
+    def write_raw(self, data):
+        """Keep a copy of the raw log."""
+        if self.rawlogfd:
+            self.rawlogfd.write(data)
+        else:
+            self.startbuf += data.tobytes()
 
     def negotiate_protocol(self):
         # Read until newline.
@@ -183,8 +275,10 @@ class ResultHandler(SocketServer.BaseRequestHandler):
 
         if "NETLOG" in buf:
             self.protocol = NetlogParser(self)
+            self.buffer.start_persist(self.write_raw)
         elif "BSON" in buf:
             self.protocol = BsonParser(self)
+            self.buffer.start_persist(self.write_raw)
         elif "FILE" in buf:
             self.protocol = FileUpload(self)
         elif "LOG" in buf:
@@ -193,17 +287,40 @@ class ResultHandler(SocketServer.BaseRequestHandler):
             raise CuckooOperationalError("Netlog failure, unknown "
                                          "protocol requested.")
 
-    def handle(self):
+    def prepare(self):
+        """Initialize the storage of a new connection.
+        @return: False if the connection doesn't belong to any analysis.
+        """
         ip, port = self.client_address
         self.connect_time = datetime.datetime.now()
         log.debug("New connection from: {0}:{1}".format(ip, port))
 
         self.storagepath = self.server.build_storage_path(ip)
         if not self.storagepath:
-            return
+            return False
 
         # Create all missing folders for this analysis.
         self.create_folders()
+        return True
+
+    def close(self):
+        """Close the protocol handler and the log files."""
+        if self.protocol:
+            self.protocol.close()
+
+        self.buffer.flush()
+        if self.logfd:
+            self.logfd.close()
+        if self.rawlogfd:
+            self.rawlogfd.close()
+        if self.behavior:
+            self.behavior.close()
+
+        log.debug("Connection closed: {0}:{1}".format(*self.client_address))
+
+    def handle(self):
+        if not self.prepare():
+            return
 
         try:
             # Initialize the protocol handler class for this connection.
@@ -220,14 +337,7 @@ class ResultHandler(SocketServer.BaseRequestHandler):
             log.exception("FIXME - exception in resultserver connection %s",
                           str(self.client_address))
 
-        self.protocol.close()
-
-        if self.logfd:
-            self.logfd.close()
-        if self.rawlogfd:
-            self.rawlogfd.close()
-
-        log.debug("Connection closed: {0}:{1}".format(ip, port))
+        self.close()
 
     def log_process(self, ctx, timestring, pid, ppid, modulepath, procname):
         if self.pid is not None:
@@ -253,6 +363,17 @@ class ResultHandler(SocketServer.BaseRequestHandler):
 
         self.pid, self.ppid, self.procname = pid, ppid, procname
 
+        # Process the behavior while the log is being received.
+        if self.server.cfg.resultserver.live_behavior and pid is not None:
+            try:
+                # Only needed when enabled, it's a processing module.
+                from modules.processing.behavior import LiveBehavior
+                self.behavior = LiveBehavior(self.storagepath, pid, ppid,
+                                             procname, timestring)
+            except Exception as e:
+                log.warning("Unable to process the behavior of process %d "
+                            "live: %s", pid, e)
+
     def log_thread(self, context, pid):
         log.debug("New thread (tid={0}, pid={1})".format(context[3], pid))
 
@@ -260,6 +381,9 @@ class ResultHandler(SocketServer.BaseRequestHandler):
         log.debug("Anomaly (tid=%s, category=%s, funcname=%s): %s",
                   tid, subcategory, funcname, msg)
 
+        if self.behavior:
+            self.behavior.log_anomaly(subcategory, tid, funcname, msg)
+
     def log_call(self, context, apiname, modulename, arguments):
         if not self.rawlogfd:
             raise CuckooOperationalError("Netlog failure, call "
@@ -281,6 +405,9 @@ class ResultHandler(SocketServer.BaseRequestHandler):
                 timestring, self.pid, self.procname, tid, self.ppid,
                 modulename, apiname, status, returnval] + argumentstrings)
 
+        if self.behavior:
+            self.behavior.log_call(context, apiname, modulename, arguments)
+
     def log_error(self, emsg):
         log.warning("ResultServer error condition on connection %s "
                     "(pid %s procname %s): %s", str(self.client_address),
@@ -297,6 +424,82 @@ class ResultHandler(SocketServer.BaseRequestHandler):
                 return False
 
 
+class AsyncResultHandler(ResultHandler):
+    """Result handler driven by the ResultServer event loop.
+
+    Received data is accumulated in a preallocated buffer which the protocol
+    parsers read from. When a message hasn't been entirely received yet, the
+    parser is interrupted and runs again from the start of the message once
+    more data is available.
+    """
+
+    def __init__(self, request, client_address, server):
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+
+        self.request.setblocking(0)
+        self.setup()
+        self.buffer = ReadBuffer(self.request.recv_into, blocking=False)
+        if not self.prepare():
+            self.storagepath = None
+
+    def handle_read(self):
+        """Receive the available data and parse the complete messages.
+        @return: False if the connection has to be closed.
+        """
+        try:
+            length = self.buffer.receive()
+        except socket.error as e:
+            return e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+        except CuckooResultError as e:
+            log.warning("ResultServer connection %s closed: %s",
+                        str(self.client_address), e)
+            return False
+
+        if not length:
+            return False
+
+        return self.consume()
+
+    def consume(self):
+        """Parse the complete messages in the buffer.
+        @return: False if the connection has to be closed.
+        """
+        buf = self.buffer
+        # The BSON parser may have decoded messages it hasn't handled yet.
+        while buf.pos < buf.end or getattr(self.protocol, "batch", None):
+            mark = buf.pos
+            try:
+                if not self.protocol:
+                    self.negotiate_protocol()
+                    continue
+
+                if isinstance(self.protocol, FileUpload):
+                    if not self.protocol.fd:
+                        if not self.protocol.open():
+                            return False
+                    elif not self.protocol.write(self.read_any()):
+                        return False
+                    continue
+
+                if not self.protocol.read_next_message():
+                    return False
+            except IncompleteMessage:
+                buf.pos = mark
+                break
+            except CuckooResultError as e:
+                log.warning("ResultServer connection stopping because of "
+                            "CuckooResultError: %s.", str(e))
+                return False
+            except:
+                log.exception("FIXME - exception in resultserver "
+                              "connection %s", str(self.client_address))
+                return False
+
+        return True
+
+
 class FileUpload(object):
     RESTRICTED_DIRECTORIES = "reports/",
 
@@ -305,9 +508,26 @@ class FileUpload(object):
         self.upload_max_size = \
             self.handler.server.cfg.resultserver.upload_max_size
         self.storagepath = self.handler.storagepath
+        self.blobstore = self.handler.server.blobstore
+        self.file_path = None
+        self.sha256 = hashlib.sha256()
         self.fd = None
 
     def read_next_message(self):
+        if not self.open():
+            return False
+
+        chunk = self.handler.read_any()
+        while chunk and self.write(chunk):
+            try:
+                chunk = self.handler.read_any()
+            except:
+                break
+
+    def open(self):
+        """Read the path of the uploaded file and create it.
+        @return: False if the file couldn't be created.
+        """
         # Read until newline for file path, e.g.,
         # shots/0001.jpg or files/9498687557/libcurl-4.dll.bin
 
@@ -334,26 +554,37 @@ class FileUpload(object):
         if not file_path.startswith(self.storagepath):
             raise CuckooOperationalError("FileUpload failure, path sanitization failed.")
 
-        self.fd = open(file_path, "wb")
-        chunk = self.handler.read_any()
-        while chunk:
-            self.fd.write(chunk)
+        self.file_path = file_path
+        self.fd = open_new(file_path)
+        return True
 
-            if self.fd.tell() >= self.upload_max_size:
-                self.fd.write("... (truncated)")
-                break
+    def write(self, chunk):
+        """Write a chunk of the uploaded file.
+        @return: False once the maximum upload size has been reached.
+        """
+        self.fd.write(chunk)
+        self.sha256.update(chunk)
 
-            try:
-                chunk = self.handler.read_any()
-            except:
-                break
-
-        log.debug("Uploaded file length: {0}".format(self.fd.tell()))
+        if self.fd.tell() >= self.upload_max_size:
+            self.fd.write("... (truncated)")
+            self.sha256.update("... (truncated)")
+            return False
+        return True
 
     def close(self):
         if self.fd:
+            log.debug("Uploaded file length: {0}".format(self.fd.tell()))
             self.fd.close()
 
+            # Files already uploaded by other analyses are only kept once.
+            if self.blobstore:
+                try:
+                    self.blobstore.add(self.file_path,
+                                       self.sha256.hexdigest())
+                except (IOError, OSError, CuckooOperationalError) as e:
+                    log.warning("Unable to store uploaded file \"%s\": %s",
+                                self.file_path, e)
+
 
 class LogHandler(object):
     def __init__(self, handler):
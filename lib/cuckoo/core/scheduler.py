@@ -7,8 +7,11 @@ import time
 import shutil
 import logging
 import Queue
-from threading import Thread, Lock
+from contextlib import contextmanager
+from datetime import datetime
+from threading import Thread, Lock, Condition
 
+from lib.cuckoo.common.blobstore import BlobStore
 from lib.cuckoo.common.config import Config
 from lib.cuckoo.common.constants import CUCKOO_ROOT
 from lib.cuckoo.common.exceptions import CuckooMachineError, CuckooGuestError
@@ -16,10 +19,10 @@ from lib.cuckoo.common.exceptions import CuckooOperationalError
 from lib.cuckoo.common.exceptions import CuckooCriticalError
 from lib.cuckoo.common.objects import File
 from lib.cuckoo.common.utils import create_folder
-from lib.cuckoo.core.database import Database, TASK_PENDING, TASK_COMPLETED, TASK_REPORTED, TASK_SCHEDULED, TASK_SINGLE, TASK_RECURRENT
+from lib.cuckoo.core.database import Database, TASK_PENDING, TASK_COMPLETED, TASK_SCHEDULED, TASK_SINGLE, TASK_RECURRENT
 from lib.cuckoo.core.guest import GuestManager
-from lib.cuckoo.core.plugins import list_plugins, RunAuxiliary, RunProcessing
-from lib.cuckoo.core.plugins import RunSignatures, RunReporting
+from lib.cuckoo.core.plugins import list_plugins, RunAuxiliary
+from lib.cuckoo.core.processor import ProcessingQueue, notify_completed
 from lib.cuckoo.core.resultserver import ResultServer
 
 log = logging.getLogger(__name__)
@@ -27,8 +30,7 @@ log = logging.getLogger(__name__)
 machinery = None
 machine_lock = Lock()
 latest_symlink_lock = Lock()
-
-active_analysis_count = 0
+reservations = None
 
 
 class CuckooDeadMachine(Exception):
@@ -40,26 +42,74 @@ class CuckooDeadMachine(Exception):
     pass
 
 
-class AnalysisManager(Thread):
+class MachineReservations(object):
+    """Machine capacity accounting.
+
+    Every analysis reserves a slot before acquiring its machine and gives
+    it back once the machine has been stopped. Slots account for machines
+    which are still being started, so max_machines_count is honoured
+    without serializing the machine starts.
+    """
+
+    def __init__(self, limit=0):
+        """@param limit: maximum number of machines, 0 for no limit."""
+        self.limit = limit
+        self.count = 0
+        self.cond = Condition()
+
+    def free(self):
+        """Number of slots left, None if there is no limit."""
+        if not self.limit:
+            return None
+
+        with self.cond:
+            return max(0, self.limit - self.count)
+
+    def reserve(self):
+        """Reserve a slot, waiting for one to be given back if needed."""
+        with self.cond:
+            while self.limit and self.count >= self.limit:
+                self.cond.wait(1)
+            self.count += 1
+
+    def release(self):
+        """Give a slot back."""
+        with self.cond:
+            self.count -= 1
+            self.cond.notify()
+
+class AnalysisManager(object):
     """Analysis Manager.
 
     This class handles the full analysis process for a given task. It takes
     care of selecting the analysis machine, preparing the configuration and
     interacting with the guest agent and analyzer components to launch and
     complete the analysis and store, process and report its results.
+    Analysis managers are run by the worker threads of an AnalysisPool.
     """
 
     def __init__(self, task, error_queue):
         """@param task: task object containing the details for the analysis."""
-        Thread.__init__(self)
-        Thread.daemon = True
-
         self.task = task
         self.errors = error_queue
         self.cfg = Config()
         self.storage = ""
         self.binary = ""
         self.machine = None
+        # Seconds spent in each stage of the analysis.
+        self.timings = {}
+
+    @contextmanager
+    def stage(self, name):
+        """Measure the time spent in a stage of the analysis.
+        @param name: stage name.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            self.timings[name] = self.timings.get(name, 0) + elapsed
 
     def init_storage(self):
         """Initialize analysis storage folder."""
@@ -118,6 +168,14 @@ class AnalysisManager(Thread):
                           "analysis aborted", self.task.target, self.binary)
                 return False
 
+            # Share the content with the identical dropped files.
+            if self.cfg.cuckoo.blob_store:
+                try:
+                    BlobStore().add(self.binary, sha256)
+                except (IOError, OSError, CuckooOperationalError) as e:
+                    log.warning("Unable to store file \"%s\" in the blob "
+                                "store: %s", self.binary, e)
+
         return True
 
     def create_symlink(self):
@@ -138,32 +196,31 @@ class AnalysisManager(Thread):
 
         # Start a loop to acquire the a machine to run the analysis on.
         while True:
-            machine_lock.acquire()
-
-            # In some cases it's possible that we enter this loop without
-            # having any available machines. We should make sure this is not
-            # such case, or the analysis task will fail completely.
-            if not machinery.availables(locked_by=self.task.experiment_id):
-                machine_lock.release()
-                time.sleep(1)
-                continue
-
-            # If the user specified a specific machine ID, a platform to be
-            # used or machine tags acquire the machine accordingly.
-            machine = machinery.acquire(machine_id=self.task.machine,
-                                        platform=self.task.platform,
-                                        tags=self.task.tags,
-                                        locked_by=self.task.experiment_id)
+            with machine_lock:
+                # In some cases it's possible that we enter this loop
+                # without having any available machines. We should make
+                # sure this is not such case, or the analysis task will
+                # fail completely.
+                if not machinery.availables(locked_by=self.task.experiment_id):
+                    machine = None
+                else:
+                    # If the user specified a specific machine ID, a
+                    # platform to be used or machine tags acquire the
+                    # machine accordingly.
+                    machine = machinery.acquire(machine_id=self.task.machine,
+                                                platform=self.task.platform,
+                                                tags=self.task.tags,
+                                                locked_by=self.task.experiment_id)
 
             # If no machine is available at this moment, wait for one second
             # and try again.
             if not machine:
-                machine_lock.release()
                 log.debug("Task #%d: no machine available yet", self.task.id)
                 time.sleep(1)
             else:
                 log.info("Task #%d: acquired machine %s (label=%s)",
                          self.task.id, machine.name, machine.label)
+                Database().notify()
                 break
 
         self.machine = machine
@@ -208,11 +265,11 @@ class AnalysisManager(Thread):
         if not self.init_storage():
             return False
 
+        is_first_task = len(Database().list_tasks(experiment=self.task.experiment_id)) == 1
+
         if self.task.category == "file":
             sample = Database().view_sample(self.task.sample_id)
 
-            is_first_task = len(Database().list_tasks(experiment=self.task.experiment_id)) == 1
-
             if is_first_task:
                 # Check whether the file has been changed for some unknown reason.
                 # And fail this analysis if it has been modified.
@@ -233,26 +290,38 @@ class AnalysisManager(Thread):
         if self.task.repeat == TASK_RECURRENT:
             Database().schedule(self.task.id)
 
-        # Acquire analysis machine.
+        # Reserve capacity for the analysis machine, it's given back once
+        # the machine has been stopped, or right away if the analysis fails
+        # before starting it.
+        reservations.reserve()
+
         try:
-            self.acquire_machine()
-        except CuckooOperationalError as e:
-            machine_lock.release()
-            log.error("Cannot acquire machine: {0}".format(e))
-            return False
+            # Acquire analysis machine.
+            try:
+                with self.stage("acquire"):
+                    self.acquire_machine()
+            except CuckooOperationalError as e:
+                reservations.release()
+                log.error("Cannot acquire machine: {0}".format(e))
+                return False
 
-        # Generate the analysis configuration file.
-        options = self.build_options()
+            # Generate the analysis configuration file.
+            options = self.build_options()
 
-        # At this point we can tell the ResultServer about it.
-        try:
-            ResultServer().add_task(self.task, self.machine)
-        except Exception as e:
-            machinery.release(self.machine.label)
-            self.errors.put(e)
+            # At this point we can tell the ResultServer about it.
+            try:
+                ResultServer().add_task(self.task, self.machine)
+            except Exception as e:
+                machinery.release(self.machine.label)
+                self.errors.put(e)
 
-        aux = RunAuxiliary(task=self.task, machine=self.machine)
-        aux.start()
+            aux = RunAuxiliary(task=self.task, machine=self.machine)
+            aux.start()
+        except:
+            reservations.release()
+            if self.machine:
+                machinery.release(self.machine.label)
+            raise
 
         try:
             # Mark the selected analysis machine in the database as started.
@@ -261,18 +330,11 @@ class AnalysisManager(Thread):
                                                self.machine.label,
                                                machinery.__class__.__name__)
 
-            # Starting the machinery takes some time. In order not to run into
-            # race conditions with max_machines_count because acquiring new
-            # machines takes place in parallel next to starting machines, for
-            # which it takes a little delay before the machines' status turns
-            # into "running", we hold the machine lock until the machine has
-            # fully started (or gives an error, of course).
-            try:
-                # Start the machine, revert only if we are the first task in
-                # the experiment.
+            # Start the machine, revert only if we are the first task in
+            # the experiment. Machines are started in parallel, the capacity
+            # has already been reserved.
+            with self.stage("start"), machinery.get_lock(self.machine.label):
                 machinery.start(self.machine.label, revert=is_first_task)
-            finally:
-                machine_lock.release()
 
             # Initialize the guest manager.
             # FIXME - The critical timeout options is analysis_timeout + 60 sec
@@ -284,9 +346,11 @@ class AnalysisManager(Thread):
 
             # Start the analysis if we are the first task of a series
             if is_first_task:
-                guest.start_analysis(options)
+                with self.stage("upload"):
+                    guest.start_analysis(options)
 
-            guest.wait_for_completion()
+            with self.stage("run"):
+                guest.wait_for_completion()
             succeeded = True
         except CuckooMachineError as e:
             log.error(str(e), extra={"task_id": self.task.id})
@@ -301,7 +365,8 @@ class AnalysisManager(Thread):
             if self.cfg.cuckoo.memory_dump or self.task.memory:
                 try:
                     dump_path = os.path.join(self.storage, "memory.dmp")
-                    machinery.dump_memory(self.machine.label, dump_path)
+                    with self.stage("memory"), machinery.get_lock(self.machine.label):
+                        machinery.dump_memory(self.machine.label, dump_path)
                 except NotImplementedError:
                     log.error("The memory dump functionality is not available "
                               "for the current machine manager.")
@@ -310,10 +375,13 @@ class AnalysisManager(Thread):
 
             try:
                 # Stop the analysis machine.
-                machinery.stop(self.machine.label)
+                with self.stage("stop"), machinery.get_lock(self.machine.label):
+                    machinery.stop(self.machine.label)
             except CuckooMachineError as e:
                 log.warning("Unable to stop machine %s: %s",
                             self.machine.label, e)
+            finally:
+                reservations.release()
 
             # Mark the machine in the database as stopped. Unless this machine
             # has been marked as dead, we just keep it as "started" in the
@@ -352,45 +420,8 @@ class AnalysisManager(Thread):
 
         return succeeded
 
-    def process_results(self):
-        """Process the analysis results and generate the enabled reports."""
-        results = RunProcessing(task_id=self.task.id).run()
-        RunSignatures(results=results).run()
-        RunReporting(task_id=self.task.id, results=results).run()
-
-        # If the target is a file and the user enabled the option,
-        # delete the original copy.
-        if self.task.category == "file" and self.cfg.cuckoo.delete_original:
-            if not os.path.exists(self.task.target):
-                log.warning("Original file does not exist anymore: \"%s\": "
-                            "File not found.", self.task.target)
-            else:
-                try:
-                    os.remove(self.task.target)
-                except OSError as e:
-                    log.error("Unable to delete original file at path "
-                              "\"%s\": %s", self.task.target, e)
-
-        # If the target is a file and the user enabled the delete copy of
-        # the binary option, then delete the copy.
-        if self.task.category == "file" and self.cfg.cuckoo.delete_bin_copy:
-            if not os.path.exists(self.binary):
-                log.warning("Copy of the original file does not exist anymore: \"%s\": File not found", self.binary)
-            else:
-                try:
-                    os.remove(self.binary)
-                except OSError as e:
-                    log.error("Unable to delete the copy of the original file at path \"%s\": %s", self.binary, e)
-
-        log.info("Task #%d: reports generation completed (path=%s)",
-                 self.task.id, self.storage)
-
-        return True
-
     def run(self):
-        """Run manager thread."""
-        global active_analysis_count
-        active_analysis_count += 1
+        """Run the analysis, called by a worker thread of the pool."""
         try:
             while True:
                 try:
@@ -405,9 +436,9 @@ class AnalysisManager(Thread):
             log.debug("Released database task #%d with status %s",
                       self.task.id, success)
 
-            if self.cfg.cuckoo.process_results:
-                self.process_results()
-                Database().set_status(self.task.id, TASK_REPORTED)
+            # The results are processed by the processing queue, either
+            # within this process or by utils/process.py.
+            notify_completed(self.task.id)
 
             # We make a symbolic link ("latest") which links to the latest
             # analysis - this is useful for debugging purposes. This is only
@@ -430,11 +461,130 @@ class AnalysisManager(Thread):
                 finally:
                     latest_symlink_lock.release()
 
-            log.info("Task #%d: analysis procedure completed", self.task.id)
+            log.info("Task #%d: analysis procedure completed (%s)",
+                     self.task.id, ", ".join("%s=%.1fs" % (name, value)
+                                             for name, value
+                                             in sorted(self.timings.items())))
         except:
             log.exception("Failure in AnalysisManager.run")
 
-        active_analysis_count -= 1
+        # A machine might be available again.
+        Database().notify()
+
+class AnalysisPool(object):
+    """Fixed-size pool of worker threads running the analysis managers.
+
+    The number of workers is tied to the number of analysis machines, so
+    that the amount of concurrent analyses (and the memory they take) is
+    bounded regardless of the number of tasks being submitted.
+    """
+
+    def __init__(self, workers):
+        """@param workers: number of worker threads."""
+        self.queue = Queue.Queue()
+        self.lock = Lock()
+        self.active = set()
+        self.queued = 0
+        self.completed = 0
+        # Cumulative time spent in each analysis stage, over all analyses.
+        self.timings = {}
+        self.threads = []
+
+        for idx in xrange(workers):
+            thread = Thread(target=self._worker,
+                            name="AnalysisWorker-%d" % idx)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _worker(self):
+        """Worker thread main loop."""
+        while True:
+            analysis = self.queue.get()
+            if analysis is None:
+                break
+
+            with self.lock:
+                self.queued -= 1
+                self.active.add(analysis)
+
+            try:
+                analysis.run()
+            finally:
+                with self.lock:
+                    self.active.discard(analysis)
+                    self.completed += 1
+                    for name, value in analysis.timings.items():
+                        self.timings[name] = self.timings.get(name, 0) + value
+
+    def submit(self, analysis):
+        """Queue an analysis to be run by the first free worker.
+        @param analysis: AnalysisManager instance.
+        """
+        with self.lock:
+            self.queued += 1
+        self.queue.put(analysis)
+
+    def pending(self):
+        """Number of analyses either queued or running."""
+        with self.lock:
+            return self.queued + len(self.active)
+
+    def acquiring(self):
+        """Number of analyses which haven't acquired a machine yet."""
+        with self.lock:
+            return self.queued + len([a for a in self.active
+                                      if a.machine is None])
+
+    def status(self):
+        """Returns the gauges and the average stage timings of the pool.
+        @return: dict with pool statistics.
+        """
+        with self.lock:
+            timings = {}
+            if self.completed:
+                for name, value in self.timings.items():
+                    timings[name] = value / self.completed
+
+            return dict(workers=len(self.threads), active=len(self.active),
+                        queued=self.queued, completed=self.completed,
+                        timings=timings)
+
+    def shutdown(self):
+        """Stop the pool. Queued analyses are put back in the pending state,
+        running ones are waited for."""
+        while True:
+            try:
+                analysis = self.queue.get(block=False)
+            except Queue.Empty:
+                break
+
+            if analysis is None:
+                continue
+
+            with self.lock:
+                self.queued -= 1
+
+            log.info("Task #%d: analysis not started, back to pending",
+                     analysis.task.id)
+            Database().set_status(analysis.task.id, TASK_PENDING)
+
+        for thread in self.threads:
+            self.queue.put(None)
+
+        active = self.pending()
+        if active:
+            log.info("Waiting for %d running analyses to complete "
+                     "(press CTRL+C again to force shutdown)", active)
+
+        try:
+            for thread in self.threads:
+                # Join with a timeout so that CTRL+C is still handled.
+                while thread.is_alive():
+                    thread.join(1)
+        except KeyboardInterrupt:
+            log.warning("Forcing shutdown with %d analyses still running",
+                        self.pending())
 
 class Scheduler:
     """Tasks Scheduler.
@@ -446,16 +596,25 @@ class Scheduler:
     take care of running the full analysis process and operating with the
     assigned analysis machine.
     """
+    # Seconds between checks for tasks added by other processes, e.g., by
+    # the API or the web interface, which can't notify us directly.
+    POLL_INTERVAL = 1
+
     def __init__(self, maxcount=None):
         self.running = True
         self.cfg = Config()
         self.db = Database()
         self.maxcount = maxcount
         self.total_analysis_count = 0
+        self.last_task_id = None
+        self.pool = None
+        self.processing = None
 
     def initialize(self):
         """Initialize the machine manager."""
-        global machinery
+        global machinery, reservations
+
+        reservations = MachineReservations(self.cfg.cuckoo.max_machines_count or 0)
 
         machinery_name = self.cfg.cuckoo.machinery
 
@@ -505,9 +664,75 @@ class Scheduler:
                         "increase throughput and stability. Please read the "
                         "documentation about the `Processing Utility`.")
 
-    def stop(self):
-        """Stop scheduler."""
+    def wait_for_work(self, retry=False):
+        """Block until there might be a task to be started, that is, until
+        a task is added, a machine is released, an analysis completes or a
+        scheduled task becomes due.
+        @param retry: only wait for the polling interval, used when a task
+                      could not be started for a transient reason.
+        """
+        if retry:
+            self.db.wait_for_work(self.POLL_INTERVAL)
+            return
+
+        next_due = self.db.next_task_due()
+
+        while self.running:
+            timeout = self.POLL_INTERVAL
+            if next_due:
+                delay = (next_due - datetime.now()).total_seconds()
+                timeout = max(0, min(timeout, delay))
+
+            if self.db.wait_for_work(timeout):
+                return
+
+            if next_due and next_due <= datetime.now():
+                return
+
+            # Tasks submitted by another process don't notify us.
+            task_id = self.db.last_task_id()
+            if task_id != self.last_task_id:
+                self.last_task_id = task_id
+                return
+
+    def batch_limit(self, free):
+        """Number of pending tasks that may be started right now.
+        @param free: number of machines not locked by any analysis.
+        @return: maximum number of tasks to claim.
+        """
+        # Analysis managers which haven't acquired their machine yet are
+        # about to take one of the free machines.
+        limit = free - self.pool.acquiring()
+
+        # Don't restore too many machines at once.
+        if self.cfg.cuckoo.max_batch_count > 0:
+            limit = min(limit, self.cfg.cuckoo.max_batch_count)
+
+        if reservations.free() is not None:
+            limit = min(limit, reservations.free())
+
+        if self.maxcount:
+            limit = min(limit, self.maxcount - self.total_analysis_count)
+
+        return limit
+
+    def stop(self, drain=False):
+        """Stop scheduler.
+        @param drain: process the results of the completed analyses before
+        stopping, otherwise they're processed at the next start.
+        """
         self.running = False
+        self.db.notify()
+
+        # Let the running analyses complete.
+        if self.pool:
+            self.pool.shutdown()
+            self.pool = None
+
+        if self.processing:
+            self.processing.stop(drain=drain)
+            self.processing = None
+
         # Shutdown machine manager (used to kill machines that still alive).
         machinery.shutdown()
 
@@ -524,16 +749,33 @@ class Scheduler:
         if self.maxcount is None:
             self.maxcount = self.cfg.cuckoo.max_analysis_count
 
+        # One worker per machine, no more than the machines allowed to run
+        # at the same time.
+        workers = len(machinery.machines())
+        if self.cfg.cuckoo.max_machines_count > 0:
+            workers = min(workers, self.cfg.cuckoo.max_machines_count)
+
+        self.pool = AnalysisPool(workers)
+
+        # Process the results in worker processes next to the analyses.
+        if self.cfg.cuckoo.process_results:
+            self.processing = ProcessingQueue(
+                workers=self.cfg.processing.workers or 1,
+                timeout=self.cfg.processing.timeout or 0,
+                retries=self.cfg.processing.retries or 0)
+            self.processing.start()
+
+        self.last_task_id = self.db.last_task_id()
+
+        # Look for tasks right away at startup, wait for work afterwards.
+        wait = retry = False
+
         # This loop runs forever.
         while self.running:
-            time.sleep(1)
-
-            # Wait until the machine lock is not locked, that is, all machines
-            # have been assigned a machine and are running.
-            if not machine_lock.acquire(False):
-                continue
+            if wait:
+                self.wait_for_work(retry=retry)
 
-            machine_lock.release()
+            wait, retry = True, False
 
             # If not enough free disk space is available, then we print an
             # error message and wait another round (this check is ignored
@@ -554,39 +796,50 @@ class Scheduler:
                     if space_available < self.cfg.cuckoo.freespace:
                         log.error("Not enough free disk space! (Only %d MB!)",
                                   space_available)
+                        retry = True
                         continue
 
             # Have we limited the number of concurrently executing machines?
-            if self.cfg.cuckoo.max_machines_count > 0:
-                # Are too many running?
-                if len(machinery.running()) >= self.cfg.cuckoo.max_machines_count:
-                    continue
+            # Are too many running or being started?
+            if reservations.free() == 0:
+                continue
 
             # Exits if max_analysis_count is defined in the configuration
             # file and has been reached.
             if self.maxcount and self.total_analysis_count >= self.maxcount:
-                if active_analysis_count <= 0:
-                    self.stop()
+                if not self.pool.pending():
+                    self.stop(drain=True)
             else:
-                task = None
-                if machinery.availables():
-                    # Machines available, get the next task
-                    # lock the machine, and run the analysis.
-                    task = self.db.fetch(status=TASK_PENDING)
+                tasks = []
+
+                # Machines available, claim as many pending tasks as there
+                # are machines free and run the analyses.
+                machines = machinery.free_machines()
+                limit = self.batch_limit(len(machines))
+                if limit > 0:
+                    tasks = self.db.claim_tasks(machines, TASK_PENDING, limit)
 
-                if not task:
+                if not tasks:
                     # No pending task available, simply run scheduled task
                     task = self.db.fetch(status=TASK_SCHEDULED)
+                    if task:
+                        tasks = [task]
 
-                if task:
+                for task in tasks:
                     log.debug("Processing task #%s", task.id)
 
                     self.total_analysis_count += 1
 
-                    # Initialize and start the analysis manager.
-                    analysis = AnalysisManager(task, errors)
-                    analysis.start()
-                    task = None
+                    # Initialize the analysis manager and hand it over to
+                    # the worker pool.
+                    self.pool.submit(AnalysisManager(task, errors))
+
+                if tasks:
+                    log.debug("Analysis pool status: %s", self.pool.status())
+
+                    # Check again as soon as the analysis managers have
+                    # acquired their machines.
+                    retry = True
 
             # Deal with errors.
             try:
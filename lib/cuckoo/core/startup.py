@@ -21,6 +21,8 @@ from lib.cuckoo.common.config import Config
 from lib.cuckoo.common.constants import CUCKOO_ROOT, CUCKOO_VERSION
 from lib.cuckoo.common.exceptions import CuckooStartupError
 from lib.cuckoo.common.exceptions import CuckooOperationalError
+from lib.cuckoo.common.exceptions import CuckooDependencyError
+from lib.cuckoo.common.exceptions import CuckooReportError
 from lib.cuckoo.common.utils import create_folders
 from lib.cuckoo.core.database import Database, TASK_RUNNING
 from lib.cuckoo.core.plugins import import_plugin, import_package, list_plugins
@@ -228,6 +230,34 @@ def init_modules():
             else:
                 log.debug("\t |-- %s", entry.__name__)
 
+    init_reporting()
+
+def init_reporting():
+    """Sets up the enabled reporting modules, once for all the analyses."""
+    cfg = Config("reporting")
+
+    for module in list_plugins(group="reporting"):
+        module_name = module.__module__.rsplit(".", 1)[-1]
+        try:
+            options = cfg.get(module_name)
+        except CuckooOperationalError:
+            continue
+
+        if not options.enabled:
+            continue
+
+        current = module()
+        current.set_options(options)
+
+        try:
+            current.setup()
+        except CuckooDependencyError as e:
+            log.warning("The reporting module \"%s\" has missing "
+                        "dependencies: %s", module.__name__, e)
+        except CuckooReportError as e:
+            raise CuckooStartupError("Unable to set up the reporting module "
+                                     "\"%s\": %s" % (module.__name__, e))
+
 def init_yara():
     """Generates index for yara signatures."""
 
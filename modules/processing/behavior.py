@@ -3,14 +3,22 @@
 # See the file 'docs/LICENSE' for copying permission.
 
 import os
+import time
+import cPickle
 import logging
 import datetime
+import itertools
+import multiprocessing
+from collections import deque
 
 from lib.cuckoo.common.abstracts import Processing
+from lib.cuckoo.common.callstore import CallStore, CallStoreWriter
+from lib.cuckoo.common.callstore import write_calls
 from lib.cuckoo.common.config import Config
-from lib.cuckoo.common.netlog import NetlogParser, BsonParser
+from lib.cuckoo.common.exceptions import CuckooOperationalError
+from lib.cuckoo.common.netlog import NetlogParser, BsonParser, ReadBuffer
 from lib.cuckoo.common.utils import convert_to_printable, logtime
-from lib.cuckoo.common.utils import cleanup_value
+from lib.cuckoo.common.utils import cleanup_value, create_folder
 
 log = logging.getLogger(__name__)
 
@@ -31,15 +39,177 @@ def fix_key(key):
 
     return res
 
+def compare_calls(a, b):
+    """Compare two calls for equality. Same implementation as before netlog.
+    @param a: call a
+    @param b: call b
+    @return: True if a == b else False
+    """
+    # Anomalies are never merged, they don't have the fields of a call.
+    if a["category"] == "anomaly" or b["category"] == "anomaly":
+        return False
+
+    if a["api"] == b["api"] and \
+            a["status"] == b["status"] and \
+            a["arguments"] == b["arguments"] and \
+            a["return"] == b["return"]:
+        return True
+    return False
+
+# Longest sequence of calls looked for when collapsing loops.
+LOOP_MAX_PERIOD = 8
+
+def collapse_loops(calls, max_period=LOOP_MAX_PERIOD):
+    """Collapse the loops of calls: when a sequence of calls is directly
+    followed by the same sequence, the calls of the repetitions are counted
+    in the "repeated" field of the first occurrence instead.
+    @param calls: iterable of calls, the repetitions of a single call
+                  already merged.
+    @param max_period: longest sequence of calls looked for.
+    @return: generator of calls.
+    """
+    pending = []
+    period, position = 0, 0
+
+    for call in calls:
+        # Within a loop, as long as the calls follow the sequence.
+        if period:
+            first = pending[len(pending) - period + position]
+            if compare_calls(first, call):
+                first["repeated"] += call["repeated"] + 1
+                position = (position + 1) % period
+                continue
+            period = 0
+
+        pending.append(call)
+
+        for length in xrange(2, min(max_period, len(pending) / 2) + 1):
+            if not compare_calls(pending[-1 - length], pending[-1]):
+                continue
+
+            if all(compare_calls(pending[-length - idx], pending[-idx])
+                   for idx in xrange(2, length + 1)):
+                for idx in xrange(1, length + 1):
+                    pending[-length - idx]["repeated"] += \
+                        pending[-idx]["repeated"] + 1
+                del pending[-length:]
+                period, position = length, 0
+                break
+
+        # Older calls can't be part of a loop anymore.
+        while len(pending) > 2 * max_period:
+            yield pending.pop(0)
+
+    for call in pending:
+        yield call
+
+def parse_row(row):
+    """Parse log row.
+    @param row: row data.
+    @return: parsed information dict.
+    """
+    call = {}
+    arguments = []
+
+    try:
+        timestamp = row[0]    # Timestamp of current API call invocation.
+        thread_id = row[1]    # Thread ID.
+        category = row[2]     # Win32 function category.
+        api_name = row[3]     # Name of the Windows API.
+        status_value = row[4] # Success or Failure?
+        return_value = row[5] # Value returned by the function.
+    except IndexError as e:
+        log.debug("Unable to parse process log row: %s", e)
+        return None
+
+    # Now walk through the remaining columns, which will contain API
+    # arguments.
+    for index in range(6, len(row)):
+        argument = {}
+
+        # Split the argument name with its value based on the separator.
+        try:
+            arg_name, arg_value = row[index]
+        except ValueError as e:
+            log.debug("Unable to parse analysis row argument (row=%s): %s", row[index], e)
+            continue
+
+        argument["name"] = arg_name
+
+        argument["value"] = convert_to_printable(cleanup_value(arg_value))
+        arguments.append(argument)
+
+    call["timestamp"] = timestamp
+    call["thread_id"] = str(thread_id)
+    call["category"] = category
+    call["api"] = api_name
+    call["status"] = bool(int(status_value))
+
+    if isinstance(return_value, int):
+        call["return"] = "0x%.08x" % return_value
+    else:
+        call["return"] = convert_to_printable(cleanup_value(return_value))
+
+    call["arguments"] = arguments
+    call["repeated"] = 0
+
+    return call
+
+def build_call(first_seen, context, apiname, category, arguments):
+    """Build the dictionary of a logged API call.
+    @param first_seen: datetime of the process creation.
+    @param context: call context, as given by the log parsers.
+    @param apiname: API name.
+    @param category: API category.
+    @param arguments: list of (name, value) arguments.
+    @return: call dict.
+    """
+    apiindex, status, returnval, tid, timediff = context
+
+    current_time = first_seen + datetime.timedelta(0, 0, timediff*1000)
+    timestring = logtime(current_time)
+
+    return parse_row([timestring,
+                      tid,
+                      category,
+                      apiname,
+                      status,
+                      returnval] + arguments)
+
+def build_anomaly(subcategory, tid, funcname, msg):
+    """@return: dict of a logged anomaly."""
+    return dict(thread_id=tid, category="anomaly", api="",
+                subcategory=subcategory, funcname=funcname, msg=msg)
+
 class ParseProcessLog(list):
-    """Parses process log file."""
+    """Parses process log file.
+
+    The log is parsed only once, the calls are written to a call store which
+    all the following iterations read from.
+    """
 
-    def __init__(self, log_path):
-        """@param log_path: log file path."""
+    def __init__(self, log_path, store_path=None, truncate=0):
+        """@param log_path: log file path.
+        @param store_path: call store path, by default in the "calls" folder
+                           next to the "logs" one.
+        @param truncate: if set, the log is truncated: only this many calls
+                         are kept at its head and at its tail, see
+                         truncate_calls().
+        """
         self._log_path = log_path
+        self.truncate = truncate
         self.fd = None
+        self.buffer = None
         self.parser = None
 
+        if store_path is None:
+            name = os.path.splitext(os.path.basename(log_path))[0]
+            store_path = os.path.join(os.path.dirname(os.path.dirname(log_path)),
+                                      "calls", name + ".calls")
+        self._store_path = store_path
+        self._store = None
+        self._iter = None
+
         self.process_id = None
         self.process_name = None
         self.parent_id = None
@@ -52,6 +222,7 @@ class ParseProcessLog(list):
 
     def parse_first_and_reset(self):
         self.fd = open(self._log_path, "rb")
+        self.buffer = ReadBuffer(self.fd.readinto)
 
         if self._log_path.endswith(".bson"):
             self.parser = BsonParser(self)
@@ -67,43 +238,163 @@ class ParseProcessLog(list):
         while not self.process_id:
             self.parser.read_next_message()
 
+        self.rewind()
+
+    def rewind(self):
+        """Go back to the start of the log."""
         self.fd.seek(0)
+        self.buffer.reset()
+        if isinstance(self.parser, BsonParser):
+            self.parser.batch.clear()
+        self.lastcall = None
 
     def read(self, length):
         if not length:
             return ''
-        buf = self.fd.read(length)
-        if not buf or len(buf) != length:
-            raise EOFError()
-        return buf
+        return self.buffer.read(length)
+
+    def open_store(self):
+        """Open the call store, writing it first if it doesn't exist yet, if
+        it's older than the log or if it's not truncated with the requested
+        limit.
+        @return: CallStore instance or None if it can't be written.
+        """
+        if self._store is not None or not self.fd:
+            return self._store or None
+
+        try:
+            if os.path.exists(self._store_path) and \
+                    os.stat(self._store_path).st_mtime >= \
+                    os.stat(self._log_path).st_mtime:
+                try:
+                    store = CallStore(self._store_path)
+                    # Reused as long as it's been truncated, or not, with
+                    # the requested limit.
+                    if store.meta.get("truncate") == self.truncate:
+                        self._store = store
+                        return self._store
+                    store.close()
+                except CuckooOperationalError as e:
+                    log.debug("Rebuilding call store: %s", e)
+
+            folder = os.path.dirname(self._store_path)
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+
+            meta = {"truncate": self.truncate}
+            if self.truncate:
+                write_calls(self._store_path, self.truncate_calls(meta), meta)
+            else:
+                write_calls(self._store_path, self.read_calls(), meta)
+            self._store = CallStore(self._store_path)
+        except (IOError, OSError, CuckooOperationalError) as e:
+            log.warning("Unable to write the call store %s, parsing the log "
+                        "at every iteration instead: %s", self._store_path, e)
+            self._store = False
+
+        return self._store or None
+
+    def read_calls(self):
+        """Parse the calls from the log, merging the repeated ones."""
+        self.rewind()
+
+        while self.wait_for_lastcall():
+            nextcall, self.lastcall = self.lastcall, None
+
+            self.wait_for_lastcall()
+            while self.lastcall and self.compare_calls(nextcall, self.lastcall):
+                nextcall["repeated"] += 1
+                self.lastcall = None
+                self.wait_for_lastcall()
+
+            yield nextcall
+
+    def truncate_calls(self, meta):
+        """Parse the calls from an oversized log. Loops of calls are
+        collapsed, then only the calls at the head and at the tail of the
+        log are kept. The calls of each API are counted over the whole log.
+        @param meta: dictionary the truncation information is added to.
+        """
+        counts = {}
+
+        def counted(calls):
+            for call in calls:
+                if call["category"] != "anomaly":
+                    counts[call["api"]] = \
+                        counts.get(call["api"], 0) + call["repeated"] + 1
+                yield call
+
+        kept, dropped = 0, 0
+        tail = deque(maxlen=self.truncate)
+        for call in collapse_loops(counted(self.read_calls())):
+            if kept < self.truncate:
+                kept += 1
+                yield call
+                continue
+
+            if len(tail) == self.truncate:
+                dropped += 1
+            tail.append(call)
+
+        for call in tail:
+            yield call
+
+        meta["truncated"] = {
+            "calls": sum(counts.itervalues()),
+            "dropped": dropped,
+            "apis": counts,
+        }
+
+    @property
+    def truncated(self):
+        """@return: truncation information of the log, None if it hasn't
+        been truncated."""
+        store = self.open_store()
+        if store:
+            return store.meta.get("truncated")
+        return None
 
     def __iter__(self):
-        #import inspect
-        #log.debug('iter called by this guy: {0}'.format(inspect.stack()[1]))
-        return self
+        if not self.fd:
+            return iter(())
+
+        store = self.open_store()
+        if store:
+            return iter(store)
+        if self.truncate:
+            return self.truncate_calls({})
+        return self.read_calls()
+
+    def __len__(self):
+        store = self.open_store()
+        if store:
+            return len(store)
+        return sum(1 for call in self)
+
+    def __getitem__(self, index):
+        store = self.open_store()
+        if not store:
+            return [call for call in self][index]
+
+        if isinstance(index, slice):
+            return [store[i] for i in xrange(*index.indices(len(store)))]
+        return store[index]
+
+    @property
+    def log_path(self):
+        return self._log_path
 
     def __repr__(self):
         return "<ParseProcessLog log-path: %r>" % self._log_path
 
     def __nonzero__(self):
-        return self.wait_for_lastcall()
+        return len(self) > 0
 
     def reset(self):
-        self.fd.seek(0)
-        self.lastcall = None
+        self._iter = None
 
     def compare_calls(self, a, b):
-        """Compare two calls for equality. Same implementation as before netlog.
-        @param a: call a
-        @param b: call b
-        @return: True if a == b else False
-        """
-        if a["api"] == b["api"] and \
-                a["status"] == b["status"] and \
-                a["arguments"] == b["arguments"] and \
-                a["return"] == b["return"]:
-            return True
-        return False
+        return compare_calls(a, b)
 
     def wait_for_lastcall(self):
         while not self.lastcall:
@@ -116,22 +407,14 @@ class ParseProcessLog(list):
         return True
 
     def next(self):
-        if not self.fd:
-            raise StopIteration()
+        if self._iter is None:
+            self._iter = iter(self)
 
-        if not self.wait_for_lastcall():
+        try:
+            return self._iter.next()
+        except StopIteration:
             self.reset()
-            raise StopIteration()
-
-        nextcall, self.lastcall = self.lastcall, None
-
-        self.wait_for_lastcall()
-        while self.lastcall and self.compare_calls(nextcall, self.lastcall):
-            nextcall["repeated"] += 1
-            self.lastcall = None
-            self.wait_for_lastcall()
-
-        return nextcall
+            raise
 
     def log_process(self, context, timestring, pid, ppid, modulepath, procname):
         self.process_id, self.parent_id, self.process_name = pid, ppid, procname
@@ -141,77 +424,42 @@ class ParseProcessLog(list):
         pass
 
     def log_anomaly(self, subcategory, tid, funcname, msg):
-        self.lastcall = dict(thread_id=tid, category="anomaly", api="",
-                             subcategory=subcategory, funcname=funcname,
-                             msg=msg)
+        self.lastcall = build_anomaly(subcategory, tid, funcname, msg)
 
     def log_call(self, context, apiname, category, arguments):
-        apiindex, status, returnval, tid, timediff = context
-
-        current_time = self.first_seen + datetime.timedelta(0, 0, timediff*1000)
-        timestring = logtime(current_time)
-
-        self.lastcall = self._parse([timestring,
-                                     tid,
-                                     category,
-                                     apiname,
-                                     status,
-                                     returnval] + arguments)
+        self.lastcall = build_call(self.first_seen, context, apiname,
+                                   category, arguments)
 
     def log_error(self, emsg):
         log.warning("ParseProcessLog error condition on log %s: %s", str(self._log_path), emsg)
 
     def _parse(self, row):
-        """Parse log row.
-        @param row: row data.
-        @return: parsed information dict.
-        """
-        call = {}
-        arguments = []
-
-        try:
-            timestamp = row[0]    # Timestamp of current API call invocation.
-            thread_id = row[1]    # Thread ID.
-            category = row[2]     # Win32 function category.
-            api_name = row[3]     # Name of the Windows API.
-            status_value = row[4] # Success or Failure?
-            return_value = row[5] # Value returned by the function.
-        except IndexError as e:
-            log.debug("Unable to parse process log row: %s", e)
-            return None
-
-        # Now walk through the remaining columns, which will contain API
-        # arguments.
-        for index in range(6, len(row)):
-            argument = {}
-
-            # Split the argument name with its value based on the separator.
-            try:
-                arg_name, arg_value = row[index]
-            except ValueError as e:
-                log.debug("Unable to parse analysis row argument (row=%s): %s", row[index], e)
-                continue
-
-            argument["name"] = arg_name
-
-            argument["value"] = convert_to_printable(cleanup_value(arg_value))
-            arguments.append(argument)
-
-        call["timestamp"] = timestamp
-        call["thread_id"] = str(thread_id)
-        call["category"] = category
-        call["api"] = api_name
-        call["status"] = bool(int(status_value))
+        return parse_row(row)
+
+def process_log(file_path, truncate=0):
+    """Open the log of a process.
+    @param file_path: log file path.
+    @param truncate: number of calls kept at the head and at the tail of the
+                     log, if it has to be truncated.
+    @return: process dict or None if the log doesn't contain any process.
+    """
+    # Invoke parsing of current log file.
+    current_log = ParseProcessLog(file_path, truncate=truncate)
+    if current_log.process_id is None:
+        return None
 
-        if isinstance(return_value, int):
-            call["return"] = "0x%.08x" % return_value
-        else:
-            call["return"] = convert_to_printable(cleanup_value(return_value))
+    process = {
+        "process_id": current_log.process_id,
+        "process_name": current_log.process_name,
+        "parent_id": current_log.parent_id,
+        "first_seen": logtime(current_log.first_seen),
+        "calls": current_log.calls,
+    }
 
-        call["arguments"] = arguments
-        call["repeated"] = 0
+    if truncate and current_log.truncated:
+        process["truncated"] = current_log.truncated
 
-        return call
+    return process
 
 class Processes:
     """Processes analyzer."""
@@ -219,21 +467,27 @@ class Processes:
     def __init__(self, logs_path):
         """@param  logs_path: logs path."""
         self._logs_path = logs_path
+        self._paths = None
         self.cfg = Config()
 
-    def run(self):
-        """Run analysis.
-        @return: processes infomartion list.
+    def log_paths(self):
+        """Get the logs to process. The ones too big are truncated, or left
+        out if processing.truncate_calls is disabled.
+        @return: list of (log file path, calls to keep at the head and at the
+                 tail of the log, 0 to keep them all) tuples.
         """
-        results = []
+        if self._paths is not None:
+            return self._paths
+
+        self._paths = []
 
         if not os.path.exists(self._logs_path):
             log.warning("Analysis results folder does not exist at path \"%s\".", self._logs_path)
-            return results
+            return self._paths
 
         if len(os.listdir(self._logs_path)) == 0:
             log.warning("Analysis results folder does not contain any file.")
-            return results
+            return self._paths
 
         for file_name in os.listdir(self._logs_path):
             file_path = os.path.join(self._logs_path, file_name)
@@ -241,25 +495,35 @@ class Processes:
             if os.path.isdir(file_path):
                 continue
 
-            # Skipping the current log file if it's too big.
+            # Truncating the current log file if it's too big, or skipping
+            # it altogether.
+            truncate = 0
             if os.stat(file_path).st_size > self.cfg.processing.analysis_size_limit:
-                log.warning("Behavioral log {0} too big to be processed, skipped.".format(file_name))
-                continue
+                truncate = self.cfg.processing.truncate_calls
+                if not truncate:
+                    log.warning("Behavioral log {0} too big to be processed, skipped.".format(file_name))
+                    continue
 
-            # Invoke parsing of current log file.
-            current_log = ParseProcessLog(file_path)
-            if current_log.process_id is None:
-                continue
+                log.info("Behavioral log %s too big to be processed entirely, "
+                         "truncated.", file_name)
+
+            self._paths.append((file_path, truncate))
+
+        return self._paths
+
+    def run(self):
+        """Run analysis.
+        @return: processes infomartion list.
+        """
+        results = []
+
+        for file_path, truncate in self.log_paths():
+            process = process_log(file_path, truncate)
 
             # If the current log actually contains any data, add its data to
             # the results list.
-            results.append({
-                "process_id": current_log.process_id,
-                "process_name": current_log.process_name,
-                "parent_id": current_log.parent_id,
-                "first_seen": logtime(current_log.first_seen),
-                "calls": current_log.calls,
-            })
+            if process:
+                results.append(process)
 
         # Sort the items in the results list chronologically. In this way we
         # can have a sequential order of spawned processes.
@@ -267,21 +531,50 @@ class Processes:
 
         return results
 
+class OrderedSet(object):
+    """Set which keeps the order its values were added in."""
+
+    def __init__(self, values=()):
+        self.values = []
+        self.index = set()
+        for value in values:
+            self.add(value)
+
+    def add(self, value):
+        if value not in self.index:
+            self.index.add(value)
+            self.values.append(value)
+
+    def __contains__(self, value):
+        return value in self.index
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __len__(self):
+        return len(self.values)
+
 class Summary:
     """Generates summary information."""
 
     key = "summary"
+    filter_apinames = set([
+        "RegOpenKeyExA", "RegOpenKeyExW", "RegCreateKeyExA", "RegCreateKeyExW",
+        "NtOpenKey", "NtOpenKeyEx", "NtDeleteValueKey", "RegCloseKey",
+    ])
+    filter_categories = set(["filesystem", "synchronization"])
 
     def __init__(self):
-        self.keys = []
-        self.mutexes = []
-        self.files = []
-        self.handles = []
+        self.keys = OrderedSet()
+        self.mutexes = OrderedSet()
+        self.files = OrderedSet()
+        # Name of the open keys by handle, the handle 0 is kept for the last
+        # key opened without any.
+        self.handles = {}
 
     def _check_registry(self, registry, subkey, handle):
-        for known_handle in self.handles:
-            if handle != 0 and handle == known_handle["handle"]:
-                return None
+        if handle != 0 and handle in self.handles:
+            return None
 
         name = ""
 
@@ -299,13 +592,11 @@ class Summary:
             name = "HKEY_CURRENT_CONFIG\\"
         elif registry == 0x80000006:
             name = "HKEY_DYN_DATA\\"
-        else:
-            for known_handle in self.handles:
-                if registry == known_handle["handle"]:
-                    name = known_handle["name"] + "\\"
+        elif registry in self.handles:
+            name = self.handles[registry] + "\\"
 
         key = fix_key(name + subkey)
-        self.handles.append({"handle": handle, "name": key})
+        self.handles[handle] = key
         return key
 
     def event_apicall(self, call, process):
@@ -313,7 +604,9 @@ class Summary:
         @return: None.
         """
 
-        if call["api"].startswith("RegOpenKeyEx") or call["api"].startswith("RegCreateKeyEx"):
+        api = call["api"]
+
+        if api in ("RegOpenKeyExA", "RegOpenKeyExW", "RegCreateKeyExA", "RegCreateKeyExW"):
             registry = 0
             subkey = ""
             handle = 0
@@ -327,9 +620,9 @@ class Summary:
                     handle = int(argument["value"], 16)
 
             name = self._check_registry(registry, subkey, handle)
-            if name and name not in self.keys:
-                self.keys.append(name)
-        elif call["api"].startswith("NtOpenKey"):
+            if name:
+                self.keys.add(name)
+        elif api in ("NtOpenKey", "NtOpenKeyEx"):
             registry = -1
             subkey = ""
             handle = 0
@@ -341,9 +634,9 @@ class Summary:
                     handle = int(argument["value"], 16)
 
             name = self._check_registry(registry, subkey, handle)
-            if name and name not in self.keys:
-                self.keys.append(name)
-        elif call["api"].startswith("NtDeleteValueKey"):
+            if name:
+                self.keys.add(name)
+        elif api == "NtDeleteValueKey":
             registry = -1
             subkey = ""
             handle = 0
@@ -355,9 +648,9 @@ class Summary:
                     handle = int(argument["value"], 16)
 
             name = self._check_registry(registry, subkey, handle)
-            if name and name not in self.keys:
-                self.keys.append(name)
-        elif call["api"].startswith("RegCloseKey"):
+            if name:
+                self.keys.add(name)
+        elif api == "RegCloseKey":
             handle = 0
 
             for argument in call["arguments"]:
@@ -365,12 +658,7 @@ class Summary:
                     handle = int(argument["value"], 16)
 
             if handle != 0:
-                for a in self.handles:
-                    if a["handle"] == handle:
-                        try:
-                            self.handles.remove(a)
-                        except ValueError:
-                            pass
+                self.handles.pop(handle, None)
 
         elif call["category"] == "filesystem":
             for argument in call["arguments"]:
@@ -379,8 +667,7 @@ class Summary:
                     if not value:
                         continue
 
-                    if value not in self.files:
-                        self.files.append(value)
+                    self.files.add(value)
 
         elif call["category"] == "synchronization":
             for argument in call["arguments"]:
@@ -389,19 +676,256 @@ class Summary:
                     if not value:
                         continue
 
-                    if value not in self.mutexes:
-                        self.mutexes.append(value)
+                    self.mutexes.add(value)
+
+    def merge(self, other):
+        """Add the results of a following process.
+        @param other: Summary of the other process.
+        """
+        for values, others in ((self.files, other.files),
+                               (self.keys, other.keys),
+                               (self.mutexes, other.mutexes)):
+            for value in others:
+                values.add(value)
 
     def run(self):
         """Get registry keys, mutexes and files.
         @return: Summary of keys, mutexes and files.
         """
-        return {"files": self.files, "keys": self.keys, "mutexes": self.mutexes}
+        return {"files": list(self.files), "keys": list(self.keys),
+                "mutexes": list(self.mutexes)}
+
+ENHANCED_EVENTS = [
+    {
+        "event": "move",
+        "object": "file",
+        "apis": [
+            "MoveFileWithProgressW",
+            "MoveFileExA",
+            "MoveFileExW"
+        ],
+        "args": [
+            ("from", "ExistingFileName"),
+            ("to", "NewFileName")
+        ]
+    },
+    {
+        "event": "copy",
+        "object": "file",
+        "apis": [
+            "CopyFileA",
+            "CopyFileW",
+            "CopyFileExW",
+            "CopyFileExA"
+        ],
+        "args": [
+            ("from", "ExistingFileName"),
+            ("to", "NewFileName")
+        ]
+    },
+    {
+        "event": "delete",
+        "object": "file",
+        "apis": [
+            "DeleteFileA",
+            "DeleteFileW",
+            "NtDeleteFile"
+        ],
+        "args": [("file", "FileName")]
+    },
+    {
+        "event": "delete",
+        "object": "dir",
+        "apis": [
+            "RemoveDirectoryA",
+            "RemoveDirectoryW"
+        ],
+        "args": [("file", "DirectoryName")]
+    },
+    {
+        "event": "create",
+        "object": "dir",
+        "apis": [
+            "CreateDirectoryW",
+            "CreateDirectoryExW"
+        ],
+        "args": [("file", "DirectoryName")]
+    },
+    {
+        "event": "write",
+        "object": "file",
+        "apis": [
+            "URLDownloadToFileW",
+            "URLDownloadToFileA"
+        ],
+        "args": [("file", "FileName")]
+    },
+    {
+        "event": "execute",
+        "object": "file",
+        "apis": [
+            "CreateProcessAsUserA",
+            "CreateProcessAsUserW",
+            "CreateProcessA",
+            "CreateProcessW",
+            "NtCreateProcess",
+            "NtCreateProcessEx"
+        ],
+        "args": [("file", "FileName")]
+    },
+    {
+        "event": "execute",
+        "object": "file",
+        "apis": [
+            "CreateProcessInternalW",
+        ],
+        "args": [("file", "CommandLine")]
+    },
+    {
+        "event": "execute",
+        "object": "file",
+        "apis": [
+            "ShellExecuteExA",
+            "ShellExecuteExW",
+        ],
+        "args": [("file", "FilePath")]
+    },
+    {
+        "event": "load",
+        "object": "library",
+        "apis": [
+            "LoadLibraryA",
+            "LoadLibraryW",
+            "LoadLibraryExA",
+            "LoadLibraryExW",
+            "LdrLoadDll",
+            "LdrGetDllHandle"
+        ],
+        "args": [
+            ("file", "FileName"),
+            ("pathtofile", "PathToFile"),
+            ("moduleaddress", "BaseAddress")
+        ]
+    },
+    {
+        "event": "findwindow",
+        "object": "windowname",
+        "apis": [
+            "FindWindowA",
+            "FindWindowW",
+            "FindWindowExA",
+            "FindWindowExW"
+        ],
+        "args": [
+            ("classname", "ClassName"),
+            ("windowname", "WindowName")
+        ]
+    },
+    {
+        "event": "read",
+        "object": "file",
+        "apis": [
+            "NtReadFile",
+            "ReadFile"
+        ],
+        "args": []
+    },
+    {
+        "event": "write",
+        "object": "file",
+        "apis": ["NtWriteFile"],
+        "args": []
+    },
+    {
+        "event": "delete",
+        "object": "registry",
+        "apis": [
+            "RegDeleteKeyA",
+            "RegDeleteKeyW"
+        ],
+        "args": []
+    },
+    {
+        "event": "write",
+        "object": "registry",
+        "apis": [
+            "RegSetValueExA",
+            "RegSetValueExW"
+        ],
+        "args": [
+            ("content", "Buffer"),
+            ("object", "object")
+        ]
+    },
+    {
+        "event": "read",
+        "object": "registry",
+        "apis": [
+            "RegQueryValueExA",
+            "RegQueryValueExW",
+            "NtQueryValueKey"
+        ],
+        "args": []
+    },
+    {
+        "event": "delete",
+        "object": "registry",
+        "apis": [
+            "RegDeleteValueA",
+            "RegDeleteValueW",
+            "NtDeleteValueKey"
+        ],
+        "args": []
+    },
+    {
+        "event": "create",
+        "object": "windowshook",
+        "apis": ["SetWindowsHookExA"],
+        "args": [
+            ("id", "HookIdentifier"),
+            ("moduleaddress", "ModuleAddress"),
+            ("procedureaddress", "ProcedureAddress")
+        ]
+    },
+    {
+        "event": "modify",
+        "object": "service",
+        "apis": ["ControlService"],
+        "args": [("controlcode", "ControlCode")]
+    },
+    {
+        "event": "delete",
+        "object": "service",
+        "apis": ["DeleteService"],
+        "args": [],
+    },
+]
+
+# Not sure I really want this, way too noisy anyway and doesn't bring
+# much value.
+#if self.details:
+#    ENHANCED_EVENTS = ENHANCED_EVENTS + [{"event" : "get",
+#           "object" : "procedure",
+#           "apis" : ["LdrGetProcedureAddress"],
+#           "args": [("name", "FunctionName"), ("ordinal", "Ordinal")]
+#          },]
+
+# Generic event of each API, looked up instead of walking the list above.
+# The first event listing an API wins.
+ENHANCED_APIS = dict((api, item) for item in reversed(ENHANCED_EVENTS)
+                     for api in item["apis"])
 
 class Enhanced(object):
     """Generates a more extensive high-level representation than Summary."""
 
     key = "enhanced"
+    filter_apinames = set(ENHANCED_APIS) | set([
+        "SetCurrentDirectoryA", "SetCurrentDirectoryW",
+        "NtCreateFile", "NtOpenFile", "CreateFileW", "NtClose", "CloseHandle",
+        "OpenServiceW",
+        "RegOpenKeyExA", "RegOpenKeyExW", "RegCreateKeyExA", "RegCreateKeyExW",
+        "NtOpenKey", "RegCloseKey",
+    ])
 
     def __init__(self, details=False):
         """
@@ -476,296 +1000,61 @@ class Enhanced(object):
     def _get_keyhandle(self, handle):
         return self.keyhandles.get(handle, "")
 
-    def _process_call(self, call):
-        """ Gets files calls
-        @return: information list
+    def _load_args(self, call):
         """
-        def _load_args(call):
-            """
-            Load arguments from call
-            """
-            res = {}
-            for argument in call["arguments"]:
-                res[argument["name"]] = argument["value"]
-
-            return res
-
-        def _generic_handle_details(self, call, item):
-            """
-            Generic handling of api calls
-            @call: the call dict
-            @item: Generic item to process
-            """
-            event = None
-            if call["api"] in item["apis"]:
-                args = _load_args(call)
-                self.eid += 1
-
-                event = {
-                    "event": item["event"],
-                    "object": item["object"],
-                    "timestamp": call["timestamp"],
-                    "eid": self.eid,
-                    "data": {}
-                }
-
-                for logname, dataname in item["args"]:
-                    event["data"][logname] = args.get(dataname)
-                return event
-
-        def _generic_handle(self, data, call):
-            """Generic handling of api calls."""
-            for item in data:
-                event = _generic_handle_details(self, call, item)
-                if event:
-                    return event
+        Load arguments from call
+        """
+        res = {}
+        for argument in call["arguments"]:
+            res[argument["name"]] = argument["value"]
+
+        return res
 
+    def _generic_event(self, call, args):
+        """
+        Generic handling of api calls
+        @call: the call dict
+        @args: arguments of the call
+        @return: the event, None if the api has no generic handling
+        """
+        item = ENHANCED_APIS.get(call["api"])
+        if not item:
             return None
 
-        # Generic handles
-        def _add_handle(handles, handle, filename):
-            handles[handle] = filename
-
-        def _remove_handle(handles, handle):
-            if handle in handles:
-                handles.pop(handle)
-
-        def _get_handle(handles, handle):
-            return handles.get(handle)
-
-        def _get_service_action(control_code):
-            """@see: http://msdn.microsoft.com/en-us/library/windows/desktop/ms682108%28v=vs.85%29.aspx"""
-            codes = {1: "stop",
-                     2: "pause",
-                     3: "continue",
-                     4: "info"}
-
-            default = "user" if control_code >= 128 else "notify"
-            return codes.get(control_code, default)
-
-        event = None
-
-        gendat = [
-            {
-                "event": "move",
-                "object": "file",
-                "apis": [
-                    "MoveFileWithProgressW",
-                    "MoveFileExA",
-                    "MoveFileExW"
-                ],
-                "args": [
-                    ("from", "ExistingFileName"),
-                    ("to", "NewFileName")
-                ]
-            },
-            {
-                "event": "copy",
-                "object": "file",
-                "apis": [
-                    "CopyFileA",
-                    "CopyFileW",
-                    "CopyFileExW",
-                    "CopyFileExA"
-                ],
-                "args": [
-                    ("from", "ExistingFileName"),
-                    ("to", "NewFileName")
-                ]
-            },
-            {
-                "event": "delete",
-                "object": "file",
-                "apis": [
-                    "DeleteFileA",
-                    "DeleteFileW",
-                    "NtDeleteFile"
-                ],
-                "args": [("file", "FileName")]
-            },
-            {
-                "event": "delete",
-                "object": "dir",
-                "apis": [
-                    "RemoveDirectoryA",
-                    "RemoveDirectoryW"
-                ],
-                "args": [("file", "DirectoryName")]
-            },
-            {
-                "event": "create",
-                "object": "dir",
-                "apis": [
-                    "CreateDirectoryW",
-                    "CreateDirectoryExW"
-                ],
-                "args": [("file", "DirectoryName")]
-            },
-            {
-                "event": "write",
-                "object": "file",
-                "apis": [
-                    "URLDownloadToFileW",
-                    "URLDownloadToFileA"
-                ],
-                "args": [("file", "FileName")]
-            },
-            {
-                "event": "execute",
-                "object": "file",
-                "apis": [
-                    "CreateProcessAsUserA",
-                    "CreateProcessAsUserW",
-                    "CreateProcessA",
-                    "CreateProcessW",
-                    "NtCreateProcess",
-                    "NtCreateProcessEx"
-                ],
-                "args": [("file", "FileName")]
-            },
-            {
-                "event": "execute",
-                "object": "file",
-                "apis": [
-                    "CreateProcessInternalW",
-                ],
-                "args": [("file", "CommandLine")]
-            },
-            {
-                "event": "execute",
-                "object": "file",
-                "apis": [
-                    "ShellExecuteExA",
-                    "ShellExecuteExW",
-                ],
-                "args": [("file", "FilePath")]
-            },
-            {
-                "event": "load",
-                "object": "library",
-                "apis": [
-                    "LoadLibraryA",
-                    "LoadLibraryW",
-                    "LoadLibraryExA",
-                    "LoadLibraryExW",
-                    "LdrLoadDll",
-                    "LdrGetDllHandle"
-                ],
-                "args": [
-                    ("file", "FileName"),
-                    ("pathtofile", "PathToFile"),
-                    ("moduleaddress", "BaseAddress")
-                ]
-            },
-            {
-                "event": "findwindow",
-                "object": "windowname",
-                "apis": [
-                    "FindWindowA",
-                    "FindWindowW",
-                    "FindWindowExA",
-                    "FindWindowExW"
-                ],
-                "args": [
-                    ("classname", "ClassName"),
-                    ("windowname", "WindowName")
-                ]
-            },
-            {
-                "event": "read",
-                "object": "file",
-                "apis": [
-                    "NtReadFile",
-                    "ReadFile"
-                ],
-                "args": []
-            },
-            {
-                "event": "write",
-                "object": "file",
-                "apis": ["NtWriteFile"],
-                "args": []
-            },
-            {
-                "event": "delete",
-                "object": "registry",
-                "apis": [
-                    "RegDeleteKeyA",
-                    "RegDeleteKeyW"
-                ],
-                "args": []
-            },
-            {
-                "event": "write",
-                "object": "registry",
-                "apis": [
-                    "RegSetValueExA",
-                    "RegSetValueExW"
-                ],
-                "args": [
-                    ("content", "Buffer"),
-                    ("object", "object")
-                ]
-            },
-            {
-                "event": "read",
-                "object": "registry",
-                "apis": [
-                    "RegQueryValueExA",
-                    "RegQueryValueExW",
-                    "NtQueryValueKey"
-                ],
-                "args": []
-            },
-            {
-                "event": "delete",
-                "object": "registry",
-                "apis": [
-                    "RegDeleteValueA",
-                    "RegDeleteValueW",
-                    "NtDeleteValueKey"
-                ],
-                "args": []
-            },
-            {
-                "event": "create",
-                "object": "windowshook",
-                "apis": ["SetWindowsHookExA"],
-                "args": [
-                    ("id", "HookIdentifier"),
-                    ("moduleaddress", "ModuleAddress"),
-                    ("procedureaddress", "ProcedureAddress")
-                ]
-            },
-            {
-                "event": "modify",
-                "object": "service",
-                "apis": ["ControlService"],
-                "args": [("controlcode", "ControlCode")]
-            },
-            {
-                "event": "delete",
-                "object": "service",
-                "apis": ["DeleteService"],
-                "args": [],
-            },
-        ]
+        self.eid += 1
+
+        event = {
+            "event": item["event"],
+            "object": item["object"],
+            "timestamp": call["timestamp"],
+            "eid": self.eid,
+            "data": {}
+        }
+
+        for logname, dataname in item["args"]:
+            event["data"][logname] = args.get(dataname)
+        return event
 
-        # Not sure I really want this, way too noisy anyway and doesn't bring
-        # much value.
-        #if self.details:
-        #    gendata = gendata + [{"event" : "get",
-        #           "object" : "procedure",
-        #           "apis" : ["LdrGetProcedureAddress"],
-        #           "args": [("name", "FunctionName"), ("ordinal", "Ordinal")]
-        #          },]
+    def _get_service_action(self, control_code):
+        """@see: http://msdn.microsoft.com/en-us/library/windows/desktop/ms682108%28v=vs.85%29.aspx"""
+        codes = {1: "stop",
+                 2: "pause",
+                 3: "continue",
+                 4: "info"}
 
-        event = _generic_handle(self, gendat, call)
-        args = _load_args(call)
+        default = "user" if control_code >= 128 else "notify"
+        return codes.get(control_code, default)
+
+    def _process_call(self, call):
+        """ Gets files calls
+        @return: information list
+        """
+        args = self._load_args(call)
+        event = self._generic_event(call, args)
 
         if event:
             if call["api"] in ["NtReadFile", "ReadFile", "NtWriteFile"]:
-                event["data"]["file"] = _get_handle(self.filehandles, args["FileHandle"])
+                event["data"]["file"] = self.filehandles.get(args["FileHandle"])
 
             elif call["api"] in ["RegDeleteKeyA", "RegDeleteKeyW"]:
                 event["data"]["regkey"] = "{0}{1}".format(self._get_keyhandle(args.get("Handle", "")), args.get("SubKey", ""))
@@ -793,10 +1082,10 @@ class Enhanced(object):
                 event["data"]["module"] = self._get_loaded_module(args.get("ModuleAddress", ""))
 
             if call["api"] in ["ControlService", "DeleteService"]:
-                event["data"]["service"] = _get_handle(self.servicehandles, args["ServiceHandle"])
+                event["data"]["service"] = self.servicehandles.get(args["ServiceHandle"])
 
             if call["api"] in ["ControlService"]:
-                event["data"]["action"] = _get_service_action(args["ControlCode"])
+                event["data"]["action"] = self._get_service_action(args["ControlCode"])
 
             return event
 
@@ -805,17 +1094,17 @@ class Enhanced(object):
 
         # Files
         elif call["api"] in ["NtCreateFile", "NtOpenFile"]:
-            _add_handle(self.filehandles, args["FileHandle"], args["FileName"])
+            self.filehandles[args["FileHandle"]] = args["FileName"]
 
         elif call["api"] in ["CreateFileW"]:
-            _add_handle(self.filehandles, call["return"], args["FileName"])
+            self.filehandles[call["return"]] = args["FileName"]
 
         elif call["api"] in ["NtClose", "CloseHandle"]:
-            _remove_handle(self.filehandles, args["Handle"])
+            self.filehandles.pop(args["Handle"], None)
 
         # Services
         elif call["api"] in ["OpenServiceW"]:
-            _add_handle(self.servicehandles, call["return"], args["ServiceName"])
+            self.servicehandles[call["return"]] = args["ServiceName"]
 
         # Registry
         elif call["api"] in ["RegOpenKeyExA", "RegOpenKeyExW", "RegCreateKeyExA", "RegCreateKeyExW"]:
@@ -837,6 +1126,15 @@ class Enhanced(object):
         if event:
             self.events.append(event)
 
+    def merge(self, other):
+        """Add the events of a following process, numbered after ours.
+        @param other: Enhanced instance of the other process.
+        """
+        for event in other.events:
+            self.eid += 1
+            event["eid"] = self.eid
+            self.events.append(event)
+
     def run(self):
         """Get registry keys, mutexes and files.
         @return: Summary of keys, mutexes and files.
@@ -850,6 +1148,7 @@ class Anomaly(object):
     """
 
     key = "anomaly"
+    filter_categories = set(["anomaly"])
 
     def __init__(self):
         self.anomalies = []
@@ -879,6 +1178,10 @@ class Anomaly(object):
             message=message,
         ))
 
+    def merge(self, other):
+        """Add the anomalies of a following process."""
+        self.anomalies.extend(other.anomalies)
+
     def run(self):
         """Fetch all anomalies."""
         return self.anomalies
@@ -891,98 +1194,398 @@ class ProcessTree:
 
     def __init__(self):
         self.processes = []
+        self.pids = {}
         self.tree = []
 
-    def add_node(self, node, tree):
-        """Add a node to a process tree.
-        @param node: node to add.
-        @param tree: processes tree.
-        @return: boolean with operation success status.
-        """
-        # Walk through the existing tree.
-        for process in tree:
-            # If the current process has the same ID of the parent process of
-            # the provided one, append it the children.
-            if process["pid"] == node["parent_id"]:
-                process["children"].append(node)
-            # Otherwise try with the children of the current process.
-            else:
-                self.add_node(node, process["children"])
+    def add_process(self, entry):
+        """Add a process to the list, unless it's already there.
+        @param entry: process tree node.
+        """
+        if entry["pid"] not in self.pids:
+            self.pids[entry["pid"]] = entry
+            self.processes.append(entry)
 
     def event_apicall(self, call, process):
-        for entry in self.processes:
-            if entry["pid"] == process["process_id"]:
-                return
+        if process["process_id"] in self.pids:
+            return
 
-        self.processes.append(dict(
+        self.add_process(dict(
             name=process["process_name"],
             pid=process["process_id"],
             parent_id=process["parent_id"],
             children=[]
         ))
 
+    def merge(self, other):
+        """Add the processes seen by another instance."""
+        for process in other.processes:
+            self.add_process(process)
+
     def run(self):
         children = []
 
-        # Walk through the generated list of processes.
+        # The processes whose parent isn't known are the roots of the tree,
+        # the other ones are children.
         for process in self.processes:
-            has_parent = False
-            # Walk through the list again.
-            for process_again in self.processes:
-                # If we find a parent for the first process, we mark it as
-                # as a child.
-                if process_again["pid"] == process["parent_id"]:
-                    has_parent = True
-
-            # If the process has a parent, add it to the children list.
-            if has_parent:
+            if process["parent_id"] in self.pids:
                 children.append(process)
-            # Otherwise it's an orphan and we add it to the tree root.
             else:
                 self.tree.append(process)
 
-        # Now we loop over the remaining child processes.
+        # Attach the children in order, as long as their parent is already
+        # part of the tree.
+        attached = set(process["pid"] for process in self.tree)
         for process in children:
-            self.add_node(process, self.tree)
+            if process["parent_id"] in attached:
+                self.pids[process["parent_id"]]["children"].append(process)
+                attached.add(process["pid"])
 
         return self.tree
 
+# Partial behaviors, computed for every process on its own and merged in
+# the order the processes were created.
+PARTIAL_BEHAVIORS = Anomaly, ProcessTree, Summary, Enhanced
+
+class CallRouter(object):
+    """Dispatch table of the calls to the partial behaviors.
+
+    Just like the evented signatures, partial behaviors declare the API
+    names and categories they're interested in through their
+    filter_apinames and filter_categories attributes, they're only given
+    the calls matching either of them. Those without any filter are given
+    all the calls.
+    """
+
+    def __init__(self, classes):
+        """@param classes: partial behavior classes."""
+        self.apis = {}
+        self.categories = {}
+        self.everything = []
+        self.routes = {}
+
+        for index, cls in enumerate(classes):
+            apinames = getattr(cls, "filter_apinames", None)
+            categories = getattr(cls, "filter_categories", None)
+            if not apinames and not categories:
+                self.everything.append(index)
+                continue
+
+            for api in apinames or ():
+                self.apis.setdefault(api, []).append(index)
+            for category in categories or ():
+                self.categories.setdefault(category, []).append(index)
+
+    def route(self, api, category):
+        """@return: indexes of the partial behaviors interested in a call,
+        in the order they were given."""
+        try:
+            return self.routes[api, category]
+        except KeyError:
+            indexes = set(self.everything)
+            indexes.update(self.apis.get(api, ()))
+            indexes.update(self.categories.get(category, ()))
+            route = self.routes[api, category] = tuple(sorted(indexes))
+            return route
+
+ROUTER = CallRouter(PARTIAL_BEHAVIORS)
+
+# Seconds between two checkpoints of a process processed live.
+CHECKPOINT_INTERVAL = 60
+
+def checkpoint_path(analysis_path, pid):
+    """@return: path of the behavior checkpoint of a process."""
+    return os.path.join(analysis_path, "calls", "%s.checkpoint" % pid)
+
+class ProcessBehavior(object):
+    """Partial behaviors of a single process, updated one call at a time.
+
+    The state can be saved to a checkpoint, along with the number of calls
+    it has been fed with, and fed with the following calls once restored.
+    """
+
+    def __init__(self, process):
+        """@param process: process information dict, without the calls."""
+        self.process = process
+        self.instances = [cls() for cls in PARTIAL_BEHAVIORS]
+        self.count = 0
+        self.complete = False
+
+    def event_apicall(self, call):
+        """Feed a call to the partial behaviors.
+        @param call: call dict.
+        """
+        for index in ROUTER.route(call["api"], call["category"]):
+            instance = self.instances[index]
+            try:
+                instance.event_apicall(call, self.process)
+            except:
+                log.exception("Failure in partial behavior \"%s\"", instance.key)
+
+        self.count += 1
+
+    def merge(self, other):
+        """Add the partial behaviors of a process created after this one.
+        @param other: ProcessBehavior instance.
+        """
+        for instance, partial in zip(self.instances, other.instances):
+            try:
+                instance.merge(partial)
+            except:
+                log.exception("Failed to merge partial behavior \"%s\"", instance.key)
+
+    def save(self, path):
+        """Write a checkpoint.
+        @param path: checkpoint path.
+        """
+        tmppath = path + ".tmp"
+        with open(tmppath, "wb") as f:
+            cPickle.dump(self, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmppath, path)
+
+    @staticmethod
+    def load(path):
+        """Restore a checkpoint.
+        @param path: checkpoint path.
+        @return: ProcessBehavior instance or None if it can't be restored.
+        """
+        try:
+            with open(path, "rb") as f:
+                state = cPickle.load(f)
+        except Exception as e:
+            log.warning("Unable to restore the behavior checkpoint %s: %s", path, e)
+            return None
+
+        if not isinstance(state, ProcessBehavior):
+            return None
+        return state
+
+class LiveBehavior(object):
+    """Processes the behavior of a process while its log is being received.
+
+    Fed by the ResultServer, the calls are merged and written to the call
+    store just as ParseProcessLog would and the state of the partial
+    behaviors is regularly checkpointed. Once the analysis is over,
+    BehaviorAnalysis only has to merge the processes.
+    """
+
+    def __init__(self, analysis_path, pid, ppid, procname, first_seen):
+        """@param analysis_path: analysis folder path.
+        @param pid: process id.
+        @param ppid: parent process id.
+        @param procname: process name.
+        @param first_seen: datetime of the process creation.
+        @raise CuckooOperationalError: if the calls folder can't be created.
+        """
+        create_folder(analysis_path, "calls")
+
+        self.first_seen = first_seen
+        self.lastcall = None
+        self.state = ProcessBehavior(dict(process_id=pid,
+                                          process_name=procname,
+                                          parent_id=ppid,
+                                          first_seen=logtime(first_seen)))
+        self.path = checkpoint_path(analysis_path, pid)
+        self.checkpoint_time = time.time()
+        # Written in full, as ParseProcessLog does for the logs that don't
+        # have to be truncated.
+        self.writer = CallStoreWriter(os.path.join(analysis_path, "calls",
+                                                   "%s.calls" % pid),
+                                      meta={"truncate": 0})
+
+    def log_call(self, context, apiname, category, arguments):
+        self.add(build_call(self.first_seen, context, apiname, category,
+                            arguments))
+
+    def log_anomaly(self, subcategory, tid, funcname, msg):
+        self.add(build_anomaly(subcategory, tid, funcname, msg))
+
+    def add(self, call):
+        """Add a call, repetitions of the previous one are merged into it.
+        @param call: call dict.
+        """
+        if self.lastcall:
+            if compare_calls(self.lastcall, call):
+                self.lastcall["repeated"] += 1
+                return
+            self.flush()
+
+        self.lastcall = call
+
+    def flush(self):
+        """Process the pending call."""
+        call, self.lastcall = self.lastcall, None
+
+        if self.writer:
+            try:
+                self.writer.add(call)
+            except (IOError, OSError) as e:
+                log.warning("Unable to write the call store of process %s, "
+                            "it will be written by the processing: %s",
+                            self.state.process["process_id"], e)
+                self.writer.abort()
+                self.writer = None
+
+        self.state.event_apicall(call)
+
+        if time.time() - self.checkpoint_time >= CHECKPOINT_INTERVAL:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """Save the state of the partial behaviors."""
+        self.checkpoint_time = time.time()
+        try:
+            self.state.save(self.path)
+        except (IOError, OSError) as e:
+            log.warning("Unable to write the behavior checkpoint %s: %s",
+                        self.path, e)
+
+    def close(self):
+        """Complete the call store and the checkpoint, the log is over."""
+        if self.lastcall:
+            self.flush()
+
+        if self.writer:
+            try:
+                self.writer.close()
+            except (IOError, OSError) as e:
+                log.warning("Unable to write the call store of process %s: "
+                            "%s", self.state.process["process_id"], e)
+
+        self.state.complete = True
+        self.checkpoint()
+
+def process_behavior(analysis_path, process):
+    """Get the partial behaviors of a process, restored from its checkpoint
+    if the ResultServer processed it live.
+    @param analysis_path: analysis folder path.
+    @param process: process dict, as returned by Processes.
+    @return: ProcessBehavior instance.
+    """
+    info = dict((key, process[key]) for key in ("process_id",
+                                                "process_name",
+                                                "parent_id",
+                                                "first_seen"))
+
+    state = None
+    path = checkpoint_path(analysis_path, process["process_id"])
+    if os.path.exists(path):
+        state = ProcessBehavior.load(path)
+
+    # Leftover of a previous run of the analysis.
+    if state and state.process != info:
+        state = None
+
+    if not state:
+        state = ProcessBehavior(info)
+    elif state.complete:
+        return state
+    elif process.get("truncated"):
+        # The calls were counted before the log got truncated.
+        state = ProcessBehavior(info)
+
+    # Only feed the calls following the checkpoint, if any.
+    for call in itertools.islice(process["calls"], state.count, None):
+        state.event_apicall(call)
+
+    return state
+
+def parse_process_log(args):
+    """Parse the log of a process and compute its partial behaviors, in a
+    worker process. The call store is written along the way, for the parent
+    process to read the calls from.
+    @param args: tuple of analysis folder path, log file path and number of
+                 calls kept if the log has to be truncated.
+    @return: ProcessBehavior instance or None.
+    """
+    analysis_path, file_path, truncate = args
+    try:
+        process = process_log(file_path, truncate)
+        if not process:
+            return None
+
+        state = process_behavior(analysis_path, process)
+        process["calls"].open_store()
+        return state
+    except:
+        log.exception("Failed to parse the behavioral log %s", file_path)
+        return None
+
 class BehaviorAnalysis(Processing):
     """Behavior Analyzer."""
 
     key = "behavior"
 
+    def process_behavior(self, process):
+        """Get the partial behaviors of a process.
+        @param process: process dict, as returned by Processes.
+        @return: ProcessBehavior instance.
+        """
+        return process_behavior(self.analysis_path, process)
+
+    def parse_logs(self, paths, workers):
+        """Parse the logs of the processes in a pool of worker processes,
+        one log per worker at a time.
+        @param paths: list of (log file path, truncation) tuples, as returned
+                      by Processes.log_paths().
+        @param workers: number of worker processes.
+        @return: dict of the ProcessBehavior instances by log path, the logs
+                 which couldn't be parsed are left out.
+        """
+        pool = multiprocessing.Pool(min(workers, len(paths)))
+        try:
+            states = pool.map(parse_process_log,
+                              [(self.analysis_path, path, truncate)
+                               for path, truncate in paths],
+                              chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        return dict((path, state) for (path, truncate), state
+                    in zip(paths, states) if state)
+
     def run(self):
         """Run analysis.
         @return: results dict.
         """
         behavior = {}
-        behavior["processes"] = Processes(self.logs_path).run()
+        processes = Processes(self.logs_path)
+
+        workers = 1
+        if self.options:
+            workers = self.options.get("workers", 1)
+        if not workers:
+            workers = multiprocessing.cpu_count()
+
+        # The logs are parsed and reduced in parallel, the results are
+        # merged in the usual order below.
+        states = {}
+        paths = processes.log_paths()
+        if workers > 1 and len(paths) > 1:
+            # Daemonic processes aren't allowed to have children.
+            if multiprocessing.current_process().daemon:
+                log.debug("Parsing the behavioral logs sequentially from a "
+                          "daemonic process")
+            else:
+                states = self.parse_logs(paths, workers)
 
-        instances = [
-            Anomaly(),
-            ProcessTree(),
-            Summary(),
-            Enhanced(),
-        ]
+        behavior["processes"] = processes.run()
 
-        # Iterate calls and tell interested signatures about them
+        results = ProcessBehavior(None)
         for process in behavior["processes"]:
-            for call in process["calls"]:
-                for instance in instances:
-                    try:
-                        instance.event_apicall(call, process)
-                    except:
-                        log.exception("Failure in partial behavior \"%s\"", instance.key)
-
-        for instance in instances:
+            state = states.get(process["calls"].log_path)
+            if not state:
+                state = self.process_behavior(process)
+            results.merge(state)
+
+        for instance in results.instances:
             try:
                 behavior[instance.key] = instance.run()
             except:
                 log.exception("Failed to run partial behavior class \"%s\"", instance.key)
 
-            # Reset the ParseProcessLog instances after each module
-            for process in behavior["processes"]:
-                process["calls"].reset()
+        # Reset the ParseProcessLog instances.
+        for process in behavior["processes"]:
+            process["calls"].reset()
 
         return behavior
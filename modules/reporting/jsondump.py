@@ -3,28 +3,77 @@
 # See the file 'docs/LICENSE' for copying permission.
 
 import os
-import json
-import codecs
 
 from lib.cuckoo.common.abstracts import Report
+from lib.cuckoo.common.exceptions import CuckooOperationalError
 from lib.cuckoo.common.exceptions import CuckooReportError
+from lib.cuckoo.common.jsonwriter import EXTENSIONS, dump, open_output
+from lib.cuckoo.common.utils import create_folder
 
 class JsonDump(Report):
     """Saves analysis results in JSON format."""
 
+    def write(self, obj, path):
+        """Writes an object to a JSON file.
+        @param obj: object to encode.
+        @param path: file path, without the compression extension.
+        """
+        report = open_output(path, self.compression)
+        try:
+            dump(obj, report, indent=self.indent, encoding=self.encoding)
+        finally:
+            report.close()
+
+    def split_calls(self, results):
+        """Writes the calls of each process to their own file.
+        @param results: Cuckoo results dict.
+        @return: results dict referencing the calls files.
+        """
+        calls_path = os.path.join(self.reports_path, "calls")
+        create_folder(folder=calls_path)
+
+        index = []
+        processes = []
+        for process in results.get("behavior", {}).get("processes", []):
+            name = "%s.json%s" % (process["process_id"],
+                                  EXTENSIONS[self.compression])
+            self.write(process["calls"], os.path.join(
+                calls_path, "%s.json" % process["process_id"]))
+
+            # The other reporting modules still need the calls, only copies
+            # of the dicts are modified.
+            process = dict(process, calls=os.path.join("calls", name))
+            processes.append(process)
+            index.append(dict(process_id=process["process_id"],
+                              process_name=process["process_name"],
+                              calls=process["calls"]))
+
+        self.write(index, os.path.join(calls_path, "index.json"))
+
+        results = dict(results)
+        if "behavior" in results:
+            results["behavior"] = dict(results["behavior"],
+                                       processes=processes)
+        return results
+
     def run(self, results):
         """Writes report.
         @param results: Cuckoo results dict.
         @raise CuckooReportError: if fails to write report.
         """
-        indent = self.options.get("indent", 4)
-        encoding = self.options.get("encoding", "utf-8")
+        self.indent = int(self.options.get("indent", 4))
+        self.encoding = self.options.get("encoding", "utf-8")
+        self.compression = self.options.get("compression")
+        if not self.compression or self.compression == "none":
+            self.compression = None
+        if self.options.get("compact"):
+            self.indent = None
 
         try:
-            path = os.path.join(self.reports_path, "report.json")
-            report = codecs.open(path, "w", "utf-8")
-            json.dump(results, report, sort_keys=False,
-                      indent=int(indent), encoding=encoding)
-            report.close()
-        except (UnicodeError, TypeError, IOError) as e:
+            if self.options.get("split"):
+                results = self.split_calls(results)
+            self.write(results, os.path.join(self.reports_path,
+                                             "report.json"))
+        except (UnicodeError, TypeError, ValueError, IOError,
+                CuckooOperationalError) as e:
             raise CuckooReportError("Failed to generate JSON report: %s" % e)
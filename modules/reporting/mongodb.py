@@ -3,21 +3,52 @@
 # See the file 'docs/LICENSE' for copying permission.
 
 import os
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
 
 from lib.cuckoo.common.abstracts import Report
 from lib.cuckoo.common.exceptions import CuckooDependencyError
 from lib.cuckoo.common.exceptions import CuckooReportError
 from lib.cuckoo.common.objects import File
+from lib.cuckoo.common.search import MAX_LENGTH, MAX_VALUES
+from lib.cuckoo.common.search import search_document, search_indexes
 
 try:
-    from pymongo import MongoClient
+    from bson.objectid import ObjectId
+    from pymongo import MongoClient, version_tuple
     from pymongo.errors import ConnectionFailure
     from gridfs import GridFS
     from gridfs.errors import FileExists
-    HAVE_MONGO = True
+    # The collection methods used were introduced by pymongo 3.0.
+    HAVE_MONGO = version_tuple >= (3, 0)
 except ImportError:
     HAVE_MONGO = False
 
+log = logging.getLogger(__name__)
+
+# Fields of the reports the search documents are built from.
+SEARCH_FIELDS = ["info.id", "target.file", "strings", "behavior.summary",
+                 "network.domains", "signatures"]
+
+# Clients kept open across the analyses reported by a process, by process,
+# host and port.
+_clients = {}
+_lock = threading.Lock()
+
+def get_client(host, port):
+    """Get a client to a MongoDB server, connecting only the first time.
+    @param host: MongoDB host.
+    @param port: MongoDB port.
+    @return: MongoClient instance.
+    """
+    # Clients can't be shared with forked processes.
+    key = os.getpid(), host, port
+    with _lock:
+        if key not in _clients:
+            _clients[key] = MongoClient(host, port)
+        return _clients[key]
+
 class MongoDB(Report):
     """Stores report in MongoDB."""
 
@@ -32,7 +63,7 @@ class MongoDB(Report):
         port = self.options.get("port", 27017)
 
         try:
-            self.conn = MongoClient(host, port)
+            self.conn = get_client(host, port)
             self.db = self.conn.cuckoo
             self.fs = GridFS(self.db)
         except TypeError:
@@ -40,6 +71,101 @@ class MongoDB(Report):
         except ConnectionFailure:
             raise CuckooReportError("Cannot connect to MongoDB")
 
+    def setup(self):
+        """Checks the schema and sets up the indexes, once at startup rather
+        than for each report.
+        @raise CuckooReportError: if unable to connect or if the schema
+        version is not the expected one.
+        """
+        if not HAVE_MONGO:
+            raise CuckooDependencyError("Unable to import pymongo 3 (install "
+                                        "with `pip install \"pymongo>=3.0,"
+                                        "<4.0\"`)")
+
+        self.connect()
+        try:
+            self.init_schema()
+        except ConnectionFailure:
+            raise CuckooReportError("Cannot connect to MongoDB")
+
+    def init_schema(self):
+        """Checks the schema version and sets up the indexes.
+        @raise CuckooReportError: if the schema version is not the expected
+        one.
+        """
+        schema = self.db.cuckoo_schema.find_one()
+        if not schema:
+            schema = {"version": self.SCHEMA_VERSION}
+            self.db.cuckoo_schema.insert_one(schema)
+        elif schema["version"] != self.SCHEMA_VERSION:
+            raise CuckooReportError("Mongo schema version not expected, "
+                                    "check data migration tool")
+
+        # Set an unique index on stored files, to avoid duplicates.
+        self.db.fs.files.create_index("sha256", unique=True,
+                                      sparse=True, name="sha256_unique")
+
+        # The web interface looks the reports up by task and the chunks of
+        # calls by report, process and page or by category and API.
+        self.db.analysis.create_index("info.id", name="task_id")
+        for name in "index", "categories", "apis":
+            self.db.calls.create_index([("analysis_id", 1), ("pid", 1),
+                                        (name, 1)],
+                                       name="analysis_pid_%s" % name)
+
+        # Exact searches run on the reports, the other ones on the search
+        # documents.
+        for name in ("target.file.md5", "target.file.sha1",
+                     "target.file.sha256", "target.file.sha512",
+                     "target.file.crc32", "target.url", "network.hosts",
+                     "static.pe_imphash"):
+            self.db.analysis.create_index(name, name=name)
+        for name in search_indexes():
+            self.db.search.create_index(name, name=name)
+
+        # The reports stored before the search documents wouldn't be found
+        # by the searches, their search documents are built once.
+        if not schema.get("search_indexed"):
+            count = self.index_search(missing=True)
+            if count:
+                log.info("Built the search documents of %d reports", count)
+            self.db.cuckoo_schema.update_one({"_id": schema["_id"]},
+                                             {"$set": {"search_indexed": True}})
+
+    def search_document(self, report):
+        """Build the search document of a report, bounded as configured.
+        @param report: analysis results dictionary.
+        @return: search document.
+        """
+        search = search_document(
+            report,
+            max_values=int(self.options.get("search_max_values", MAX_VALUES)),
+            max_length=int(self.options.get("search_max_length", MAX_LENGTH)))
+        search["task_id"] = report["info"]["id"]
+        return search
+
+    def index_search(self, missing=False):
+        """Build the search documents of the stored reports.
+        @param missing: only build the missing ones.
+        @return: number of search documents built.
+        """
+        indexed = set()
+        if missing:
+            indexed.update(x["_id"] for x in
+                           self.db.search.find({}, {"_id": True}))
+
+        count = 0
+        reports = self.db.analysis.find({}, dict.fromkeys(SEARCH_FIELDS, True))
+        for report in reports:
+            if report["_id"] in indexed:
+                continue
+
+            self.db.search.replace_one({"_id": report["_id"]},
+                                       self.search_document(report),
+                                       upsert=True)
+            count += 1
+        return count
+
     def store_file(self, file_obj, filename=""):
         """Store a file in GridFS.
         @param file_obj: object to the file to store
@@ -49,22 +175,125 @@ class MongoDB(Report):
         if not filename:
             filename = file_obj.get_name()
 
-        existing = self.db.fs.files.find_one({"sha256": file_obj.get_sha256()})
-
-        if existing:
-            return existing["_id"]
+        # The files already stored have been looked up by store_files(), so
+        # only a concurrent upload of the same file can make this one fail.
+        new = self.fs.new_file(filename=filename, sha256=file_obj.get_sha256())
+        for chunk in file_obj.get_chunks():
+            new.write(chunk)
+        try:
+            new.close()
+        except FileExists:
+            to_find = {"sha256": file_obj.get_sha256()}
+            return self.db.fs.files.find_one(to_find)["_id"]
         else:
-            new = self.fs.new_file(filename=filename,
-                                   sha256=file_obj.get_sha256())
-            for chunk in file_obj.get_chunks():
-                new.write(chunk)
+            return new._id
+
+    def store_files(self, files):
+        """Store files in GridFS in parallel, skipping the ones already
+        stored.
+        @param files: list of (File, file name) tuples.
+        @return: dict of object ids by sha256.
+        """
+        unique = {}
+        for file_obj, filename in files:
+            unique.setdefault(file_obj.get_sha256(), (file_obj, filename))
+
+        # Look the files up at once, before sending any data.
+        ids = {}
+        existing = self.db.fs.files.find({"sha256": {"$in": unique.keys()}},
+                                         {"sha256": True})
+        for stored in existing:
+            ids[stored["sha256"]] = stored["_id"]
+
+        missing = [unique[sha256] for sha256 in unique if sha256 not in ids]
+        if len(missing) > 1:
+            workers = min(int(self.options.get("upload_workers", 4)),
+                          len(missing))
+            pool = ThreadPool(max(workers, 1))
             try:
-                new.close()
-            except FileExists:
-                to_find = {"sha256": file_obj.get_sha256()}
-                return self.db.fs.files.find_one(to_find)["_id"]
-            else:
-                return new._id
+                stored = pool.map(lambda args: self.store_file(*args), missing)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            stored = [self.store_file(*args) for args in missing]
+
+        for (file_obj, filename), object_id in zip(missing, stored):
+            ids[file_obj.get_sha256()] = object_id
+        return ids
+
+    def chunk_document(self, analysis_id, task_id, pid, index, calls):
+        """Build the document of a chunk of API calls.
+        @param analysis_id: object id of the report.
+        @param task_id: task id.
+        @param pid: process id.
+        @param index: index of the chunk in the calls of the process.
+        @param calls: list of API calls.
+        @return: chunk document, with the categories and the APIs of its
+        calls, so that they can be filtered without reading the calls.
+        """
+        categories = {}
+        for call in calls:
+            categories[call["category"]] = \
+                categories.get(call["category"], 0) + 1
+
+        return {
+            # The object ids are generated here so the chunks can be
+            # inserted in batches.
+            "_id": ObjectId(),
+            "analysis_id": analysis_id,
+            "task_id": task_id,
+            "pid": pid,
+            "index": index,
+            "categories": sorted(categories),
+            "category_counts": categories,
+            "apis": sorted(set(call["api"] for call in calls)),
+            "first_seen": calls[0].get("timestamp"),
+            "last_seen": calls[-1].get("timestamp"),
+            "calls": calls,
+        }
+
+    def store_calls(self, analysis_id, task_id, processes):
+        """Store chunks of API calls in their own collection.
+        @param analysis_id: object id of the report.
+        @param task_id: task id.
+        @param processes: list of process dicts.
+        @return: list of chunk object ids of each process.
+        """
+        chunk_size = int(self.options.get("calls_chunk_size", 100))
+        batch_size = int(self.options.get("calls_batch_size", 100))
+
+        batch = []
+        chunks_ids = []
+        for process in processes:
+            chunks_ids.append([])
+
+            chunk = []
+            for call in process["calls"]:
+                chunk.append(call)
+                if len(chunk) < chunk_size:
+                    continue
+
+                batch.append(self.chunk_document(analysis_id, task_id,
+                                                 process["process_id"],
+                                                 len(chunks_ids[-1]), chunk))
+                chunks_ids[-1].append(batch[-1]["_id"])
+                chunk = []
+
+                if len(batch) >= batch_size:
+                    self.db.calls.insert_many(batch, ordered=False)
+                    batch = []
+
+            # Store leftovers.
+            if chunk:
+                batch.append(self.chunk_document(analysis_id, task_id,
+                                                 process["process_id"],
+                                                 len(chunks_ids[-1]), chunk))
+                chunks_ids[-1].append(batch[-1]["_id"])
+
+        if batch:
+            self.db.calls.insert_many(batch, ordered=False)
+        return chunks_ids
 
     def run(self, results):
         """Writes report.
@@ -74,118 +303,94 @@ class MongoDB(Report):
         # We put the raise here and not at the import because it would
         # otherwise trigger even if the module is not enabled in the config.
         if not HAVE_MONGO:
-            raise CuckooDependencyError("Unable to import pymongo "
-                                        "(install with `pip install pymongo`)")
+            raise CuckooDependencyError("Unable to import pymongo 3 (install "
+                                        "with `pip install \"pymongo>=3.0,"
+                                        "<4.0\"`)")
 
         self.connect()
 
-        # Set mongo schema version.
-        # TODO: This is not optimal becuase it run each analysis. Need to run
-        # only one time at startup.
-        if "cuckoo_schema" in self.db.collection_names():
-            if self.db.cuckoo_schema.find_one()["version"] != self.SCHEMA_VERSION:
-                CuckooReportError("Mongo schema version not expected, check data migration tool")
-        else:
-            self.db.cuckoo_schema.save({"version": self.SCHEMA_VERSION})
-
-        # Set an unique index on stored files, to avoid duplicates.
-        # From pymongo docs:
-        #  Returns the name of the created index if an index is actually
-        #    created.
-        #  Returns None if the index already exists.
-        # TODO: This is not optimal because it run each analysis. Need to run
-        # only one time at startup.
-        self.db.fs.files.ensure_index("sha256", unique=True,
-                                      sparse=True, name="sha256_unique")
-
         # Create a copy of the dictionary. This is done in order to not modify
         # the original dictionary and possibly compromise the following
         # reporting modules.
         report = dict(results)
 
-        # Store the sample in GridFS.
+        # Collect the sample, the PCAP file, the dropped files and the
+        # screenshots, so they can be stored in GridFS at once.
+        files = []
+
+        sample = None
         if results["info"]["category"] == "file":
             sample = File(self.file_path)
             if sample.valid():
-                fname = results["target"]["file"]["name"]
-                sample_id = self.store_file(sample, filename=fname)
-                report["target"] = {"file_id": sample_id}
-                report["target"].update(results["target"])
-
-        # Store the PCAP file in GridFS and reference it back in the report.
-        pcap_path = os.path.join(self.analysis_path, "dump.pcap")
-        pcap = File(pcap_path)
-        if pcap.valid():
-            pcap_id = self.store_file(pcap)
-            report["network"] = {"pcap_id": pcap_id}
-            report["network"].update(results["network"])
-
-        # Walk through the dropped files, store them in GridFS and update the
-        # report with the ObjectIds.
-        new_dropped = []
-        if "dropped" in report:
-            for dropped in report["dropped"]:
-                new_drop = dict(dropped)
-                drop = File(dropped["path"])
-                if drop.valid():
-                    dropped_id = self.store_file(drop, filename=dropped["name"])
-                    new_drop["object_id"] = dropped_id
+                files.append((sample, results["target"]["file"]["name"]))
+            else:
+                sample = None
 
-                new_dropped.append(new_drop)
+        pcap = File(os.path.join(self.analysis_path, "dump.pcap"))
+        if pcap.valid():
+            files.append((pcap, pcap.get_name()))
+        else:
+            pcap = None
 
-        report["dropped"] = new_dropped
+        drops = []
+        for dropped in report.get("dropped", []):
+            drop = File(dropped["path"])
+            if drop.valid():
+                # The hash has already been computed by the processing.
+                if dropped.get("sha256"):
+                    drop._sha256 = dropped["sha256"]
+                files.append((drop, dropped["name"]))
+            else:
+                drop = None
+            drops.append(drop)
 
-        # Add screenshots.
-        report["shots"] = []
+        shots = []
         shots_path = os.path.join(self.analysis_path, "shots")
         if os.path.exists(shots_path):
             # Walk through the files and select the JPGs.
-            shots = [shot for shot in os.listdir(shots_path)
-                     if shot.endswith(".jpg")]
-
-            for shot_file in sorted(shots):
-                shot_path = os.path.join(self.analysis_path,
-                                         "shots", shot_file)
-                shot = File(shot_path)
-                # If the screenshot path is a valid file, store it and
-                # reference it back in the report.
+            for shot_file in sorted(os.listdir(shots_path)):
+                if not shot_file.endswith(".jpg"):
+                    continue
+
+                shot = File(os.path.join(shots_path, shot_file))
                 if shot.valid():
-                    shot_id = self.store_file(shot)
-                    report["shots"].append(shot_id)
+                    files.append((shot, shot.get_name()))
+                    shots.append(shot)
+
+        ids = self.store_files(files)
+
+        # Reference the stored files back in the report.
+        if sample:
+            report["target"] = {"file_id": ids[sample.get_sha256()]}
+            report["target"].update(results["target"])
+
+        if pcap:
+            report["network"] = {"pcap_id": ids[pcap.get_sha256()]}
+            report["network"].update(results["network"])
+
+        new_dropped = []
+        for dropped, drop in zip(report.get("dropped", []), drops):
+            new_drop = dict(dropped)
+            if drop:
+                new_drop["object_id"] = ids[drop.get_sha256()]
+            new_dropped.append(new_drop)
+
+        report["dropped"] = new_dropped
+        report["shots"] = [ids[shot.get_sha256()] for shot in shots]
 
         # Store chunks of API calls in a different collection and reference
         # those chunks back in the report. In this way we should defeat the
         # issue with the oversized reports exceeding MongoDB's boundaries.
         # Also allows paging of the reports.
+        # The chunks reference the report, whose id is known beforehand.
+        report["_id"] = ObjectId()
+        processes = report["behavior"]["processes"]
+        chunks_ids = self.store_calls(report["_id"], results["info"]["id"],
+                                      processes)
         new_processes = []
-        for process in report["behavior"]["processes"]:
+        for process, process_chunks in zip(processes, chunks_ids):
             new_process = dict(process)
-
-            chunk = []
-            chunks_ids = []
-            # Loop on each process call.
-            for index, call in enumerate(process["calls"]):
-                # If the chunk size is 100 or if the loop is completed then
-                # store the chunk in MongoDB.
-                if len(chunk) == 100:
-                    to_insert = {"pid": process["process_id"],
-                                 "calls": chunk}
-                    chunk_id = self.db.calls.insert(to_insert)
-                    chunks_ids.append(chunk_id)
-                    # Reset the chunk.
-                    chunk = []
-
-                # Append call to the chunk.
-                chunk.append(call)
-
-            # Store leftovers.
-            if chunk:
-                to_insert = {"pid": process["process_id"], "calls": chunk}
-                chunk_id = self.db.calls.insert(to_insert)
-                chunks_ids.append(chunk_id)
-
-            # Add list of chunks.
-            new_process["calls"] = chunks_ids
+            new_process["calls"] = process_chunks
             new_processes.append(new_process)
 
         # Store the results in the report.
@@ -193,5 +398,9 @@ class MongoDB(Report):
         report["behavior"]["processes"] = new_processes
 
         # Store the report and retrieve its object id.
-        self.db.analysis.save(report)
-        self.conn.disconnect()
+        self.db.analysis.insert_one(report)
+
+        # Store the searchable fields of the report.
+        search = self.search_document(results)
+        search["_id"] = report["_id"]
+        self.db.search.insert_one(search)
@@ -0,0 +1,385 @@
+# Copyright (C) 2010-2014 Cuckoo Foundation.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import os
+import multiprocessing
+import shutil
+import struct
+import tempfile
+from nose.tools import assert_equals, assert_true
+
+from lib.cuckoo.common.callstore import CallStore
+from lib.cuckoo.common.logtbl import table as LOGTBL
+from lib.cuckoo.common.objects import Dictionary
+from lib.cuckoo.common.netlog import NetlogParser
+from lib.cuckoo.common.utils import logtime
+from lib.cuckoo.core.database import Database
+from modules.processing.behavior import BehaviorAnalysis, LiveBehavior
+from modules.processing.behavior import ParseProcessLog, ProcessBehavior
+from modules.processing.behavior import Anomaly, Enhanced, ProcessTree
+from modules.processing.behavior import Summary, CallRouter
+from modules.processing.behavior import checkpoint_path, process_log
+from modules.processing.behavior import collapse_loops
+
+
+def netlog_string(s):
+    return struct.pack("II", len(s), len(s)) + s
+
+def netlog_message(api, tid, data):
+    apiindex = [x[0] for x in LOGTBL].index(api)
+    return struct.pack("BB", apiindex, 1) + struct.pack("III", 0, tid, 0) + \
+        data
+
+def netlog_header(pid, ppid, filetime):
+    filetime = (filetime + 11644473600) * 10000000
+    return netlog_message("__process__", 0,
+                          struct.pack("IIII", filetime & 0xffffffff,
+                                      filetime >> 32, pid, ppid) +
+                          netlog_string("C:\\malware.exe"))
+
+def netlog_log(pid, ppid, filetime):
+    """@return: netlog stream of a process with a few calls."""
+    data = netlog_header(pid, ppid, filetime)
+    data += netlog_message("DeleteFileA", 1, netlog_string("C:\\a.txt")) * 3
+    data += netlog_message("CopyFileA", 1, netlog_string("C:\\a.txt") +
+                           netlog_string("C:\\b.txt"))
+    data += netlog_message("DeleteFileA", 2, netlog_string("C:\\b.txt"))
+    return data
+
+def make_call(api, category, **arguments):
+    return {
+        "timestamp": "2014-01-01 10:00:00,000",
+        "thread_id": "1",
+        "category": category,
+        "api": api,
+        "status": True,
+        "return": "0x00000000",
+        "arguments": [{"name": name, "value": value}
+                      for name, value in sorted(arguments.items())],
+        "repeated": 0,
+    }
+
+def reg_open(registry, subkey, handle):
+    return make_call("RegOpenKeyExA", "registry", Registry=registry,
+                     SubKey=subkey, Handle=handle)
+
+class LiveHandler(object):
+    """Feeds a netlog stream to LiveBehavior, as the ResultServer does."""
+
+    def __init__(self, data, analysis_path):
+        self.data = data
+        self.analysis_path = analysis_path
+        self.behavior = None
+
+    def read(self, length):
+        buf, self.data = self.data[:length], self.data[length:]
+        if len(buf) != length:
+            raise EOFError()
+        return buf
+
+    def log_process(self, context, timestring, pid, ppid, modulepath,
+                    procname):
+        self.behavior = LiveBehavior(self.analysis_path, pid, ppid, procname,
+                                     timestring)
+
+    def log_call(self, context, apiname, category, arguments):
+        self.behavior.log_call(context, apiname, category, arguments)
+
+    def run(self):
+        parser = NetlogParser(self)
+        while self.data:
+            parser.read_next_message()
+        self.behavior.close()
+
+class TestLiveBehavior:
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.dirpath, "logs"))
+        self.analysis = BehaviorAnalysis()
+        self.analysis.set_path(self.dirpath)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath)
+
+    def write_log(self, pid, ppid, filetime):
+        data = netlog_log(pid, ppid, filetime)
+        path = os.path.join(self.dirpath, "logs", "%d.raw" % pid)
+        open(path, "wb").write(data)
+        return data
+
+    def process(self, pid):
+        calls = ParseProcessLog(os.path.join(self.dirpath, "logs",
+                                             "%d.raw" % pid))
+        return {
+            "process_id": calls.process_id,
+            "process_name": calls.process_name,
+            "parent_id": calls.parent_id,
+            "first_seen": logtime(calls.first_seen),
+            "calls": calls,
+        }
+
+    def results(self, state):
+        return dict((instance.key, instance.run())
+                    for instance in state.instances)
+
+    def test_same_as_offline(self):
+        data = self.write_log(1234, 1, 1388534400)
+        offline = self.analysis.process_behavior(self.process(1234))
+        os.unlink(os.path.join(self.dirpath, "calls", "1234.calls"))
+
+        LiveHandler(data, self.dirpath).run()
+        store_path = os.path.join(self.dirpath, "calls", "1234.calls")
+        written = os.stat(store_path)
+        live = self.analysis.process_behavior(self.process(1234))
+        assert_true(live.complete)
+        assert_equals(live.count, 3)
+        assert_equals(self.results(live), self.results(offline))
+        assert_equals(self.results(live)["summary"]["files"],
+                      ["C:\\a.txt", "C:\\b.txt"])
+
+        # The call store written live is used by the processing, rather
+        # than written again.
+        calls = self.process(1234)["calls"]
+        assert_equals(list(calls), list(CallStore(calls._store_path)))
+        assert_equals(calls[0]["repeated"], 2)
+        reused = os.stat(store_path)
+        assert_equals((reused.st_ino, reused.st_mtime),
+                      (written.st_ino, written.st_mtime))
+
+    def test_resume(self):
+        self.write_log(1234, 1, 1388534400)
+        process = self.process(1234)
+        offline = self.analysis.process_behavior(process)
+
+        # Checkpoint taken by the ResultServer in the middle of the log.
+        partial = ProcessBehavior(offline.process)
+        partial.event_apicall(process["calls"][0])
+        partial.save(checkpoint_path(self.dirpath, 1234))
+
+        resumed = self.analysis.process_behavior(self.process(1234))
+        assert_equals(resumed.count, 3)
+        assert_equals(self.results(resumed), self.results(offline))
+
+    def test_stale_checkpoint(self):
+        self.write_log(1234, 1, 1388534400)
+        process = self.process(1234)
+        state = ProcessBehavior(dict(process_id=1234, process_name="old.exe",
+                                     parent_id=1, first_seen="old"))
+        state.complete = True
+        os.mkdir(os.path.join(self.dirpath, "calls"))
+        state.save(checkpoint_path(self.dirpath, 1234))
+
+        state = self.analysis.process_behavior(process)
+        assert_equals(state.count, 3)
+
+    def test_merge(self):
+        self.write_log(1234, 1, 1388534400)
+        self.write_log(1300, 1234, 1388534401)
+
+        results = ProcessBehavior(None)
+        for pid in 1234, 1300:
+            results.merge(self.analysis.process_behavior(self.process(pid)))
+
+        results = self.results(results)
+        assert_equals([event["eid"] for event in results["enhanced"]],
+                      range(1, 7))
+        assert_equals(results["processtree"][0]["pid"], 1234)
+        assert_equals(results["processtree"][0]["children"][0]["pid"], 1300)
+        assert_equals(results["summary"]["files"], ["C:\\a.txt", "C:\\b.txt"])
+
+class TestParallelParsing:
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.dirpath, "logs"))
+        self.analysis = BehaviorAnalysis()
+        self.analysis.set_path(self.dirpath)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath)
+
+    def test_parse_logs(self):
+        paths = []
+        for idx, pid in enumerate((1300, 1234, 1400)):
+            path = os.path.join(self.dirpath, "logs", "%d.raw" % pid)
+            open(path, "wb").write(netlog_log(pid, 1, 1388534400 + idx))
+            paths.append(path)
+        open(os.path.join(self.dirpath, "logs", "1.raw"), "wb").write("foo")
+        paths.append(os.path.join(self.dirpath, "logs", "1.raw"))
+
+        states = self.analysis.parse_logs([(path, 0) for path in paths], 2)
+        assert_equals(sorted(states), sorted(paths[:3]))
+
+        for path in paths[:3]:
+            # The call stores have been written by the workers.
+            pid = os.path.basename(path).split(".")[0]
+            store = os.path.join(self.dirpath, "calls", pid + ".calls")
+            assert_true(os.path.exists(store))
+
+            sequential = self.analysis.process_behavior(process_log(path))
+            assert_equals(states[path].process, sequential.process)
+            for a, b in zip(states[path].instances, sequential.instances):
+                assert_equals(a.run(), b.run())
+
+    def test_daemon_process(self):
+        Database().config_set("cuckoo.processing.analysis_size_limit",
+                              1024 * 1024)
+        for idx, pid in enumerate((1300, 1234)):
+            path = os.path.join(self.dirpath, "logs", "%d.raw" % pid)
+            open(path, "wb").write(netlog_log(pid, 1, 1388534400 + idx))
+
+        def run(queue):
+            behavior = self.analysis.run()
+            queue.put((behavior["summary"], behavior["processtree"]))
+
+        # Like in the processing workers, which can't have children.
+        self.analysis.set_options(Dictionary(workers=2))
+        queue = multiprocessing.Queue()
+        proc = multiprocessing.Process(target=run, args=(queue,))
+        proc.daemon = True
+        proc.start()
+        parallel = queue.get(timeout=30)
+        proc.join()
+
+        self.analysis.set_options(Dictionary(workers=1))
+        behavior = self.analysis.run()
+        assert_equals(len(behavior["processtree"]), 2)
+        assert_equals(parallel, (behavior["summary"], behavior["processtree"]))
+
+class TestTruncation:
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.dirpath, "logs"))
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath)
+
+    def collapse(self, apis, max_period=8):
+        calls = [make_call(api, "filesystem") for api in apis]
+        return [(call["api"], call["repeated"])
+                for call in collapse_loops(calls, max_period)]
+
+    def test_collapse_loops(self):
+        assert_equals(self.collapse("ABABABC"),
+                      [("A", 2), ("B", 2), ("C", 0)])
+        # The last loop is cut short by D.
+        assert_equals(self.collapse("ABCABCABD"),
+                      [("A", 2), ("B", 2), ("C", 1), ("D", 0)])
+        assert_equals(self.collapse("ABCDEFGHIJ"),
+                      [(api, 0) for api in "ABCDEFGHIJ"])
+        assert_equals(self.collapse("ABCABC", max_period=2),
+                      [(api, 0) for api in "ABCABC"])
+
+    def test_truncate(self):
+        data = netlog_header(1234, 1, 1388534400)
+        for x in xrange(1000):
+            data += netlog_message("DeleteFileA", 1,
+                                   netlog_string("C:\\%d.txt" % x))
+            # A loop in the middle of the log.
+            if x == 500:
+                data += (netlog_message("DeleteFileA", 1,
+                                        netlog_string("C:\\a.txt")) +
+                         netlog_message("CopyFileA", 1,
+                                        netlog_string("C:\\a.txt") * 2)) * 50
+        path = os.path.join(self.dirpath, "logs", "1234.raw")
+        open(path, "wb").write(data)
+
+        process = process_log(path, truncate=10)
+        calls = list(process["calls"])
+        assert_equals(len(calls), 20)
+        assert_equals([call["arguments"][0]["value"] for call in calls],
+                      ["C:\\%d.txt" % x for x in range(10) + range(990, 1000)])
+        assert_equals(process["truncated"], {
+            "calls": 1100,
+            "dropped": 982,
+            "apis": {"DeleteFileA": 1050, "CopyFileA": 50},
+        })
+
+        # The truncation is kept along with the call store.
+        assert_equals(process_log(path, truncate=10)["truncated"],
+                      process["truncated"])
+        # Rebuilt when the limit changes.
+        assert_equals(len(list(process_log(path, truncate=5)["calls"])), 10)
+        process = process_log(path)
+        assert_true("truncated" not in process)
+        assert_equals(len(process["calls"]), 1100)
+
+    def test_store_reused(self):
+        path = os.path.join(self.dirpath, "logs", "1234.raw")
+        open(path, "wb").write(netlog_log(1234, 1, 1388534400))
+        store_path = os.path.join(self.dirpath, "calls", "1234.calls")
+
+        def written(truncate):
+            list(process_log(path, truncate)["calls"])
+            return os.stat(store_path).st_ino, CallStore(store_path).meta
+
+        inode, meta = written(0)
+        assert_equals(meta, {"truncate": 0})
+        # Reused with the same limit.
+        assert_equals(written(0), (inode, meta))
+        # Rebuilt with another one.
+        inode, meta = written(5)
+        assert_equals(meta["truncate"], 5)
+        assert_equals(written(5), (inode, meta))
+        assert_true(written(0)[0] != inode)
+
+class TestIndexedState:
+    def test_summary(self):
+        process = dict(process_id=1, process_name="a.exe", parent_id=0)
+        summary = Summary()
+        for call in [
+            reg_open("0x80000002", "Software", "0x00000010"),
+            reg_open("0x00000010", "Microsoft", "0x00000020"),
+            # Already open, ignored.
+            reg_open("0x80000002", "Other", "0x00000010"),
+            make_call("RegCloseKey", "registry", Handle="0x00000010"),
+            reg_open("0x80000001", "Run", "0x00000010"),
+            reg_open("0x00000020", "Windows", "0x00000030"),
+            reg_open("0x80000002", "Software", "0x00000040"),
+            make_call("NtCreateFile", "filesystem", FileName="C:\\b.txt"),
+            make_call("NtCreateFile", "filesystem", FileName="C:\\a.txt"),
+            make_call("NtCreateFile", "filesystem", FileName="C:\\b.txt"),
+        ]:
+            summary.event_apicall(call, process)
+
+        assert_equals(summary.run(), {
+            "keys": [
+                "HKEY_LOCAL_MACHINE\\Software",
+                "HKEY_LOCAL_MACHINE\\Software\\Microsoft",
+                "HKEY_CURRENT_USER\\Run",
+                "HKEY_LOCAL_MACHINE\\Software\\Microsoft\\Windows",
+            ],
+            "files": ["C:\\b.txt", "C:\\a.txt"],
+            "mutexes": [],
+        })
+
+    def test_process_tree(self):
+        tree = ProcessTree()
+        # Process 3 shows up before its parent is attached to the tree and
+        # 5 and 6 are each other's parent, none of them makes it.
+        for pid, ppid in (1, 0), (3, 2), (2, 1), (1, 0), (5, 6), (6, 5), (7, 1):
+            tree.event_apicall(None, dict(process_id=pid, parent_id=ppid,
+                                          process_name="%d.exe" % pid))
+
+        def pids(nodes):
+            return [(node["pid"], pids(node["children"])) for node in nodes]
+
+        assert_equals(pids(tree.run()), [(1, [(2, []), (7, [])])])
+
+class TestCallRouter:
+    def test_route(self):
+        router = CallRouter([Anomaly, ProcessTree, Summary, Enhanced])
+        assert_equals(router.route("GetSystemMetrics", "misc"), (1,))
+        assert_equals(router.route("", "anomaly"), (0, 1))
+        assert_equals(router.route("NtWriteFile", "filesystem"), (1, 2, 3))
+        assert_equals(router.route("RegCloseKey", "registry"), (1, 2, 3))
+        assert_equals(router.route("CreateMutexA", "synchronization"), (1, 2))
+
+    def test_anomaly(self):
+        state = ProcessBehavior(dict(process_id=1, process_name="a.exe",
+                                     parent_id=0))
+        state.event_apicall({"category": "anomaly", "api": "",
+                             "arguments": [{"name": "Message",
+                                            "value": "unhooked"}]})
+        assert_equals(state.instances[0].run()[0]["message"], "unhooked")
+        assert_equals(state.instances[3].run(), [])
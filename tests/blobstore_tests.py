@@ -0,0 +1,89 @@
+# Copyright (C) 2010-2014 Cuckoo Foundation.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import os
+import stat
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+from nose.tools import assert_equals, assert_false, assert_true
+
+from lib.cuckoo.common.blobstore import BlobStore, open_new
+
+
+class TestBlobStore:
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.store = BlobStore(os.path.join(self.dirpath, "blobs"))
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath)
+
+    def write(self, name, data):
+        path = os.path.join(self.dirpath, name)
+        open(path, "wb").write(data)
+        return path
+
+    def test_add(self):
+        sha256 = hashlib.sha256("foo").hexdigest()
+        paths = [self.write("a", "foo"), self.write("b", "foo"),
+                 self.write("c", "bar")]
+        assert_equals(self.store.add(paths[0]), sha256)
+        assert_equals(self.store.add(paths[1], sha256), sha256)
+        self.store.add(paths[2])
+
+        assert_true(self.store.exists(sha256))
+        assert_true(os.path.samefile(paths[0], self.store.path(sha256)))
+        assert_true(os.path.samefile(paths[0], paths[1]))
+        assert_equals(open(paths[1], "rb").read(), "foo")
+        assert_equals(self.store.refcount(sha256), 2)
+
+        # Adding a file twice doesn't add a reference.
+        self.store.add(paths[0], sha256)
+        assert_equals(self.store.refcount(sha256), 2)
+
+    def test_collect(self):
+        sha256 = self.store.add(self.write("a", "foo"))
+        self.store.add(self.write("b", "bar"))
+        assert_equals(self.store.collect(), 0)
+
+        os.unlink(os.path.join(self.dirpath, "a"))
+        assert_equals(self.store.refcount(sha256), 0)
+        assert_equals(self.store.collect(), 1)
+        assert_false(self.store.exists(sha256))
+
+    def test_read_only(self):
+        sha256 = hashlib.sha256("foo").hexdigest()
+        paths = [self.write("a", "foo"), self.write("b", "foo")]
+        for path in paths:
+            self.store.add(path)
+            assert_false(os.stat(path).st_mode &
+                         (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+        # Writing a file in place of a link leaves the blob alone.
+        with open_new(paths[0]) as fd:
+            fd.write("bar")
+        assert_equals(open(paths[0], "rb").read(), "bar")
+        assert_equals(open(self.store.path(sha256), "rb").read(), "foo")
+        assert_equals(self.store.refcount(sha256), 1)
+
+    def test_collect_locked(self):
+        sha256 = self.store.add(self.write("a", "foo"))
+        os.unlink(os.path.join(self.dirpath, "a"))
+
+        # A file is being linked to the blob while it's collected.
+        collected = []
+        with self.store.lock():
+            thread = threading.Thread(
+                target=lambda: collected.append(self.store.collect()))
+            thread.start()
+            time.sleep(0.2)
+            os.link(self.store.path(sha256),
+                    os.path.join(self.dirpath, "b"))
+        thread.join()
+
+        assert_equals(collected, [0])
+        assert_true(self.store.exists(sha256))
@@ -0,0 +1,113 @@
+# Copyright (C) 2010-2014 Cuckoo Foundation.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import os
+import shutil
+import struct
+import tempfile
+from nose.tools import assert_equals, raises
+
+from lib.cuckoo.common.callstore import CallStore, write_calls
+from lib.cuckoo.common.exceptions import CuckooOperationalError
+from lib.cuckoo.common.logtbl import table as LOGTBL
+from modules.processing.behavior import ParseProcessLog
+
+
+def make_call(api, category="filesystem", value="C:\\foo.txt"):
+    return {
+        "timestamp": "2014-01-01 10:00:00,000",
+        "thread_id": "1234",
+        "category": category,
+        "api": api,
+        "status": True,
+        "return": "0x00000000",
+        "arguments": [{"name": "FileName", "value": value}],
+        "repeated": 0,
+    }
+
+def netlog_string(s):
+    return struct.pack("II", len(s), len(s)) + s
+
+def netlog_message(apiindex, tid, data):
+    return struct.pack("BB", apiindex, 1) + struct.pack("III", 0, tid, 0) + \
+        data
+
+class TestCallStore:
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.path = os.path.join(self.dirpath, "1234.calls")
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath)
+
+    def test_roundtrip(self):
+        calls = [
+            make_call("DeleteFileA"),
+            make_call(u"CreateMutexW", category=u"synchronization",
+                      value=u"\u00e9"),
+            {"thread_id": "1", "category": "anomaly", "api": "",
+             "subcategory": "unhook", "funcname": "foo", "msg": "bar"},
+        ]
+        assert_equals(write_calls(self.path, calls, {"foo": 1}), 3)
+
+        store = CallStore(self.path)
+        assert_equals(len(store), 3)
+        assert_equals(store.meta, {"foo": 1})
+        assert_equals(list(store), calls)
+        assert_equals(store[1]["api"], u"CreateMutexW")
+        assert_equals(store[-1], calls[2])
+        assert_equals(list(store.select(apis=set(["DeleteFileA"]))),
+                      calls[:1])
+        assert_equals(list(store.select(categories=set(["anomaly"]))),
+                      calls[2:])
+        store.close()
+
+    @raises(CuckooOperationalError)
+    def test_invalid(self):
+        open(self.path, "wb").write("foo")
+        CallStore(self.path)
+
+class TestParseProcessLog:
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.dirpath, "logs"))
+        self.log_path = os.path.join(self.dirpath, "logs", "1234.raw")
+
+        apiindex = [x[0] for x in LOGTBL].index("DeleteFileA")
+        filetime = (1388534400 + 11644473600) * 10000000
+        data = netlog_message(0, 0, struct.pack("IIII", filetime & 0xffffffff,
+                                                filetime >> 32, 1234, 1) +
+                              netlog_string("C:\\malware.exe"))
+        data += netlog_message(apiindex, 1, netlog_string("C:\\a.txt")) * 2
+        data += netlog_message(apiindex, 1, netlog_string("C:\\b.txt"))
+        open(self.log_path, "wb").write(data)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath)
+
+    def test_parse_once(self):
+        calls = ParseProcessLog(self.log_path)
+        assert_equals(calls.process_id, 1234)
+        assert_equals(calls.process_name, "malware.exe")
+
+        first = [(c["api"], c["arguments"][0]["value"], c["repeated"])
+                 for c in calls]
+        assert_equals(first, [("DeleteFileA", "C:\\a.txt", 1),
+                              ("DeleteFileA", "C:\\b.txt", 0)])
+
+        store_path = os.path.join(self.dirpath, "calls", "1234.calls")
+        assert_equals(os.path.exists(store_path), True)
+
+        # Following iterations don't touch the log anymore.
+        calls.fd.close()
+        assert_equals(list(calls), list(CallStore(store_path)))
+        assert_equals(len(calls), 2)
+        assert_equals(calls[1]["arguments"][0]["value"], "C:\\b.txt")
+
+    def test_next(self):
+        calls = ParseProcessLog(self.log_path)
+        assert_equals(calls.next()["repeated"], 1)
+        calls.reset()
+        assert_equals(calls.next()["repeated"], 1)
+        assert_equals(calls.next()["repeated"], 0)
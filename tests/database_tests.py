@@ -0,0 +1,272 @@
+# Copyright (C) 2010-2014 Cuckoo Foundation.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import os
+import time
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from nose.tools import assert_equals, assert_true, assert_false
+
+from lib.cuckoo.common.objects import Dictionary
+from lib.cuckoo.core.database import Database, TASK_RUNNING, TASK_COMPLETED
+from lib.cuckoo.core.database import Configuration, Task
+from lib.cuckoo.core.database import TASK_PENDING, TASK_SCHEDULED
+
+from helpers import temp_database
+
+
+class TestConfigCache:
+    def setUp(self):
+        self.d = Database()
+        self.d.config_refresh()
+
+    def test_config_set_get(self):
+        self.d.config_set("tests.cache.foo", "bar")
+        assert_equals(self.d.config_get("tests.cache.foo"), "bar")
+        self.d.config_set("tests.cache.foo", "baz")
+        assert_equals(self.d.config_get("tests.cache.foo"), "baz")
+
+    def test_snapshot_is_reused(self):
+        calls = []
+        config_all = self.d.config_all
+
+        def counting_config_all():
+            calls.append(None)
+            return config_all()
+
+        self.d.config_all = counting_config_all
+        try:
+            for _ in xrange(10):
+                self.d.config_get("tests.cache.missing")
+            assert_equals(len(calls), 1)
+
+            self.d.config_set("tests.cache.missing", 1)
+            assert_equals(self.d.config_get("tests.cache.missing"), 1)
+            assert_equals(len(calls), 2)
+        finally:
+            del self.d.config_all
+
+    def test_snapshot_expires(self):
+        self.d.config_set("tests.cache.ttl", "foo")
+        assert_equals(self.d.config_get("tests.cache.ttl"), "foo")
+
+        # Changed by another process, bypassing the snapshot.
+        session = self.d.Session()
+        session.query(Configuration).filter_by(key="tests.cache.ttl")\
+            .update({"value": "bar"})
+        session.commit()
+        session.close()
+        assert_equals(self.d.config_get("tests.cache.ttl"), "foo")
+
+        self.d._config_cache_time -= Database.CONFIG_TTL
+        assert_equals(self.d.config_get("tests.cache.ttl"), "bar")
+
+class TestClaimTask:
+    def setUp(self):
+        Database().config_set("cuckoo.timeouts.default", 120)
+        Database().config_set("cuckoo.timeouts.critical", 600)
+
+        self.d, self.path = temp_database()
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_claim_order(self):
+        low = self.d.add_url("http://low.example", priority=1)
+        high = self.d.add_url("http://high.example", priority=2)
+
+        task = self.d.claim_task()
+        assert_equals(task.id, high)
+        assert_equals(task.status, TASK_RUNNING)
+        assert_equals(self.d.claim_task().id, low)
+        assert_equals(self.d.claim_task(), None)
+
+    def test_claim_skips_busy_experiment(self):
+        task_id = self.d.add_url("http://foo.example")
+        self.d.claim_task()
+        self.d.schedule(task_id, delta=0)
+        assert_equals(self.d.claim_task(status=TASK_SCHEDULED), None)
+
+        self.d.set_status(task_id, TASK_COMPLETED)
+        assert_equals(self.d.claim_task(status=TASK_SCHEDULED).experiment_id,
+                      self.d.view_task(task_id).experiment_id)
+
+    def test_claim_window(self):
+        for i in xrange(Database.CLAIM_WINDOW + 1):
+            self.d.add_url("http://foo%d.example" % i)
+
+        # All the candidates but the last one of the window have been
+        # stolen after the select.
+        mark_running = self.d._mark_running
+        self.d._mark_running = lambda session, task_id, status: \
+            task_id > Database.CLAIM_WINDOW - 1 and \
+            mark_running(session, task_id, status)
+        try:
+            assert_equals(self.d.claim_task().id, Database.CLAIM_WINDOW)
+        finally:
+            del self.d._mark_running
+
+    def test_claim_concurrent_experiment(self):
+        first = self.d.add_url("http://foo.example")
+        second = self.d.add_url("http://bar.example")
+        experiment_id = self.d.view_task(first).experiment_id
+
+        session = self.d.Session()
+        session.query(Task).filter_by(id=second).update(
+            {"experiment_id": experiment_id})
+        session.commit()
+
+        # Another claimer got the first task of the experiment after the
+        # candidates were selected, on a database with row locks.
+        self.d.set_status(first, TASK_RUNNING)
+        engine, self.d.engine = self.d.engine, Dictionary(name="postgresql")
+        try:
+            assert_false(self.d._claim(session, second, experiment_id,
+                                       TASK_PENDING))
+        finally:
+            self.d.engine = engine
+            session.close()
+
+        assert_equals(self.d.view_task(second).status, TASK_PENDING)
+
+    def test_claim_tasks_matching_machines(self):
+        self.d.add_machine("m1", "m1", "192.168.56.101", "windows", "",
+                           None, None, "192.168.56.1", 2042, None)
+        self.d.add_machine("m2", "m2", "192.168.56.102", "windows", "x64",
+                           None, None, "192.168.56.1", 2042, None)
+
+        linux = self.d.add_url("http://linux.example", platform="linux")
+        x64 = self.d.add_url("http://x64.example", tags="x64")
+        plain = self.d.add_url("http://plain.example")
+
+        machines = self.d.list_machines(locked=False)
+        tasks = self.d.claim_tasks(machines)
+        assert_equals(sorted(task.id for task in tasks), [x64, plain])
+        assert_equals(self.d.view_task(linux).status, "pending")
+
+        assert_equals(self.d.claim_tasks(machines, limit=0), [])
+
+    def test_claim_tasks_prefers_untagged_machines(self):
+        self.d.add_machine("m1", "m1", "192.168.56.101", "windows", "x64",
+                           None, None, "192.168.56.1", 2042, None)
+        self.d.add_machine("m2", "m2", "192.168.56.102", "windows", "",
+                           None, None, "192.168.56.1", 2042, None)
+
+        plain = self.d.add_url("http://plain.example", priority=2)
+        x64 = self.d.add_url("http://x64.example", tags="x64")
+
+        # The untagged task doesn't take the only x64 machine.
+        tasks = self.d.claim_tasks(self.d.list_machines())
+        assert_equals([task.id for task in tasks], [plain, x64])
+
+    def test_claim_tasks_prefers_experiment_machine(self):
+        self.d.add_machine("m1", "m1", "192.168.56.101", "windows", "",
+                           None, None, "192.168.56.1", 2042, None)
+        self.d.add_machine("m2", "m2", "192.168.56.102", "windows", "",
+                           None, None, "192.168.56.1", 2042, None)
+
+        longterm = self.d.add_url("http://longterm.example", priority=2)
+        other = self.d.add_url("http://other.example")
+        self.d.try_lock_machine("m2",
+                                self.d.view_task(longterm).experiment_id)
+
+        # The experiment gets its own machine, leaving the free one.
+        tasks = self.d.claim_tasks(self.d.list_machines())
+        assert_equals([task.id for task in tasks], [longterm, other])
+
+class TestPoolStatus:
+    def setUp(self):
+        self.d, self.path = temp_database()
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_concurrent_counters(self):
+        before = self.d.pool_status()
+
+        def query():
+            for _ in xrange(50):
+                self.d.list_machines()
+
+        threads = [threading.Thread(target=query) for _ in xrange(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        after = self.d.pool_status()
+        assert_equals(after["checkouts"] - before["checkouts"], 400)
+        assert_equals(after["checkins"] - before["checkins"], 400)
+
+    def test_reconnect(self):
+        engine = self.d.engine
+        self.d.reconnect()
+        assert_true(self.d.engine is not engine)
+        assert_equals(self.d.list_machines(), [])
+        # The inherited engine is left alone.
+        assert_true(engine in self.d._inherited_engines)
+
+class TestViewTasks:
+    def setUp(self):
+        self.d, self.path = temp_database()
+        self.sample = tempfile.mkstemp()[1]
+        open(self.sample, "wb").write("foo")
+
+    def tearDown(self):
+        os.unlink(self.path)
+        os.unlink(self.sample)
+
+    def test_view_tasks(self):
+        url = self.d.add_url("http://foo.example")
+        path = self.d.add_path(self.sample)
+
+        tasks = self.d.view_tasks([path, 1234, url])
+        assert_equals([task.id for task in tasks], [path, url])
+        # The samples are loaded along with the tasks.
+        assert_equals(tasks[0].sample.to_dict()["file_size"], 3)
+        assert_equals(tasks[1].sample, None)
+        assert_equals(self.d.view_tasks([]), [])
+
+class TestWakeup:
+    def setUp(self):
+        self.d, self.path = temp_database()
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_add_wakes_up(self):
+        results = []
+
+        def wait():
+            start = time.time()
+            results.append((self.d.wait_for_work(10), time.time() - start))
+
+        thread = threading.Thread(target=wait)
+        thread.start()
+        time.sleep(0.1)
+        self.d.add_url("http://foo.example")
+        thread.join()
+
+        notified, elapsed = results[0]
+        assert_true(notified)
+        assert_true(elapsed < 5)
+
+    def test_timeout(self):
+        assert_equals(self.d.wait_for_work(0.05), False)
+
+    def test_next_task_due(self):
+        assert_equals(self.d.next_task_due(), None)
+
+        now = datetime.now()
+        self.d.add_url("http://past.example", added_on=now - timedelta(1))
+        self.d.add_url("http://later.example",
+                       added_on=now + timedelta(hours=2))
+        self.d.add_url("http://soon.example",
+                       added_on=now + timedelta(hours=1))
+        # Tasks that won't run don't count.
+        self.d.add_url("http://done.example", status=TASK_COMPLETED,
+                       added_on=now + timedelta(minutes=1))
+
+        assert_equals(self.d.next_task_due(), now + timedelta(hours=1))
@@ -0,0 +1,26 @@
+# Copyright (C) 2010-2014 Cuckoo Foundation.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import tempfile
+
+from lib.cuckoo.common.utils import Singleton
+from lib.cuckoo.core.database import Database
+
+def temp_database():
+    """Create a database in a new SQLite file, bypassing the singleton, so
+    that every test gets a fresh one.
+    @return: tuple of the Database instance and the path of its file.
+    """
+    path = tempfile.mkstemp(suffix=".db")[1]
+    return type.__call__(Database, dsn="sqlite:///%s" % path), path
+
+def swap_database(database):
+    """Make Database() return another instance.
+    @param database: Database instance, None to connect anew.
+    @return: instance Database() returned so far, None if not connected.
+    """
+    previous = Singleton._instances.pop(Database, None)
+    if database:
+        Singleton._instances[Database] = database
+    return previous
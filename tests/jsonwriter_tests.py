@@ -0,0 +1,151 @@
+# Copyright (C) 2010-2014 Cuckoo Foundation.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import os
+import gzip
+import json
+import shutil
+import tempfile
+from StringIO import StringIO
+from nose.tools import assert_equals, assert_true
+
+from lib.cuckoo.common.jsonwriter import dump, find_output, open_input
+from lib.cuckoo.common.objects import Dictionary
+from modules.reporting.jsondump import JsonDump
+
+
+def make_call(x):
+    return {
+        "timestamp": "2014-01-01 10:00:00,%03d" % (x % 1000),
+        "thread_id": "1234",
+        "category": "filesystem",
+        "api": "DeleteFileA",
+        "status": True,
+        "return": "0x00000000",
+        "arguments": [{"name": "FileName", "value": "C:\\file%d.txt" % x}],
+        "repeated": 0,
+    }
+
+class LazyCalls(list):
+    """Generates the calls on iteration, as ParseProcessLog does."""
+
+    def __init__(self, count):
+        list.__init__(self)
+        self.count = count
+
+    def __iter__(self):
+        return (make_call(x) for x in xrange(self.count))
+
+def make_results(count):
+    return {
+        "info": {"id": 1, "started": "2014-01-01 10:00:00"},
+        "signatures": [],
+        "network": {"hosts": [], "dns": [{"request": u"\u00e9.com"}]},
+        "behavior": {"processes": [
+            {"process_id": 1234, "process_name": "malware.exe",
+             "calls": LazyCalls(count)},
+            {"process_id": 1235, "process_name": "child.exe",
+             "calls": LazyCalls(0)},
+        ]},
+        "strings": ["foo", "\xe9"],
+        1: None,
+    }
+
+def materialize(results):
+    """Turn the lazy calls into lists, in place.
+    @return: results.
+    """
+    for process in results["behavior"]["processes"]:
+        process["calls"] = list(process["calls"])
+    return results
+
+class TestJsonStreamWriter:
+    def test_same_as_json_dump(self):
+        for indent in 4, 0, None:
+            results = make_results(10)
+            expected = json.dumps(materialize(make_results(10)),
+                                  indent=indent,
+                                  encoding="latin-1",
+                                  separators=(", ", ": ")
+                                  if indent is not None else (",", ":"))
+
+            report = StringIO()
+            dump(results, report, indent=indent, encoding="latin-1",
+                 buffer_size=100)
+            assert_equals(report.getvalue(), expected)
+
+    def test_bounded_buffer(self):
+        class Writes(list):
+            write = list.append
+
+        writes = Writes()
+        dump(make_results(1000), writes, encoding="latin-1",
+             buffer_size=4096)
+        assert_true(len(writes) > 10)
+        assert_true(all(len(x) < 8192 for x in writes))
+
+class TestJsonDump:
+    def setUp(self):
+        self.dirpath = tempfile.mkdtemp()
+        self.report = JsonDump()
+        self.report.set_path(self.dirpath)
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath)
+
+    def test_split(self):
+        self.report.set_options(Dictionary(indent=4, encoding="latin-1",
+                                           compression="gzip", split=True))
+        results = make_results(10)
+        self.report.run(results)
+
+        path = os.path.join(self.dirpath, "reports", "report.json.gz")
+        report = json.load(gzip.open(path))
+        assert_equals(report["behavior"]["processes"][0]["calls"],
+                      os.path.join("calls", "1234.json.gz"))
+        # The results of the other reporting modules are left alone.
+        assert_true(isinstance(results["behavior"]["processes"][0]["calls"],
+                               LazyCalls))
+
+        calls_path = os.path.join(self.dirpath, "reports", "calls")
+        index = json.load(gzip.open(os.path.join(calls_path,
+                                                 "index.json.gz")))
+        assert_equals(index[1], {"process_id": 1235,
+                                 "process_name": "child.exe",
+                                 "calls": os.path.join("calls",
+                                                       "1235.json.gz")})
+        calls = json.load(gzip.open(os.path.join(calls_path,
+                                                 "1234.json.gz")))
+        assert_equals(calls, [make_call(x) for x in xrange(10)])
+
+    def test_compact(self):
+        self.report.set_options(Dictionary(indent=4, encoding="latin-1",
+                                           compact=True, compression="none"))
+        self.report.run(make_results(10))
+
+        path = os.path.join(self.dirpath, "reports", "report.json")
+        data = open(path, "rb").read()
+        assert_true("\n" not in data)
+        assert_equals(len(json.loads(data)["behavior"]["processes"][0]["calls"]), 10)
+
+    def test_indent_zero(self):
+        self.report.set_options(Dictionary(indent=0, encoding="latin-1",
+                                           compression="none"))
+        self.report.run(make_results(10))
+
+        path = os.path.join(self.dirpath, "reports", "report.json")
+        assert_equals(open(path, "rb").read(),
+                      json.dumps(materialize(make_results(10)), indent=0,
+                                 encoding="latin-1"))
+
+    def test_find_output(self):
+        self.report.set_options(Dictionary(encoding="latin-1",
+                                           compression="gzip"))
+        self.report.run(make_results(10))
+
+        path = os.path.join(self.dirpath, "reports", "report.json")
+        assert_equals(find_output(path), path + ".gz")
+        report = json.load(open_input(find_output(path)))
+        assert_equals(len(report["behavior"]["processes"][0]["calls"]), 10)
+        assert_equals(find_output(path + ".missing"), None)
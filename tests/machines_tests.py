@@ -0,0 +1,72 @@
+# Copyright (C) 2010-2014 Cuckoo Foundation.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import os
+from nose.tools import assert_equals, raises
+
+from lib.cuckoo.common.exceptions import CuckooOperationalError
+from lib.cuckoo.common.objects import Dictionary
+from lib.cuckoo.core.machines import MachineRegistry
+
+from helpers import temp_database
+
+
+class TestMachineRegistry:
+    def setUp(self):
+        self.d, self.path = temp_database()
+        self.d.add_machine("m1", "l1", "192.168.56.101", "windows", "",
+                           None, None, "192.168.56.1", 2042, None)
+        self.d.add_machine("m2", "l2", "192.168.56.102", "windows", "x64",
+                           None, None, "192.168.56.1", 2042, None)
+        self.r = MachineRegistry(self.d)
+        self.r.load()
+
+    def tearDown(self):
+        os.unlink(self.path)
+
+    def test_acquire_release(self):
+        assert_equals(self.r.count_available(), 2)
+        machine = self.r.acquire(locked_by=1)
+        assert_equals(machine.name, "m1")
+        assert_equals(self.r.acquire(locked_by=1).name, "m1")
+        assert_equals(self.r.count_available(), 1)
+        assert_equals(self.r.count_available(locked_by=1), 2)
+
+        self.r.flush()
+        assert_equals(self.d.view_machine("m1").locked_by, 1)
+
+        self.r.release("l1")
+        self.r.flush()
+        assert_equals(self.d.view_machine("m1").locked_by, None)
+        assert_equals(self.r.count_available(), 2)
+
+    def test_acquire_tags(self):
+        tag = Dictionary(name="x64")
+        assert_equals(self.r.acquire(tags=[tag], locked_by=1).name, "m2")
+        assert_equals(self.r.acquire(tags=[tag], locked_by=2), None)
+        assert_equals(self.r.acquire(platform="windows", locked_by=2).name,
+                      "m1")
+
+    @raises(CuckooOperationalError)
+    def test_acquire_no_match(self):
+        self.r.acquire(platform="linux", locked_by=1)
+
+    def test_locked_elsewhere(self):
+        # Locked by another process, e.g., utils/machine.py.
+        self.d.try_lock_machine("m1", 5)
+        assert_equals(self.r.count_available(), 2)
+
+        assert_equals(self.r.acquire(locked_by=1).name, "m2")
+        assert_equals(self.r.acquire(locked_by=2), None)
+        assert_equals(self.r.acquire(locked_by=5).name, "m1")
+        assert_equals(self.d.view_machine("m2").locked_by, 1)
+
+    def test_unlocked_elsewhere(self):
+        self.r.acquire(locked_by=1)
+        self.r.acquire(locked_by=2)
+        assert_equals(self.r.count_available(), 0)
+
+        self.d.unlock_machine("l1")
+        self.r.sync(force=True)
+        assert_equals(self.r.acquire(locked_by=3).name, "m1")
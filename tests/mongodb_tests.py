@@ -0,0 +1,171 @@
+# Copyright (C) 2010-2014 Cuckoo Foundation.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import os
+import shutil
+import tempfile
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_equals, assert_true
+
+from lib.cuckoo.common.objects import Dictionary, File
+from modules.reporting.mongodb import MongoDB, HAVE_MONGO
+
+if HAVE_MONGO:
+    from gridfs.errors import FileExists
+
+
+class FakeCollection(object):
+    """Records the operations made on a collection."""
+
+    def __init__(self):
+        self.documents = []
+        self.requests = 0
+
+    def insert_many(self, documents, ordered=True):
+        self.requests += 1
+        self.documents.extend(documents)
+
+    def find(self, spec, fields=None):
+        self.requests += 1
+        values = spec["sha256"]["$in"]
+        return [doc for doc in self.documents if doc["sha256"] in values]
+
+    def find_one(self, spec):
+        self.requests += 1
+        for doc in self.documents:
+            if doc["sha256"] == spec["sha256"]:
+                return doc
+
+class FakeSearch(object):
+    """Search documents collection."""
+
+    def __init__(self, documents):
+        self.documents = dict((doc["_id"], doc) for doc in documents)
+
+    def find(self, spec, fields=None):
+        return self.documents.values()
+
+    def replace_one(self, spec, document, upsert=False):
+        self.documents[spec["_id"]] = dict(document, _id=spec["_id"])
+
+class FakeGridIn(object):
+    """File uploaded concurrently by another analysis."""
+
+    def __init__(self, files, sha256):
+        self.files = files
+        self.sha256 = sha256
+
+    def write(self, data):
+        pass
+
+    def close(self):
+        self.files.documents.append({"_id": "other", "sha256": self.sha256})
+        raise FileExists()
+
+class FakeGridFS(object):
+    def __init__(self, files):
+        self.files = files
+        self.uploads = []
+
+    def store(self, file_obj, filename):
+        self.uploads.append(filename)
+        self.files.documents.append({"_id": len(self.files.documents),
+                                     "sha256": file_obj.get_sha256()})
+        return self.files.documents[-1]["_id"]
+
+class TestMongoDB:
+    def setUp(self):
+        if not HAVE_MONGO:
+            raise SkipTest("pymongo 3 is not installed")
+
+        self.dirpath = tempfile.mkdtemp()
+        self.report = MongoDB()
+        self.report.set_path(self.dirpath)
+        self.report.set_options(Dictionary(calls_chunk_size=10,
+                                           calls_batch_size=4,
+                                           upload_workers=2))
+        self.report.db = Dictionary(calls=FakeCollection(),
+                                    fs=Dictionary(files=FakeCollection()))
+        self.gridfs = FakeGridFS(self.report.db.fs.files)
+        self.report.store_file = self.gridfs.store
+
+    def tearDown(self):
+        shutil.rmtree(self.dirpath)
+
+    def test_store_calls(self):
+        foo = {"api": "foo", "category": "system", "timestamp": "1"}
+        bar = {"api": "bar", "category": "process", "timestamp": "2"}
+        processes = [
+            {"process_id": 1, "calls": [foo] * 95},
+            {"process_id": 2, "calls": []},
+            {"process_id": 3, "calls": [foo] * 5 + [bar] * 5},
+        ]
+        chunks_ids = self.report.store_calls("analysis", 42, processes)
+
+        calls = self.report.db.calls
+        assert_equals([len(x) for x in chunks_ids], [10, 0, 1])
+        assert_equals(calls.requests, 3)
+        assert_equals([x["_id"] for x in calls.documents],
+                      chunks_ids[0] + chunks_ids[2])
+        assert_equals([len(x["calls"]) for x in calls.documents],
+                      [10] * 9 + [5, 10])
+
+        chunk = dict(calls.documents[-1], _id=None, calls=None)
+        assert_equals(chunk, {
+            "_id": None, "analysis_id": "analysis", "task_id": 42, "pid": 3,
+            "index": 0, "categories": ["process", "system"],
+            "category_counts": {"process": 5, "system": 5},
+            "apis": ["bar", "foo"], "first_seen": "1", "last_seen": "2",
+            "calls": None,
+        })
+        assert_equals(calls.documents[9]["index"], 9)
+
+    def test_store_files(self):
+        paths = []
+        for name, data in (("a", "foo"), ("b", "bar"), ("c", "foo"),
+                           ("d", "baz")):
+            paths.append(os.path.join(self.dirpath, name))
+            open(paths[-1], "wb").write(data)
+
+        # The first file is already stored.
+        self.gridfs.store(File(paths[0]), "a")
+        files = [(File(path), os.path.basename(path)) for path in paths]
+        ids = self.report.store_files(files)
+
+        assert_equals(sorted(self.gridfs.uploads), ["a", "b", "d"])
+        assert_equals(ids[files[0][0].get_sha256()],
+                      ids[files[2][0].get_sha256()])
+        assert_equals(len(set(ids.values())), 3)
+
+    def test_store_file_exists(self):
+        path = os.path.join(self.dirpath, "a")
+        open(path, "wb").write("foo")
+        files = self.report.db.fs.files
+        self.report.fs = Dictionary(
+            new_file=lambda filename, sha256: FakeGridIn(files, sha256))
+
+        # The file is uploaded right away and looked up only once the upload
+        # conflicts with the other one.
+        assert_equals(MongoDB.store_file(self.report, File(path)), "other")
+        assert_equals(files.requests, 1)
+
+    def test_index_search(self):
+        reports = [{"_id": x, "info": {"id": x},
+                    "behavior": {"summary": {"files": ["file%d" % x] * x}}}
+                   for x in xrange(1, 4)]
+        self.report.db.analysis = Dictionary(find=lambda spec, fields: reports)
+        self.report.db.search = FakeSearch([{"_id": 1, "task_id": 1}])
+        self.report.options.search_max_length = 4
+
+        # Only the missing search documents are built.
+        assert_equals(self.report.index_search(missing=True), 2)
+        documents = self.report.db.search.documents
+        assert_equals(sorted(documents), [1, 2, 3])
+        assert_equals(documents[1], {"_id": 1, "task_id": 1})
+        assert_equals(documents[3]["task_id"], 3)
+        assert_equals(documents[3]["file"], ["file"])
+        assert_true(documents[3]["truncated"])
+
+        assert_equals(self.report.index_search(), 3)
+        assert_equals(documents[1]["file"], ["file"])
@@ -0,0 +1,233 @@
+# Copyright (C) 2010-2014 Cuckoo Foundation.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import random
+import struct
+from nose.plugins.skip import SkipTest
+from nose.tools import assert_equals, assert_true, raises
+
+from lib.cuckoo.common.defines import REG_SZ, REG_DWORD_LITTLE_ENDIAN
+from lib.cuckoo.common.logtbl import table as LOGTBL
+from lib.cuckoo.common.netlog import NetlogParser, ReadBuffer, expand_format
+from lib.cuckoo.common.netlog import BsonParser, IncompleteMessage, HAVE_BSON
+
+try:
+    import bson
+    bson_encode = getattr(bson, "dumps", None) or bson.BSON.encode
+except ImportError:
+    pass
+
+
+class Handler(object):
+    """Reads a netlog stream from memory and collects the calls."""
+
+    def __init__(self, data):
+        self.data = data
+        self.offset = 0
+        self.reads = 0
+        self.calls = []
+
+    def read(self, length):
+        self.reads += 1
+        buf = self.data[self.offset:self.offset+length]
+        if len(buf) != length:
+            raise EOFError()
+        self.offset += length
+        return buf
+
+    def log_call(self, context, apiname, category, arguments):
+        self.calls.append((apiname, category, arguments))
+
+def pack_string(s, truncated=False):
+    return struct.pack("II", len(s), len(s) + truncated) + s
+
+def pack_value(fs, rand):
+    """@return: netlog encoding of a random value of the given format."""
+    if fs in "ilLpP":
+        return struct.pack("I", rand.randint(0, 0xffffffff))
+    if fs in "sSuUoObB":
+        return pack_string("x" * rand.randint(0, 40), rand.random() < 0.1)
+    if fs in "aA":
+        count = rand.randint(0, 3)
+        return struct.pack("I", count) + \
+            "".join(pack_string("arg%d" % x) for x in xrange(count))
+    if fs in "rR":
+        if rand.random() < 0.5:
+            return struct.pack("II", REG_DWORD_LITTLE_ENDIAN, 1)
+        return struct.pack("I", REG_SZ) + pack_string("value")
+    raise ValueError(fs)
+
+def synthetic_stream(count, seed=1):
+    """@return: netlog stream of random API calls."""
+    rand = random.Random(seed)
+    messages = []
+    for x in xrange(count):
+        apiindex = rand.randint(2, len(LOGTBL) - 1)
+        fmt = expand_format(LOGTBL[apiindex][2][0])
+        messages.append(struct.pack("BB", apiindex, 1) +
+                        struct.pack("III", 0, 1, x) +
+                        "".join(pack_value(fs, rand) for fs in fmt))
+    return "".join(messages)
+
+def legacy_arguments(handler, apiindex):
+    """Decode the arguments of a call field by field, as NetlogParser used
+    to, for comparison."""
+    parser = NetlogParser(handler)
+    readers = {
+        "s": parser.read_string, "S": parser.read_string,
+        "u": parser.read_string, "U": parser.read_string,
+        "o": parser.read_string, "O": parser.read_string,
+        "b": parser.read_buffer, "B": parser.read_buffer,
+        "i": parser.read_int32, "l": parser.read_int32,
+        "L": parser.read_int32, "p": parser.read_ptr, "P": parser.read_ptr,
+        "a": parser.read_argv, "A": parser.read_argv,
+        "r": parser.read_registry, "R": parser.read_registry,
+    }
+
+    parseinfo = LOGTBL[apiindex][2]
+    return [(argname, readers[fs]())
+            for fs, argname in zip(expand_format(parseinfo[0]),
+                                   parseinfo[1:])]
+
+def legacy_parse(data):
+    handler = Handler(data)
+    while handler.offset < len(handler.data):
+        apiindex, status = struct.unpack("BB", handler.read(2))
+        struct.unpack("III", handler.read(12))
+        handler.calls.append((LOGTBL[apiindex][0], LOGTBL[apiindex][1],
+                              legacy_arguments(handler, apiindex)))
+    return handler
+
+def parse(data):
+    handler = Handler(data)
+    parser = NetlogParser(handler)
+    while handler.offset < len(handler.data):
+        assert_true(parser.read_next_message())
+    return handler
+
+class TestNetlogDecoders:
+    def test_same_as_legacy(self):
+        data = synthetic_stream(2000)
+        assert_equals(parse(data).calls, legacy_parse(data).calls)
+
+    def test_reads_per_call(self):
+        # Header, first string length, first string data along with the
+        # second string length, second string data. It used to take six.
+        apiindex = [x[0] for x in LOGTBL].index("CopyFileA")
+        assert_equals(LOGTBL[apiindex][2][0], "ss")
+
+        data = struct.pack("BB", apiindex, 1) + struct.pack("III", 0, 1, 0) + \
+            pack_string("C:\\a.txt") + pack_string("C:\\b.txt", True)
+        handler = parse(data)
+        assert_equals(handler.reads, 4)
+        assert_equals(handler.calls[0][2], [
+            ("ExistingFileName", "C:\\a.txt"),
+            ("NewFileName", "C:\\b.txt... (truncated)"),
+        ])
+
+class ChunkSource(object):
+    """Hands out data in chunks of at most the given size."""
+
+    def __init__(self, data, chunk):
+        self.data = data
+        self.chunk = chunk
+
+    def fill(self, view):
+        length = min(len(view), self.chunk, len(self.data))
+        view[:length] = self.data[:length]
+        self.data = self.data[length:]
+        return length
+
+class TestReadBuffer:
+    def test_reads(self):
+        data = "".join("line %d\n" % x for x in xrange(1000))
+        buf = ReadBuffer(ChunkSource(data, 7).fill, size=16)
+        assert_equals(buf.read(5), "line ")
+        assert_equals(buf.read_newline(), "0\n")
+        assert_equals(buf.read(4000), data[7:4007])
+        lines = []
+        while buf.pos < buf.end or buf.receive():
+            lines.append(buf.read_newline())
+        assert_equals("".join(lines), data[4007:])
+
+    @raises(EOFError)
+    def test_eof(self):
+        ReadBuffer(ChunkSource("foo", 2).fill).read(4)
+
+    @raises(IncompleteMessage)
+    def test_non_blocking(self):
+        buf = ReadBuffer(ChunkSource("foo", 2).fill, blocking=False)
+        buf.receive()
+        buf.read(3)
+
+    def test_persist(self):
+        writes = []
+        data = "x" * 10000
+        buf = ReadBuffer(ChunkSource("HEADER" + data, 1024).fill, size=4096)
+        buf.read(6)
+        buf.start_persist(lambda view: writes.append(view.tobytes()))
+        for x in xrange(1000):
+            buf.read(10)
+        buf.flush()
+        assert_equals("".join(writes), data)
+        # One write per refill of the buffer, not one per read.
+        assert_true(len(writes) <= 10)
+
+class BufferedHandler(Handler):
+    """Reads a stream from memory through a read buffer."""
+
+    def __init__(self, data):
+        Handler.__init__(self, data)
+        self.buffer = ReadBuffer(ChunkSource(data, 64 * 1024).fill)
+
+    def read(self, length):
+        self.reads += 1
+        return self.buffer.read(length)
+
+def synthetic_bson_stream(count):
+    """@return: BSON stream of API calls."""
+    messages = [bson_encode({
+        "type": "info", "I": 2, "name": "NtCreateFile",
+        "category": "filesystem",
+        "args": ["is_success", "retval", ["FileHandle", "p"], "FileName"],
+    })]
+    for x in xrange(count):
+        messages.append(bson_encode({
+            "I": 2, "T": 1, "t": x,
+            "args": [1, 0, -x, u"C:\\file%d.txt" % x],
+        }))
+    return "".join(messages)
+
+def parse_bson(handler):
+    parser = BsonParser(handler)
+    while parser.read_next_message():
+        pass
+    return handler
+
+class TestBsonBatch:
+    def setUp(self):
+        if not HAVE_BSON:
+            raise SkipTest("bson is not installed")
+
+    def test_same_as_unbuffered(self):
+        data = synthetic_bson_stream(3000)
+        unbuffered = Handler(data)
+        buffered = BufferedHandler(data)
+        for handler in unbuffered, buffered:
+            try:
+                parse_bson(handler)
+            except EOFError:
+                pass
+
+        assert_equals(len(buffered.calls), 3000)
+        assert_equals(buffered.calls, unbuffered.calls)
+        assert_equals(buffered.calls[1][2][0], ("FileHandle", "0xffffffff"))
+        assert_true(buffered.reads < 100)
+
+    def test_invalid_message(self):
+        # 0x99 isn't a valid element type.
+        data = synthetic_bson_stream(9) + struct.pack("I", 12) + "\x99" * 8
+        handler = BufferedHandler(data + synthetic_bson_stream(1))
+        parse_bson(handler)
+        assert_equals(len(handler.calls), 9)
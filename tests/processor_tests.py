@@ -4,10 +4,12 @@
 
 import os
 import tempfile
-from nose.tools import assert_equals
+from nose.tools import assert_equals, assert_true
 
 from lib.cuckoo.common.constants import CUCKOO_VERSION
 from lib.cuckoo.common.abstracts import Processing, Signature
+from lib.cuckoo.core import plugins
+from lib.cuckoo.core.plugins import EventedSignatures, RunSignatures
 
 
 class ProcessingMock(Processing):
@@ -40,3 +42,105 @@ class SignatureWrongVersionMock(SignatureMock):
     minimum = "0.0..-abc"
     maximum = "0.0..-abc"
 
+
+class EventedMock(Signature):
+    name = "evented"
+    minimum = CUCKOO_VERSION.split("-")[0]
+    evented = True
+
+    def __init__(self, results=None):
+        Signature.__init__(self, results)
+        self.seen = []
+
+    def on_call(self, call, process):
+        self.seen.append(call["api"])
+
+class FileMock(EventedMock):
+    name = "file"
+    filter_categories = set(["filesystem"])
+
+class DeleteMock(EventedMock):
+    name = "delete"
+    filter_apinames = set(["DeleteFileA"])
+
+    def on_call(self, call, process):
+        EventedMock.on_call(self, call, process)
+        return True
+
+class MalwareMock(EventedMock):
+    name = "malware"
+    filter_processnames = set(["malware.exe"])
+    filter_apinames = set(["DeleteFileA", "RegOpenKeyExA"])
+
+    def on_complete(self):
+        return True
+
+class BrokenMock(EventedMock):
+    name = "broken"
+
+    def on_call(self, call, process):
+        raise ValueError("foo")
+
+def make_process(name, *apis):
+    return {
+        "process_name": name,
+        "calls": [dict(api=api, category=category) for api, category in apis],
+    }
+
+class TestEventedSignatures:
+    def test_route(self):
+        sigs = [EventedMock(), FileMock(), DeleteMock(), MalwareMock()]
+        evented = EventedSignatures(sigs)
+        assert_equals(evented.route("malware.exe", "DeleteFileA", "filesystem"),
+                      (0, 1, 2, 3))
+        assert_equals(evented.route("other.exe", "DeleteFileA", "filesystem"),
+                      (0, 1, 2))
+        assert_equals(evented.route("malware.exe", "RegOpenKeyExA", "registry"),
+                      (0, 3))
+        assert_equals(evented.route("other.exe", "NtClose", "system"), (0,))
+
+        evented.finish(0)
+        assert_equals(evented.route("other.exe", "NtClose", "system"), ())
+        assert_equals(len(evented), 3)
+
+    def test_feed(self):
+        sigs = [DeleteMock(), FileMock(), BrokenMock()]
+        evented = EventedSignatures(sigs)
+        proc = make_process("malware.exe")
+        call = dict(api="DeleteFileA", category="filesystem")
+
+        # The signature following a matched one still gets the call.
+        assert_equals(evented.feed(proc, call), sigs[:1])
+        assert_equals(sigs[1].seen, ["DeleteFileA"])
+        assert_equals(evented.feed(proc, call), [])
+        assert_equals(sigs[0].seen, ["DeleteFileA"])
+        assert_equals(sigs[1].seen, ["DeleteFileA"] * 2)
+        # The failed signature is done.
+        assert_equals(len(evented), 1)
+
+        stats = evented.statistics()
+        assert_equals([x["calls"] for x in stats], [1, 2, 1])
+        assert_true(all(x["time"] >= 0 for x in stats))
+
+class TestRunSignatures:
+    def setUp(self):
+        self.signatures = plugins._modules["signatures"]
+        plugins._modules["signatures"] = [DeleteMock, FileMock, MalwareMock,
+                                          BrokenMock]
+
+    def tearDown(self):
+        plugins._modules["signatures"] = self.signatures
+
+    def test_evented(self):
+        results = {"behavior": {"processes": [
+            make_process("other.exe", ("NtClose", "system"),
+                         ("DeleteFileA", "filesystem")),
+            make_process("malware.exe", ("RegOpenKeyExA", "registry")),
+        ]}}
+        RunSignatures(results).run()
+
+        assert_equals(sorted(x["name"] for x in results["signatures"]),
+                      ["delete", "malware"])
+        assert_equals(sorted(x["name"]
+                             for x in results["statistics"]["signatures"]),
+                      ["broken", "delete", "file", "malware"])
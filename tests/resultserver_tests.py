@@ -0,0 +1,189 @@
+# Copyright (C) 2010-2014 Cuckoo Foundation.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import os
+import hashlib
+import select
+import socket
+import shutil
+import struct
+import tempfile
+from nose.tools import assert_equals, assert_false, assert_true
+
+from lib.cuckoo.common.blobstore import BlobStore
+from lib.cuckoo.common.callstore import CallStore
+from lib.cuckoo.common.logtbl import table as LOGTBL
+from lib.cuckoo.common.objects import Dictionary
+from lib.cuckoo.core.resultserver import AsyncResultHandler, ResultHandler
+from lib.cuckoo.core.resultserver import ResultServer
+from modules.processing.behavior import ProcessBehavior, checkpoint_path
+
+
+class FakeServer(object):
+    def __init__(self, storagepath, live_behavior=False, blobstore=None):
+        self.storagepath = storagepath
+        self.blobstore = blobstore
+        self.cfg = Dictionary(resultserver=Dictionary(
+            store_csvs=False, upload_max_size=1024,
+            live_behavior=live_behavior))
+
+    def build_storage_path(self, ip):
+        return self.storagepath
+
+    def register_handler(self, handler):
+        pass
+
+def netlog_string(s):
+    return struct.pack("II", len(s), len(s)) + s
+
+def netlog_process(pid, ppid, path, filetime=0):
+    return struct.pack("BB", 0, 1) + struct.pack("III", 0, 0, 0) + \
+        struct.pack("IIII", filetime & 0xffffffff, filetime >> 32,
+                    pid, ppid) + netlog_string(path)
+
+class TestAsyncResultHandler:
+    def setUp(self):
+        self.storagepath = tempfile.mkdtemp()
+        self.guest, request = socket.socketpair()
+        self.handler = AsyncResultHandler(request, ("127.0.0.1", 1234),
+                                          FakeServer(self.storagepath))
+
+    def tearDown(self):
+        self.handler.request.close()
+        self.guest.close()
+        shutil.rmtree(self.storagepath)
+
+    def send(self, data):
+        """Send data and let the handler read it, as the event loop would."""
+        self.guest.sendall(data)
+        ret = True
+        while ret and select.select([self.handler.request], [], [], 0)[0]:
+            ret = self.handler.handle_read()
+        return ret
+
+    def test_netlog_partial_messages(self):
+        data = netlog_process(1234, 1, "C:\\malware.exe") + \
+            struct.pack("BB", 1, 1) + struct.pack("III", 0, 0, 0) + \
+            struct.pack("I", 1234)
+
+        assert_true(self.send("NET"))
+        assert_true(self.send("LOG\n"))
+        # Deliver the messages a few bytes at a time.
+        for idx in xrange(0, len(data), 7):
+            assert_true(self.send(data[idx:idx+7]))
+
+        assert_equals(self.handler.pid, 1234)
+        assert_equals(self.handler.procname, "malware.exe")
+
+        self.handler.close()
+        path = os.path.join(self.storagepath, "logs", "1234.raw")
+        assert_equals(open(path, "rb").read(), data)
+
+    def test_buffer_growth(self):
+        data = netlog_process(1, 0, "C:\\" + "a" * 60000 + "\\b.exe")
+        assert_true(self.send("NETLOG\n" + data[:40000]))
+        assert_true(self.send(data[40000:]))
+        assert_equals(self.handler.pid, 1)
+
+    def test_file_upload(self):
+        assert_true(self.send("FILE\nshots/0001.jpg\n"))
+        assert_true(self.send("a" * 100))
+        assert_false(self.send("b" * 2000))
+
+        self.handler.close()
+        path = os.path.join(self.storagepath, "shots", "0001.jpg")
+        assert_equals(open(path, "rb").read(),
+                      "a" * 100 + "b" * 2000 + "... (truncated)")
+
+    def test_file_upload_blob(self):
+        blobstore = BlobStore(os.path.join(self.storagepath, "blobs"))
+        self.handler.server.blobstore = blobstore
+        paths = []
+        for name in "a.bin", "b.bin":
+            guest, request = socket.socketpair()
+            guest.sendall("FILE\nfiles/%s\n" % name + "x" * 100)
+            guest.close()
+            ResultHandler(request, ("127.0.0.1", 1234), self.handler.server)
+            request.close()
+            paths.append(os.path.join(self.storagepath, "files", name))
+
+        # Both uploads share the same blob.
+        assert_true(os.path.samefile(*paths))
+        assert_equals(open(paths[1], "rb").read(), "x" * 100)
+        assert_equals(blobstore.refcount(hashlib.sha256("x" * 100).hexdigest()),
+                      2)
+
+    def test_disconnect(self):
+        assert_true(self.send("LOG\nline one\nline"))
+        self.guest.close()
+        assert_false(self.handler.handle_read())
+
+        self.handler.close()
+        path = os.path.join(self.storagepath, "analysis.log")
+        assert_equals(open(path, "rb").read(), "line one\n")
+
+    def test_close_failure(self):
+        server = ResultServer.__new__(ResultServer)
+        server.poller = select.poll()
+        fd = self.handler.request.fileno()
+        server.poller.register(fd, select.POLLIN)
+        server.connections = {fd: self.handler}
+
+        def close():
+            raise IOError("disk full")
+        self.handler.close = close
+
+        # The connection is closed all the same, and the loop goes on.
+        server.close_async(fd)
+        assert_equals(server.connections, {})
+        assert_true(self.handler.done_event.isSet())
+        assert_equals(self.handler.request.fileno(), -1)
+
+class TestResultHandler:
+    def setUp(self):
+        self.storagepath = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.storagepath)
+
+    def test_netlog(self):
+        data = netlog_process(1234, 1, "C:\\malware.exe") + \
+            "".join(struct.pack("BB", 1, 1) + struct.pack("III", 0, 0, 0) +
+                    struct.pack("I", 1234) for x in xrange(10000))
+
+        guest, request = socket.socketpair()
+        guest.sendall("NETLOG\n" + data)
+        guest.close()
+
+        # Handles the whole connection.
+        handler = ResultHandler(request, ("127.0.0.1", 1234),
+                                FakeServer(self.storagepath))
+        request.close()
+
+        assert_equals(handler.pid, 1234)
+        path = os.path.join(self.storagepath, "logs", "1234.raw")
+        assert_equals(open(path, "rb").read(), data)
+
+    def test_live_behavior(self):
+        filetime = (1388534400 + 11644473600) * 10000000
+        apiindex = [x[0] for x in LOGTBL].index("DeleteFileA")
+        data = netlog_process(1234, 1, "C:\\malware.exe", filetime) + \
+            (struct.pack("BB", apiindex, 1) + struct.pack("III", 0, 1, 0) +
+             netlog_string("C:\\a.txt")) * 10
+
+        guest, request = socket.socketpair()
+        guest.sendall("NETLOG\n" + data)
+        guest.close()
+
+        ResultHandler(request, ("127.0.0.1", 1234),
+                      FakeServer(self.storagepath, live_behavior=True))
+        request.close()
+
+        state = ProcessBehavior.load(checkpoint_path(self.storagepath, 1234))
+        assert_true(state.complete)
+        assert_equals(state.process["process_name"], "malware.exe")
+        # The ten identical calls are merged.
+        assert_equals(state.count, 1)
+        path = os.path.join(self.storagepath, "calls", "1234.calls")
+        assert_equals(CallStore(path)[0]["repeated"], 9)
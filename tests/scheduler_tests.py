@@ -0,0 +1,363 @@
+# Copyright (C) 2010-2014 Cuckoo Foundation.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import os
+import time
+import Queue
+import threading
+from nose.tools import assert_equals, assert_raises, assert_true
+
+import lib.cuckoo.core.processor as processor
+import lib.cuckoo.core.scheduler as scheduler
+from lib.cuckoo.common.objects import Dictionary
+from lib.cuckoo.core.database import Database, TASK_COMPLETED, TASK_REPORTED
+from lib.cuckoo.core.database import TASK_PENDING, TASK_RUNNING, TASK_SINGLE
+from lib.cuckoo.core.scheduler import AnalysisManager, AnalysisPool
+from lib.cuckoo.core.scheduler import MachineReservations
+
+from helpers import swap_database, temp_database
+
+
+class FakeMachinery(object):
+    """Machinery whose machines take a fixed time to start."""
+
+    def __init__(self, count, delay):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.free = set("vm%d" % idx for idx in xrange(count))
+        self.locks = dict((label, threading.Lock()) for label in self.free)
+        self.started = 0
+        self.running = 0
+        self.max_running = 0
+
+    def availables(self, locked_by=None):
+        return len(self.free)
+
+    def acquire(self, machine_id=None, platform=None, tags=None,
+                locked_by=None):
+        with self.lock:
+            if not self.free:
+                return None
+            label = self.free.pop()
+            return Dictionary(name=label, label=label, ip="192.168.56.101",
+                              platform="windows",
+                              resultserver_ip="192.168.56.1",
+                              resultserver_port=2042)
+
+    def release(self, label):
+        with self.lock:
+            self.free.add(label)
+
+    def get_lock(self, label):
+        return self.locks[label]
+
+    def start(self, label, revert=True):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(self.delay)
+        with self.lock:
+            self.started += 1
+
+    def stop(self, label):
+        with self.lock:
+            self.running -= 1
+
+class FakeAuxiliary(object):
+    def __init__(self, task, machine):
+        pass
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+class FakeGuest(object):
+    def __init__(self, name, ip, timeout, platform):
+        pass
+
+    def start_analysis(self, options):
+        pass
+
+    def wait_for_completion(self):
+        pass
+
+class FakeResultServer(object):
+    def add_task(self, task, machine):
+        pass
+
+    def del_task(self, task, machine):
+        pass
+
+def run_starts(machines, limit, starts, delay):
+    """Run as many analyses as there are starts, from as many threads,
+    through AnalysisManager.launch_analysis() with fake machines and guests.
+    @return: tuple of (elapsed seconds, fake machinery).
+    """
+    patched = (scheduler.ResultServer, scheduler.RunAuxiliary,
+               scheduler.GuestManager)
+    database, path = temp_database()
+    previous = swap_database(database)
+    scheduler.ResultServer = FakeResultServer
+    scheduler.RunAuxiliary = FakeAuxiliary
+    scheduler.GuestManager = FakeGuest
+    scheduler.machinery = FakeMachinery(machines, delay)
+    scheduler.reservations = MachineReservations(limit)
+
+    try:
+        Database().config_set("cuckoo.timeouts.default", 120)
+        Database().config_set("cuckoo.timeouts.critical", 600)
+
+        analyses = []
+        for idx in xrange(starts):
+            task = Database().view_task(Database().add_url("http://%d" % idx))
+            analysis = AnalysisManager(Dictionary(
+                id=task.id, experiment_id=task.experiment_id,
+                category=task.category, target=task.target, machine=None,
+                platform=None, tags=[], repeat=TASK_SINGLE, timeout=0,
+                package=None, options=None, enforce_timeout=False,
+                clock=None, memory=False), Queue.Queue())
+            analysis.init_storage = lambda: True
+            analyses.append(analysis)
+
+        results = []
+
+        def launch(analysis):
+            results.append(analysis.launch_analysis())
+
+        threads = [threading.Thread(target=launch, args=(analysis,))
+                   for analysis in analyses]
+
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+    finally:
+        (scheduler.ResultServer, scheduler.RunAuxiliary,
+         scheduler.GuestManager) = patched
+        swap_database(previous)
+        os.unlink(path)
+
+    # All the analyses succeeded, their machines have been stopped and
+    # released.
+    assert_equals(results, [True] * starts)
+    assert_equals(scheduler.machinery.running, 0)
+    assert_equals(len(scheduler.machinery.free), machines)
+    return elapsed, scheduler.machinery
+
+class TestMachineStarts:
+    def test_parallel_starts(self):
+        elapsed, machinery = run_starts(machines=4, limit=0, starts=4,
+                                        delay=0.2)
+        assert_equals(machinery.started, 4)
+        assert_true(elapsed < 0.6)
+
+    def test_max_machines_count(self):
+        elapsed, machinery = run_starts(machines=4, limit=2, starts=6,
+                                        delay=0.05)
+        assert_equals(machinery.started, 6)
+        assert_equals(machinery.max_running, 2)
+
+class TestReservations:
+    def test_released_on_error(self):
+        scheduler.machinery = FakeMachinery(1, 0)
+        scheduler.reservations = MachineReservations(1)
+
+        task = Dictionary(id=1, experiment_id=1, machine=None, platform=None,
+                          tags=[], category="url", target="http://foo")
+        analysis = AnalysisManager(task, None)
+        analysis.init_storage = lambda: True
+
+        def build_options():
+            raise ValueError("foo")
+
+        analysis.build_options = build_options
+        assert_raises(ValueError, analysis.launch_analysis)
+
+        # Neither the capacity nor the machine are lost.
+        assert_equals(scheduler.reservations.free(), 1)
+        assert_equals(len(scheduler.machinery.free), 1)
+
+class BlockedAnalysis(object):
+    """Analysis waiting for a machine until it's released."""
+
+    def __init__(self, task_id, event=None):
+        self.task = Dictionary(id=task_id)
+        self.event = event
+        self.machine = None
+        self.timings = {"machine": 2}
+
+    def run(self):
+        if self.event:
+            self.event.wait(10)
+
+class TestAnalysisPool:
+    def setUp(self):
+        database, self.path = temp_database()
+        self.database = swap_database(database)
+
+    def tearDown(self):
+        swap_database(self.database)
+        os.unlink(self.path)
+
+    def test_shutdown(self):
+        task_ids = [Database().add_url("http://%d.example" % idx)
+                    for idx in xrange(3)]
+        for task_id in task_ids:
+            Database().set_status(task_id, TASK_RUNNING)
+
+        release = threading.Event()
+        pool = AnalysisPool(1)
+        for task_id in task_ids:
+            pool.submit(BlockedAnalysis(task_id, release))
+        while pool.status()["active"] != 1:
+            time.sleep(0.01)
+        assert_equals(pool.status()["queued"], 2)
+        assert_equals(pool.acquiring(), 3)
+
+        thread = threading.Thread(target=pool.shutdown)
+        thread.start()
+        while pool.status()["queued"]:
+            time.sleep(0.01)
+        release.set()
+        thread.join()
+
+        # The running analysis completed, the others are back to pending.
+        status = pool.status()
+        assert_equals((status["active"], status["completed"]), (0, 1))
+        assert_equals(status["timings"], {"machine": 2})
+        assert_equals([Database().view_task(task_id).status
+                       for task_id in task_ids],
+                      [TASK_RUNNING, TASK_PENDING, TASK_PENDING])
+
+    def test_batch_limit(self):
+        sched = scheduler.Scheduler()
+        sched.cfg = Dictionary(cuckoo=Dictionary(max_batch_count=0))
+        sched.pool = AnalysisPool(0)
+        scheduler.reservations = MachineReservations(0)
+        assert_equals(sched.batch_limit(4), 4)
+
+        # Queued analyses are about to take some of the free machines.
+        sched.pool.submit(BlockedAnalysis(1))
+        sched.pool.submit(BlockedAnalysis(2))
+        assert_equals(sched.batch_limit(4), 2)
+        assert_true(sched.batch_limit(1) < 1)
+
+        sched.cfg.cuckoo.max_batch_count = 1
+        assert_equals(sched.batch_limit(4), 1)
+
+        sched.cfg.cuckoo.max_batch_count = 0
+        scheduler.reservations = MachineReservations(3)
+        scheduler.reservations.reserve()
+        scheduler.reservations.reserve()
+        assert_equals(sched.batch_limit(4), 1)
+
+        scheduler.reservations = MachineReservations(0)
+        sched.maxcount = 5
+        sched.total_analysis_count = 4
+        assert_equals(sched.batch_limit(4), 1)
+
+class FakeAnalysisManager(object):
+    """Analysis manager completing its analysis right away."""
+
+    def __init__(self, task, errors):
+        self.task = task
+        self.machine = None
+        self.timings = {}
+
+    def run(self):
+        Database().set_status(self.task.id, TASK_COMPLETED)
+        processor.notify_completed(self.task.id)
+        # The machine has been released.
+        Database().notify()
+
+def fake_process(task_id, report=False, auto=False):
+    Database().set_status(task_id, TASK_REPORTED)
+
+class TestProcessing:
+    def setUp(self):
+        # The scheduler gets a fresh database.
+        database, self.path = temp_database()
+        self.database = swap_database(database)
+
+        Database().config_set("cuckoo.timeouts.default", 120)
+        Database().config_set("cuckoo.timeouts.critical", 600)
+
+        self.process = processor.process
+        self.manager = scheduler.AnalysisManager
+        processor.process = fake_process
+        scheduler.AnalysisManager = FakeAnalysisManager
+
+    def tearDown(self):
+        processor.process = self.process
+        scheduler.AnalysisManager = self.manager
+        processor._queue = None
+        swap_database(self.database)
+        os.unlink(self.path)
+
+    def test_reported_before_exit(self):
+        machine = Dictionary(id=1, name="vm1", label="vm1", platform="windows",
+                             tags=[], locked_by=None)
+        machinery = Dictionary(machines=lambda: [machine],
+                               free_machines=lambda: [machine],
+                               shutdown=lambda: None)
+
+        def initialize():
+            scheduler.machinery = machinery
+            scheduler.reservations = MachineReservations(0)
+
+        task_id = Database().add_url("http://foo.example")
+        sched = scheduler.Scheduler(maxcount=1)
+        sched.initialize = initialize
+        sched.cfg = Dictionary(cuckoo=Dictionary(process_results=True),
+                               processing=Dictionary(workers=1))
+        sched.start()
+
+        # The results have been processed before the scheduler returned.
+        assert_equals(Database().view_task(task_id).status, TASK_REPORTED)
+
+    def test_retry_delay(self):
+        task_id = Database().add_url("http://foo.example")
+        Database().set_status(task_id, TASK_COMPLETED)
+
+        queue = processor.ProcessingQueue(retries=2)
+        queue._failed(task_id, "failed")
+        assert_equals(queue._dispatch(), 0)
+
+        # Retried once the delay has expired, then after twice the delay.
+        queue.retry_at[task_id] -= queue.RETRY_DELAY
+        assert_equals(queue._dispatch(), 1)
+        queue.processes[task_id][0].join()
+        del queue.processes[task_id]
+        queue._failed(task_id, "failed")
+        assert_true(queue.retry_at[task_id] - time.time() >
+                    queue.RETRY_DELAY * 1.5)
+
+        # Given up on.
+        queue._failed(task_id, "failed")
+        assert_equals(queue.retry_at, {})
+        assert_equals(queue._dispatch(), 0)
+
+    def test_retry_not_counted(self):
+        first = Database().add_url("http://foo.example")
+        second = Database().add_url("http://bar.example")
+        Database().set_status(first, TASK_COMPLETED)
+
+        queue = processor.ProcessingQueue(workers=2, retries=1, maxcount=2)
+        assert_equals(queue._dispatch(), 1)
+        queue.processes[first][0].join()
+        del queue.processes[first]
+        Database().set_status(first, TASK_COMPLETED)
+        queue._failed(first, "failed")
+
+        # The retry of the first analysis leaves room for the second one.
+        queue.retry_at[first] -= queue.RETRY_DELAY
+        Database().set_status(second, TASK_COMPLETED)
+        assert_equals(queue._dispatch(), 2)
+        for proc, started in queue.processes.values():
+            proc.join()
+        assert_equals(queue.counted, set([first, second]))
@@ -0,0 +1,147 @@
+# Copyright (C) 2010-2014 Cuckoo Foundation.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import re
+from nose.tools import assert_equals, assert_false, assert_true, raises
+
+from lib.cuckoo.common.search import MAX_VALUES, search_document
+from lib.cuckoo.common.search import report_query, search_indexes, search_query
+
+
+def make_report(files=(), domains=(), name="sample.exe"):
+    return {
+        "info": {"id": 1},
+        "target": {"file": {"name": name, "type": "PE32 executable"}},
+        "behavior": {"summary": {"files": list(files), "keys": [],
+                                 "mutexes": []}},
+        "network": {"domains": [{"domain": x, "ip": ""} for x in domains]},
+        "signatures": [{"description": "Creates an executable"}],
+        "strings": [],
+    }
+
+def matches(document, query):
+    """Evaluate a query on a search document, as MongoDB would."""
+    for field, condition in query.iteritems():
+        values = document[field]
+        if not isinstance(condition, dict):
+            if condition not in values:
+                return False
+        elif "$all" in condition:
+            if not set(condition["$all"]).issubset(values):
+                return False
+        elif not any(re.search(condition["$regex"], x) for x in values):
+            return False
+    return True
+
+def report_values(report, field):
+    """@return: values of a dotted field of a report, as MongoDB sees them."""
+    values = [report]
+    for key in field.split("."):
+        found = []
+        for value in values:
+            value = value.get(key, [])
+            found.extend(value if isinstance(value, list) else [value])
+        values = found
+    return values
+
+def report_matches(report, query):
+    """Evaluate a query on a report, as MongoDB would."""
+    for condition in query.get("$and", [query]):
+        for field, regex in condition.iteritems():
+            assert_equals(regex["$options"], "i")
+            if not any(re.search(regex["$regex"], x, re.I)
+                       for x in report_values(report, field)):
+                return False
+    return True
+
+class TestSearch:
+    def setUp(self):
+        self.documents = [
+            search_document(make_report(
+                files=["C:\\Windows\\system32\\evil.dll"],
+                domains=["update.example.com"])),
+            search_document(make_report(
+                files=["C:\\Users\\foo\\AppData\\evil.exe"],
+                domains=["example.org"], name="Invoice.pdf.exe")),
+        ]
+
+    def search(self, name, value):
+        query = search_query(name, value)
+        return [idx for idx, document in enumerate(self.documents)
+                if matches(document, query)]
+
+    def test_document(self):
+        document = self.documents[0]
+        assert_equals(document["file"], [u"c:\\windows\\system32\\evil.dll"])
+        assert_equals(document["domain_rev"], [u"moc.elpmaxe.etadpu"])
+        assert_equals(document["domain_tokens"],
+                      [u"com", u"example", u"update"])
+        assert_true(u"evi" in document["file_ngrams"])
+        assert_equals(sorted(document), sorted(search_indexes()))
+
+    def test_substring(self):
+        assert_equals(self.search("file", "EVIL"), [0, 1])
+        assert_equals(self.search("file", "system32\\evil"), [0])
+        assert_equals(self.search("domain", "example"), [0, 1])
+        # All the substrings are there, not in that order.
+        assert_equals(self.search("domain", "exampleupdate"), [])
+
+    def test_anchors(self):
+        assert_equals(self.search("domain", "example.org$"), [1])
+        assert_equals(self.search("domain", "^update."), [0])
+        assert_equals(self.search("domain", "^example.org$"), [1])
+        assert_equals(self.search("name", ".exe$"), [0, 1])
+
+    def test_tokens(self):
+        assert_equals(self.search("file", "\"evil exe\""), [1])
+        assert_equals(self.search("signature", "\"executable\""), [0, 1])
+        assert_equals(self.search("signature", "\"execut\""), [])
+
+    @raises(ValueError)
+    def test_too_short(self):
+        search_query("file", "^ab")
+
+    @raises(ValueError)
+    def test_unknown_field(self):
+        search_query("foo", "bar")
+
+    def test_bounded(self):
+        document = search_document(make_report(
+            files=["file%d" % x for x in xrange(MAX_VALUES * 2)]))
+        assert_equals(len(document["file"]), MAX_VALUES)
+        assert_true(document["truncated"])
+        assert_false(self.documents[0]["truncated"])
+
+    def test_limits(self):
+        report = make_report(files=["file%d" % x for x in xrange(5)],
+                             domains=["a" * 20])
+        document = search_document(report, max_values=0, max_length=0)
+        assert_equals(len(document["file"]), 5)
+        assert_false(document["truncated"])
+
+        document = search_document(report, max_values=5, max_length=10)
+        assert_equals(document["domain"], [u"a" * 10])
+        assert_true(document["truncated"])
+
+    def test_report_query(self):
+        reports = [
+            make_report(files=["C:\\Windows\\system32\\evil.dll"],
+                        domains=["update.example.com"]),
+            make_report(files=["C:\\Users\\foo\\AppData\\evil.exe"],
+                        domains=["example.org"], name="Invoice.pdf.exe"),
+        ]
+
+        def search(name, value):
+            query = report_query(name, value)
+            return [idx for idx, report in enumerate(reports)
+                    if report_matches(report, query)]
+
+        # The reports are searched as the search documents are.
+        assert_equals(search("file", "EVIL"), [0, 1])
+        assert_equals(search("file", "system32\\evil"), [0])
+        assert_equals(search("domain", "^example.org$"), [1])
+        assert_equals(search("domain", "example.org$"), [1])
+        assert_equals(search("name", "^invoice."), [1])
+        assert_equals(search("file", "\"evil exe\""), [1])
+        assert_equals(search("signature", "\"execut\""), [])
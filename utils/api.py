@@ -21,6 +21,7 @@ except ImportError:
 sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), ".."))
 
 from lib.cuckoo.common.constants import CUCKOO_VERSION, CUCKOO_ROOT
+from lib.cuckoo.common.jsonwriter import find_output, open_input
 from lib.cuckoo.common.utils import store_temp_file, delete_folder
 from lib.cuckoo.common.utils import time_duration
 from lib.cuckoo.core.database import Database, TASK_RECURRENT
@@ -238,7 +239,6 @@ def tasks_delete(task_id):
 @route("/v1/tasks/report/<task_id:int>/<report_format>", method="GET")
 def tasks_report(task_id, report_format="json"):
     formats = {
-        "json": "report.json",
         "html": "report.html",
         "maec": "report.maec-1.1.xml",
         "metadata": "report.metadata.xml",
@@ -255,7 +255,17 @@ def tasks_report(task_id, report_format="json"):
         "tar": "w",
     }
 
-    if report_format.lower() in formats:
+    if report_format.lower() == "json":
+        # The JSON report may be compressed, it's returned decompressed.
+        report_path = find_output(os.path.join(CUCKOO_ROOT, "storage",
+                                               "analyses", "%d" % task_id,
+                                               "reports", "report.json"))
+        if not report_path:
+            return HTTPError(404, "Report not found")
+
+        response.content_type = "application/json; charset=UTF-8"
+        return open_input(report_path)
+    elif report_format.lower() in formats:
         report_path = os.path.join(CUCKOO_ROOT, "storage", "analyses",
                                    "%d" % task_id, "reports",
                                    formats[report_format.lower()])
@@ -364,6 +374,7 @@ def cuckoo_status():
             completed=db.count_tasks("completed"),
             reported=db.count_tasks("reported")
         ),
+        database=db.pool_status(),
     )
 
     return jsonize(response)
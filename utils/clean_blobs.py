@@ -0,0 +1,19 @@
+#!/usr/bin/env python
+# Copyright (C) 2010-2014 Cuckoo Foundation.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import os.path
+import sys
+
+sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), ".."))
+
+from lib.cuckoo.common.blobstore import BlobStore
+
+def main():
+    """Delete the blobs of the samples and dropped files that no analysis
+    refers to anymore, once the analyses have been deleted."""
+    print("%d unreferenced blobs deleted" % BlobStore().collect())
+
+if __name__ == "__main__":
+    main()
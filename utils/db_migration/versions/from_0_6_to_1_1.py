@@ -35,7 +35,7 @@ except ImportError:
     sys.exit()
 
 try:
-    from pymongo.connection import Connection
+    from pymongo import MongoClient
     from pymongo.errors import ConnectionFailure
 except ImportError:
     print "Unable to import pymongo (install with `pip install pymongo`)"
@@ -273,7 +273,7 @@ def mongo_upgrade():
 
         # Connect.
         try:
-            conn = Connection(host, port)
+            conn = MongoClient(host, port)
             db = conn.cuckoo
         except TypeError:
             print "Mongo connection port must be integer"
@@ -287,7 +287,7 @@ def mongo_upgrade():
             print "Mongo schema version not expected"
             sys.exit()
         else:
-            db.cuckoo_schema.save({"version": mongo_revision})
+            db.cuckoo_schema.insert_one({"version": mongo_revision})
 
     else:
         print "Mongo reporting module not enabled, skipping mongo migration."
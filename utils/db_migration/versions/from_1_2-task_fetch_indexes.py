@@ -0,0 +1,28 @@
+# Copyright (C) 2010-2014 Cuckoo Foundation.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+"""added indexes used to fetch tasks
+
+Revision ID: 3aa42d870199
+Revises: 5adbab2b7915
+Create Date: 2026-10-17 10:12:41.211043
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3aa42d870199'
+down_revision = '5adbab2b7915'
+
+from alembic import op
+
+def upgrade():
+    op.create_index('tasks_status_added_on_priority_index', 'tasks',
+                    ['status', 'added_on', 'priority'])
+    op.create_index('tasks_experiment_id_status_index', 'tasks',
+                    ['experiment_id', 'status'])
+
+
+def downgrade():
+    op.drop_index('tasks_experiment_id_status_index', 'tasks')
+    op.drop_index('tasks_status_added_on_priority_index', 'tasks')
@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# Copyright (C) 2010-2014 Cuckoo Foundation.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+import os.path
+import sys
+
+sys.path.append(os.path.join(os.path.abspath(os.path.dirname(__file__)), ".."))
+
+from lib.cuckoo.common.config import Config
+from lib.cuckoo.common.exceptions import CuckooOperationalError
+from lib.cuckoo.common.exceptions import CuckooCriticalError
+from modules.reporting.mongodb import MongoDB
+
+def main():
+    """Build again the search documents of the reports stored in MongoDB,
+    e.g. after changing their limits."""
+    report = MongoDB()
+    report.set_options(Config("reporting").mongodb)
+
+    try:
+        report.setup()
+        count = report.index_search()
+    except (CuckooOperationalError, CuckooCriticalError) as e:
+        sys.exit(str(e))
+
+    print("%d reports indexed" % count)
+
+if __name__ == "__main__":
+    main()
@@ -21,11 +21,21 @@ from gridfs import GridFS
 
 sys.path.append(settings.CUCKOO_PATH)
 
+from lib.cuckoo.common.search import FIELDS as SEARCH_FIELDS
+from lib.cuckoo.common.search import MAX_RESULTS, report_query, search_query
 from lib.cuckoo.core.database import Database, TASK_PENDING, TASK_SCHEDULED, TASK_UNSCHEDULED, TASK_RUNNING
 
-results_db = pymongo.connection.Connection(settings.MONGO_HOST, settings.MONGO_PORT).cuckoo
+results_db = pymongo.MongoClient(settings.MONGO_HOST, settings.MONGO_PORT).cuckoo
 fs = GridFS(results_db)
 
+# Searches of exact values, run on the reports.
+EXACT_SEARCHES = {
+    "crc32": "target.file.crc32",
+    "ip": "network.hosts",
+    "url": "target.url",
+    "imphash": "static.pe_imphash",
+}
+
 @require_safe
 def index(request):
     db = Database()
@@ -138,6 +148,53 @@ def pending(request):
                               {"tasks": pending},
                               context_instance=RequestContext(request))
 
+# Number of calls per page of filtered calls.
+FILTERED_PAGE_SIZE = 100
+
+def latest_analysis_id(task_id):
+    """Get the object id of the latest report of a task.
+    @param task_id: cuckoo task id
+    @return: object id or None.
+    """
+    record = results_db.analysis.find_one({"info.id": int(task_id)},
+                                          {"_id": 1},
+                                          sort=[("_id", pymongo.DESCENDING)])
+    return record["_id"] if record else None
+
+def aggregate_calls(pipeline):
+    """Run an aggregation on the chunks of calls.
+    @param pipeline: aggregation pipeline.
+    @return: list of resulting documents.
+    """
+    return list(results_db.calls.aggregate(pipeline))
+
+def legacy_process_chunks(task_id, pid):
+    """Get the chunk ids of a process from its report, for the reports
+    stored without the metadata of the chunks.
+    @param task_id: cuckoo task id
+    @param pid: pid you want calls
+    @return: list of chunk object ids.
+    """
+    record = results_db.analysis.find_one(
+        {
+            "info.id": int(task_id),
+            "behavior.processes.process_id": pid
+        },
+        {
+            "behavior.processes.process_id": 1,
+            "behavior.processes.calls": 1
+        }
+    )
+
+    if not record:
+        raise PermissionDenied
+
+    for pdict in record["behavior"]["processes"]:
+        if pdict["process_id"] == pid:
+            return pdict["calls"]
+
+    raise PermissionDenied
+
 @require_safe
 def chunk(request, task_id, pid, pagenum):
     try:
@@ -146,30 +203,15 @@ def chunk(request, task_id, pid, pagenum):
         raise PermissionDenied
 
     if request.is_ajax():
-        record = results_db.analysis.find_one(
-            {
-                "info.id": int(task_id),
-                "behavior.processes.process_id": pid
-            },
-            {
-                "behavior.processes.process_id": 1,
-                "behavior.processes.calls": 1
-            }
-        )
-
-        if not record:
-            raise PermissionDenied
+        chunk = results_db.calls.find_one({
+            "analysis_id": latest_analysis_id(task_id),
+            "pid": pid,
+            "index": pagenum,
+        })
 
-        process = None
-        for pdict in record["behavior"]["processes"]:
-            if pdict["process_id"] == pid:
-                process = pdict
-
-        if not process:
-            raise PermissionDenied
-
-        objectid = process["calls"][pagenum]
-        chunk = results_db.calls.find_one({"_id": ObjectId(objectid)})
+        if not chunk:
+            objectid = legacy_process_chunks(task_id, pid)[pagenum]
+            chunk = results_db.calls.find_one({"_id": ObjectId(objectid)})
 
         return render_to_response("analysis/behavior/_chunk.html",
                                   {"chunk": chunk},
@@ -186,37 +228,70 @@ def filtered_chunk(request, task_id, pid, category):
     @param category: call category type
     """
     if request.is_ajax():
-        # Search calls related to your PID.
-        record = results_db.analysis.find_one(
-            {"info.id": int(task_id), "behavior.processes.process_id": int(pid)},
-            {"behavior.processes.process_id": 1, "behavior.processes.calls": 1}
-        )
-
-        if not record:
-            raise PermissionDenied
-
-        # Extract embedded document related to your process from response collection.
-        process = None
-        for pdict in record["behavior"]["processes"]:
-            if pdict["process_id"] == int(pid):
-                process = pdict
-
-        if not process:
+        try:
+            pid = int(pid)
+            page = int(request.GET.get("page", 1)) - 1
+        except ValueError:
             raise PermissionDenied
 
         # Create empty process dict for AJAX view.
         filtered_process = {"process_id": pid, "calls": []}
-
-        # Populate dict, fetching data from all calls and selecting only appropriate category.
-        for call in process["calls"]:
-            chunk = results_db.calls.find_one({"_id": call})
-            for call in chunk["calls"]:
-                if call["category"] == category:
-                    filtered_process["calls"].append(call)
-
-        return render_to_response("analysis/behavior/_chunk.html",
-                                  {"chunk": filtered_process},
-                                  context_instance=RequestContext(request))
+        pages = 0
+
+        # Only the chunks holding calls of the category are read, and only
+        # the calls of the requested page are sent back.
+        match = {
+            "analysis_id": latest_analysis_id(task_id),
+            "pid": pid,
+            "categories": category,
+        }
+        call_match = {"calls.category": category}
+        if request.GET.get("api"):
+            match["apis"] = call_match["calls.api"] = request.GET["api"]
+
+        if results_db.calls.find_one({"analysis_id": match["analysis_id"],
+                                      "pid": pid}, {"_id": 1}):
+            if "apis" in match:
+                count = [
+                    {"$unwind": "$calls"},
+                    {"$match": call_match},
+                    {"$group": {"_id": None, "count": {"$sum": 1}}},
+                ]
+            else:
+                count = [{"$group": {
+                    "_id": None,
+                    "count": {"$sum": "$category_counts.%s" % category},
+                }}]
+
+            result = aggregate_calls([{"$match": match}] + count)
+            if result:
+                pages = (result[0]["count"] + FILTERED_PAGE_SIZE - 1) / \
+                    FILTERED_PAGE_SIZE
+
+            result = aggregate_calls([
+                {"$match": match},
+                {"$sort": {"index": 1}},
+                {"$unwind": "$calls"},
+                {"$match": call_match},
+                {"$skip": page * FILTERED_PAGE_SIZE},
+                {"$limit": FILTERED_PAGE_SIZE},
+                {"$project": {"_id": 0, "call": "$calls"}},
+            ])
+            filtered_process["calls"] = [x["call"] for x in result]
+        else:
+            # Populate dict, fetching data from all calls and selecting only
+            # appropriate category.
+            for objectid in legacy_process_chunks(task_id, pid):
+                chunk = results_db.calls.find_one({"_id": objectid})
+                for call in chunk["calls"]:
+                    if call["category"] == category:
+                        filtered_process["calls"].append(call)
+
+        response = render_to_response("analysis/behavior/_chunk.html",
+                                      {"chunk": filtered_process},
+                                      context_instance=RequestContext(request))
+        response["X-Pages"] = str(pages)
+        return response
     else:
         raise PermissionDenied
 
@@ -262,6 +337,8 @@ def file(request, category, object_id):
 def search(request):
     if "search" in request.POST:
         error = None
+        # Reports searched without their search document.
+        reports = None
 
         try:
             term, value = request.POST["search"].strip().split(":", 1)
@@ -281,32 +358,29 @@ def search(request):
             value = value.lstrip()
 
             # Search logic.
-            if term == "name":
-                records = results_db.analysis.find({"target.file.name": {"$regex": value, "$options": "-i"}}).sort([["_id", -1]])
-            elif term == "type":
-                records = results_db.analysis.find({"target.file.type": {"$regex": value, "$options": "-i"}}).sort([["_id", -1]])
-            elif term == "string":
-                records = results_db.analysis.find({"strings" : {"$regex" : value, "$options" : "-1"}}).sort([["_id", -1]])
-            elif term == "ssdeep":
-                records = results_db.analysis.find({"target.file.ssdeep": {"$regex": value, "$options": "-i"}}).sort([["_id", -1]])
-            elif term == "crc32":
-                records = results_db.analysis.find({"target.file.crc32": value}).sort([["_id", -1]])
-            elif term == "file":
-                records = results_db.analysis.find({"behavior.summary.files": {"$regex": value, "$options": "-i"}}).sort([["_id", -1]])
-            elif term == "key":
-                records = results_db.analysis.find({"behavior.summary.keys": {"$regex": value, "$options": "-i"}}).sort([["_id", -1]])
-            elif term == "mutex":
-                records = results_db.analysis.find({"behavior.summary.mutexes": {"$regex": value, "$options": "-i"}}).sort([["_id", -1]])
-            elif term == "domain":
-                records = results_db.analysis.find({"network.domains.domain": {"$regex": value, "$options": "-i"}}).sort([["_id", -1]])
-            elif term == "ip":
-                records = results_db.analysis.find({"network.hosts": value}).sort([["_id", -1]])
-            elif term == "signature":
-                records = results_db.analysis.find({"signatures.description": {"$regex": value, "$options": "-i"}}).sort([["_id", -1]])
-            elif term == "url":
-                records = results_db.analysis.find({"target.url": value}).sort([["_id", -1]])
-            elif term == "imphash":
-                records = results_db.analysis.find({"static.pe_imphash": value}).sort([["_id", -1]])
+            if term in SEARCH_FIELDS:
+                try:
+                    query = search_query(term, value)
+                except ValueError as e:
+                    return render_to_response("analysis/search.html",
+                                              {"analyses": None,
+                                               "term": request.POST["search"],
+                                               "error": str(e)},
+                                              context_instance=RequestContext(request))
+                records = results_db.search.find(query, {"task_id": 1})
+
+                # Values may be missing from the truncated search documents,
+                # their reports are searched as a whole.
+                truncated = [x["_id"] for x in
+                             results_db.search.find({"truncated": True},
+                                                    {"_id": 1})]
+                if truncated:
+                    query = report_query(term, value)
+                    query["_id"] = {"$in": truncated}
+                    reports = results_db.analysis.find(query, {"info.id": 1})
+            elif term in EXACT_SEARCHES:
+                records = results_db.analysis.find({EXACT_SEARCHES[term]: value},
+                                                   {"info.id": 1})
             else:
                 return render_to_response("analysis/search.html",
                                           {"analyses": None,
@@ -315,13 +389,13 @@ def search(request):
                                           context_instance=RequestContext(request))
         else:
             if re.match(r"^([a-fA-F\d]{32})$", value):
-                records = results_db.analysis.find({"target.file.md5": value}).sort([["_id", -1]])
+                records = results_db.analysis.find({"target.file.md5": value}, {"info.id": 1})
             elif re.match(r"^([a-fA-F\d]{40})$", value):
-                records = results_db.analysis.find({"target.file.sha1": value}).sort([["_id", -1]])
+                records = results_db.analysis.find({"target.file.sha1": value}, {"info.id": 1})
             elif re.match(r"^([a-fA-F\d]{64})$", value):
-                records = results_db.analysis.find({"target.file.sha256": value}).sort([["_id", -1]])
+                records = results_db.analysis.find({"target.file.sha256": value}, {"info.id": 1})
             elif re.match(r"^([a-fA-F\d]{128})$", value):
-                records = results_db.analysis.find({"target.file.sha512": value}).sort([["_id", -1]])
+                records = results_db.analysis.find({"target.file.sha512": value}, {"info.id": 1})
             else:
                 return render_to_response("analysis/search.html",
                                           {"analyses": None,
@@ -329,24 +403,25 @@ def search(request):
                                            "error": "Unable to recognize the search syntax"},
                                           context_instance=RequestContext(request))
 
-        # Get data from cuckoo db.
-        db = Database()
-        analyses = []
-
-        for result in records:
-            new = db.view_task(result["info"]["id"])
+        # Latest analyses first, a task may have been reported more than once.
+        results = list(records.sort([["_id", -1]]).limit(MAX_RESULTS))
+        if reports:
+            results += reports.sort([["_id", -1]]).limit(MAX_RESULTS)
+            results.sort(key=lambda result: result["_id"], reverse=True)
 
-            if not new:
-                continue
-
-            new = new.to_dict()
-
-            if result["info"]["category"] == "file":
-                if new["sample_id"]:
-                    sample = db.view_sample(new["sample_id"])
-                    if sample:
-                        new["sample"] = sample.to_dict()
+        task_ids = []
+        for result in results[:MAX_RESULTS]:
+            task_id = result["task_id"] if "task_id" in result \
+                else result["info"]["id"]
+            if task_id not in task_ids:
+                task_ids.append(task_id)
 
+        # Get data from cuckoo db, all the tasks and samples at once.
+        analyses = []
+        for task in Database().view_tasks(task_ids):
+            new = task.to_dict()
+            if task.sample:
+                new["sample"] = task.sample.to_dict()
             analyses.append(new)
 
         return render_to_response("analysis/search.html",
@@ -385,12 +460,14 @@ def remove(request, task_id):
             for drop in analysis["dropped"]:
                 if "object_id" in drop and results_db.analysis.find({"dropped.object_id": ObjectId(drop["object_id"])}).count() == 1:
                     fs.delete(ObjectId(drop["object_id"]))
-            # Delete calls.
-            for process in analysis["behavior"]["processes"]:
-                for call in process["calls"]:
-                    results_db.calls.remove({"_id": ObjectId(call)})
-            # Delete analysis data.
-            results_db.analysis.remove({"_id": ObjectId(analysis["_id"])})
+            # Delete calls, all at once.
+            chunks = [ObjectId(call)
+                      for process in analysis["behavior"]["processes"]
+                      for call in process["calls"]]
+            results_db.calls.delete_many({"_id": {"$in": chunks}})
+            # Delete analysis data and its search document.
+            results_db.analysis.delete_one({"_id": ObjectId(analysis["_id"])})
+            results_db.search.delete_one({"_id": ObjectId(analysis["_id"])})
     elif anals.count() == 0:
         return render_to_response("error.html",
                                   {"error": "The specified analysis does not exist"},